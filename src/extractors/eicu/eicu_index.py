@@ -0,0 +1,164 @@
+"""
+On-disk index of the rows of every patient-stay (patientunitstayid) in the eICU tables, so that the rows of a
+patient (or of thousands of them) are read by seeking straight to them instead of scanning whole tables.
+
+The index is a SQLite file with the byte ranges of every run of consecutive rows of the same patient in each table,
+keyed by (table, patientunitstayid). It is built with a single pass over each table and a table is re-indexed
+whenever its size, modification time, or position of its patientunitstayid column changes.
+
+Example:
+    python eicu_index.py ../../../data/eicu
+
+    connection = open_index("../../../data/eicu")
+    for table in TABLES:
+        header, rows = read_patient_rows(connection, "../../../data/eicu", table, ["141168", "141178"])
+"""
+
+import argparse
+import csv
+import io
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mimiciii"))
+
+from extractor_utils import get_column_indices, iterate_records, read_csv_header
+
+DATA_DIR = "../../../data/eicu"
+
+# eICU tables, each with a column of the patientunitstayid (ID_COLUMN)
+TABLES = ["patient.csv", "diagnosis.csv", "apacheApsVar.csv", "lab.csv", "microLab.csv", "pastHistory.csv",
+          "medication.csv"]
+ID_COLUMN = "patientunitstayid"
+
+# Number of ids looked up per query
+LOOKUP_BATCH = 500
+
+
+def get_index_location(data_dir):
+    return data_dir + "/index.sqlite"
+
+
+def get_id_column_index(path):
+    """
+    Returns the index of the patientunitstayid column of a table (raises a ValueError if it has none)
+    """
+    id_column, = get_column_indices(read_csv_header(path), [ID_COLUMN], path)
+    return id_column
+
+
+def iterate_runs(path, id_column):
+    """
+    Yields (patientunitstayid, start byte, end byte) of every run of consecutive records of the same patient, given
+    the index of the patientunitstayid column (see get_id_column_index)
+    """
+    run_id = None
+    run_start = run_end = None
+    with open(path, 'rb') as csv_file:
+        for start, end, record in iterate_records(csv_file, len(csv_file.readline())):
+            # The id columns (and the columns before them) are integers, so they are never quoted
+            record_id = record.split(b',', id_column + 1)[id_column].strip().decode('utf-8')
+            if record_id != run_id:
+                if run_id is not None:
+                    yield run_id, run_start, run_end
+                run_id, run_start = record_id, start
+            run_end = end
+    if run_id is not None:
+        yield run_id, run_start, run_end
+
+
+def get_table_stamp(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def index_table(connection, data_dir, table, id_column, batch_size=100000):
+    """
+    (Re-)indexes the runs of a table with a single pass over it
+    """
+    path = data_dir + "/" + table
+    print("Indexing " + table)
+    connection.execute("DELETE FROM runs WHERE table_name = ?", (table,))
+    connection.execute("DELETE FROM tables WHERE table_name = ?", (table,))
+    batch = []
+    num_runs = 0
+    for run_id, start, end in iterate_runs(path, id_column):
+        batch.append((table, run_id, start, end))
+        if len(batch) == batch_size:
+            connection.executemany("INSERT INTO runs VALUES (?, ?, ?, ?)", batch)
+            num_runs += len(batch)
+            print("     Indexed {} runs".format(num_runs))
+            batch = []
+    connection.executemany("INSERT INTO runs VALUES (?, ?, ?, ?)", batch)
+    size, mtime = get_table_stamp(path)
+    connection.execute("INSERT INTO tables VALUES (?, ?, ?, ?)", (table, id_column, size, mtime))
+    connection.commit()
+
+
+def open_index(data_dir=DATA_DIR, index_location=None, tables=TABLES):
+    """
+    Opens the index of the tables in data_dir (by default data_dir/index.sqlite), first indexing every table that
+    is not indexed yet or changed since it was indexed. Tables that do not exist are skipped, and so are compressed
+    tables (eg. lab.csv.gz), since their rows cannot be seeked to.
+    """
+    connection = sqlite3.connect(get_index_location(data_dir) if index_location is None else index_location)
+    connection.execute("CREATE TABLE IF NOT EXISTS tables "
+                       "(table_name TEXT PRIMARY KEY, id_column INTEGER, size INTEGER, mtime INTEGER)")
+    connection.execute("CREATE TABLE IF NOT EXISTS runs "
+                       "(table_name TEXT, id TEXT, start_byte INTEGER, end_byte INTEGER)")
+    connection.execute("CREATE INDEX IF NOT EXISTS runs_by_id ON runs (table_name, id)")
+    for table in tables:
+        path = data_dir + "/" + table
+        if not os.path.exists(path):
+            continue
+        # A table whose columns move is re-indexed too
+        id_column = get_id_column_index(path)
+        size, mtime = get_table_stamp(path)
+        stamp = connection.execute("SELECT id_column, size, mtime FROM tables WHERE table_name = ?",
+                                   (table,)).fetchone()
+        if stamp != (id_column, size, mtime):
+            index_table(connection, data_dir, table, id_column)
+    return connection
+
+
+def get_runs(connection, table, ids):
+    """
+    Returns the (start byte, end byte) runs of the rows of the given patients in a table, in file order
+    """
+    ids = sorted(set(ids))
+    runs = []
+    for i in range(0, len(ids), LOOKUP_BATCH):
+        batch = ids[i:i + LOOKUP_BATCH]
+        query = "SELECT start_byte, end_byte FROM runs WHERE table_name = ? AND id IN ({})".format(
+            ",".join("?" * len(batch)))
+        runs.extend(connection.execute(query, [table] + batch))
+    return sorted(runs)
+
+
+def read_patient_rows(connection, data_dir, table, ids):
+    """
+    Returns (header, rows) of a table, where rows are the parsed rows of the given patients (patientunitstayid
+    strings) in file order
+    """
+    path = data_dir + "/" + table
+    header = read_csv_header(path)
+
+    rows = []
+    with open(path, 'rb') as csv_file:
+        for start, end in get_runs(connection, table, ids):
+            csv_file.seek(start)
+            rows.extend(csv.reader(io.StringIO(csv_file.read(end - start).decode('utf-8'), newline=''),
+                                   delimiter=','))
+    return header, rows
+
+
+########################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_dir", nargs="?", default=DATA_DIR)
+    parser.add_argument("index_location", nargs="?", default=None,
+                        help="SQLite file of the index (data_dir/index.sqlite by default)")
+    args = parser.parse_args()
+    open_index(args.data_dir, args.index_location).close()
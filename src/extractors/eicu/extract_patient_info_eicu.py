@@ -1,65 +1,128 @@
 """
 Extracts all data from the eICU dataset regarding a particular patient-stay.
 
-For example, given a patient ID, we will grep for all journal lines with that ID in all relevant patient files.
+For example, given a patient ID, we will write all journal lines with that ID in all relevant patient files.
+The lines are looked up in the index of eicu_index.py (built on the first run), so that no file is scanned. Only
+compressed tables (eg. lab.csv.gz), which cannot be indexed, are scanned.
+
+Given a file of patient IDs (--ids-file, one per line) instead, every file is scanned exactly once for all of the
+patients, so the time taken does not depend on the number of patients. The output is then either one file per
+patient (when the output path contains "{}", eg. patient{}.csv) or one combined file whose rows are grouped by
+patient within each file.
 """
 
+import argparse
 import csv
+import os
 import sys
-import subprocess
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mimiciii"))
 
-def scan_file_for_relevant_lines(file, id):
-    retarr = [[file[0]]]
-    with open("../../../data/eicu/" + file[0], 'r') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        for row in csv_reader:
-            # Write just the first row
-            retarr.append(row)
-            break
+from eicu_index import DATA_DIR, ID_COLUMN, TABLES, open_index, read_patient_rows
+from extractor_utils import get_column_indices, get_compression, get_input_location, iterate_columns, read_csv_header
 
-    try:
-        if file[1] == 1:
-            output = subprocess.check_output(["grep", "," + id + ",", "../data/eicu/" + file[0]])
-        else:
-            output = subprocess.check_output(["grep", "^" + id + ",", "../data/eicu/" + file[0]])
-        arr = output.decode("utf-8").split('\n')
-        for a in arr:
-            retarr.append([a.strip()])
-        return retarr
-    except subprocess.CalledProcessError:
+
+def scan_file_for_relevant_lines(connection, data_dir, file, id):
+    path = get_input_location(data_dir + "/" + file)
+    if not os.path.exists(path):
+        return []
+    if get_compression(path) is not None:
+        # Compressed tables cannot be indexed (see open_index), so they are scanned instead
+        header, id_to_rows = scan_file_for_patients(data_dir, file, {id})
+        rows = [list(row) for row in id_to_rows.get(id, [])]
+    else:
+        header, rows = read_patient_rows(connection, data_dir, file, [id])
+    if not rows:
         return []
+    return [[file], header] + rows
 
 
-########################################################################
+def scan_file_for_patients(data_dir, file, ids):
+    """
+    Scans a file once and returns (header, map of patient ID -> rows of that patient) for the given set of IDs. The
+    patient ID is read from the patientunitstayid column (ID_COLUMN) of the header. Quoted values may contain
+    line breaks, like with the index.
+    """
+    path = data_dir + "/" + file
+    header = read_csv_header(path)
+    id_column, = get_column_indices(header, [ID_COLUMN], path)
+    id_to_rows = {}
+    for row in iterate_columns(path, header, file, newlines_in_values=True):
+        if row[id_column] in ids:
+            id_to_rows.setdefault(row[id_column], []).append(row)
+    return header, id_to_rows
+
+
+def load_patient_ids(ids_file):
+    """
+    Loads the patient IDs of a file with one ID per line, in order and without duplicates
+    """
+    with open(ids_file, 'r') as f:
+        return list(dict.fromkeys(line.strip() for line in f if line.strip()))
 
 
-patient_id = sys.argv[1]
-output_path = sys.argv[2]
-
-files = [
-    ["patient.csv", 0],
-    ["diagnosis.csv", 1],
-    ["apacheApsVar.csv", 1],
-    ["lab.csv", 1],
-    ["microLab.csv", 1],
-    ["pastHistory.csv", 1],
-    ["medication.csv", 1]
-]
-
-output = []
-for file in files:
-    print("Looking through file " + file[0])
-    output.extend(scan_file_for_relevant_lines(file, patient_id))
-    output.append([])
-    output.append([])
-
-with open(output_path, 'w') as csv_file:
-    csv_writer = csv.writer(csv_file, delimiter=',')
-    for row in output:
-        if len(row) == 1:
-            for r in csv.reader(row[0].split("\n"), delimiter=',', quotechar="\""):
-                csv_writer.writerow(r)
+def extract_patients(data_dir, patient_ids, output_path):
+    """
+    Writes the rows of every patient in every file, scanning each file once (see the module docstring)
+    """
+    ids = set(patient_ids)
+    table_outputs = []
+    for file in TABLES:
+        print("Looking through file " + file)
+        if os.path.exists(get_input_location(data_dir + "/" + file)):
+            table_outputs.append((file,) + scan_file_for_patients(data_dir, file, ids))
         else:
+            table_outputs.append((file, [], {}))
+
+    if "{}" in output_path:
+        for patient_id in patient_ids:
+            output = []
+            for file, header, id_to_rows in table_outputs:
+                if patient_id in id_to_rows:
+                    output.extend([[file], header] + id_to_rows[patient_id])
+                output.append([])
+                output.append([])
+            write_output(output_path.format(patient_id), output)
+    else:
+        output = []
+        for file, header, id_to_rows in table_outputs:
+            rows = [row for patient_id in patient_ids for row in id_to_rows.get(patient_id, [])]
+            if rows:
+                output.extend([[file], header] + rows)
+            output.append([])
+            output.append([])
+        write_output(output_path, output)
+
+
+def write_output(output_path, output):
+    with open(output_path, 'w') as csv_file:
+        csv_writer = csv.writer(csv_file, delimiter=',')
+        for row in output:
             csv_writer.writerow(row)
 
+
+########################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("patient_id", nargs="?", default=None)
+    parser.add_argument("output_path", help='may contain "{}" (eg. patient{}.csv) with --ids-file')
+    parser.add_argument("--ids-file", default=None, help="file of patient IDs (one per line) to extract at once")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--index", default=None, help="SQLite file of the index (data_dir/index.sqlite by default)")
+    args = parser.parse_args()
+    if (args.patient_id is None) == (args.ids_file is None):
+        parser.error("either a patient_id or --ids-file is required")
+
+    if args.ids_file is not None:
+        extract_patients(args.data_dir, load_patient_ids(args.ids_file), args.output_path)
+    else:
+        connection = open_index(args.data_dir, args.index)
+        output = []
+        for file in TABLES:
+            print("Looking through file " + file)
+            output.extend(scan_file_for_relevant_lines(connection, args.data_dir, file, args.patient_id))
+            output.append([])
+            output.append([])
+        connection.close()
+        write_output(args.output_path, output)
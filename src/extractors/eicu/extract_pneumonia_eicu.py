@@ -2,59 +2,112 @@
 Scans the eICU datasets and subsets the datasets for only those patients admitted into ICU with pneumonia
 
 Note: This script was not actually used because the MIMIC-III dataset was selected over the eICU dataset
+
+The cohort is loaded once, then the tables are split into byte ranges that are subset by a pool of worker processes.
+Each worker streams its range and only looks at the patientunitstayid of each row, so that the rows are copied as
+they are instead of being parsed and written again. A compressed table (eg. lab.csv.gz) cannot be split, so it is
+streamed by a single worker.
 """
 
+import argparse
 import csv
+from multiprocessing import Pool
+import os
+import shutil
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mimiciii"))
+
+from eicu_index import DATA_DIR
+from extractor_utils import get_column_indices, get_record_byte_ranges, iterate_columns, iterate_record_range, \
+    open_binary, read_csv_header
 
 
-def get_patients_with_pneumonia():
+def get_patients_with_pneumonia(data_dir=DATA_DIR):
     patients = []
-    with open("../../../data/eicu/patient.csv", 'r') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        with open("../../../data/eicu/pneumonia.patient.csv", 'w') as csv_file:
-            csv_writer = csv.writer(csv_file, delimiter=',')
-            i = 0
-            for row in csv_reader:
-                if i == 0:
-                    csv_writer.writerow(row)
-                elif "pneumonia" in row[7].lower():
-                    patients.append(row[0])
-                    csv_writer.writerow(row)
-                i += 1
+    headers = read_csv_header(data_dir + "/patient.csv")
+    id_index, diagnosis_index = get_column_indices(headers, ["patientunitstayid", "apacheadmissiondx"],
+                                                   data_dir + "/patient.csv")
+    with open(data_dir + "/pneumonia.patient.csv", 'w') as w_file:
+        csv_writer = csv.writer(w_file, delimiter=',')
+        csv_writer.writerow(headers)
+        for row in iterate_columns(data_dir + "/patient.csv", headers, "Patients"):
+            if "pneumonia" in row[diagnosis_index].lower():
+                patients.append(row[id_index])
+                csv_writer.writerow(row)
     print("Found " + str(len(patients)) + " with pneumonia")
     return patients
 
 
-def produce_file_subset(file, patient_ids):
-    with open("../../../data/eicu/" + file, 'r') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        with open("../../../data/eicu/pneumonia." + file, 'w') as csv_file:
-            csv_writer = csv.writer(csv_file, delimiter=',')
-            i = 0
-            for row in csv_reader:
-                if i == 0:
-                    csv_writer.writerow(row)
-                elif row[1] in patient_ids:
-                    csv_writer.writerow(row)
-                if i % 100000 == 0:
-                    print("     Processed: " + str(i))
-                i += 1
+def init_subset_worker(data_dir, patient_ids):
+    global subset_worker_state
+    subset_worker_state = (data_dir, {patient_id.encode('utf-8') for patient_id in patient_ids})
+
+
+def produce_file_subset(shard):
+    """
+    Writes the rows of the cohort of the (file, start, end) byte range of a table to the output path of the shard
+    (in a worker process, see init_subset_worker). The shard also has the index of the patientunitstayid column of
+    the table.
+
+    Returns (number of rows read, number of rows written)
+    """
+    data_dir, patient_ids = subset_worker_state
+    file, start, end, output_path, id_index = shard
+    rows_in = rows_out = 0
+    with open(output_path, 'wb', buffering=1 << 20) as w_file:
+        for _, _, record in iterate_record_range(data_dir + "/" + file, start, end):
+            rows_in += 1
+            # The id columns come before any text column, so splitting on the first commas finds them
+            if record.split(b',', id_index + 1)[id_index].strip(b'"') in patient_ids:
+                w_file.write(record)
+                rows_out += 1
+    return rows_in, rows_out
+
+
+def produce_file_subsets(data_dir, files, patient_ids, jobs):
+    """
+    Subsets every table into pneumonia.<file>, with the tables split into byte ranges of whole rows (see
+    get_record_byte_ranges) that are subset by a pool of jobs processes. Prints the number of rows read and written
+    of each table.
+    """
+    with Pool(jobs, initializer=init_subset_worker, initargs=(data_dir, patient_ids)) as pool:
+        shards = []
+        for file in files:
+            byte_ranges = get_record_byte_ranges(data_dir + "/" + file, jobs)
+            id_index, = get_column_indices(read_csv_header(data_dir + "/" + file), ["patientunitstayid"],
+                                           data_dir + "/" + file)
+            shards.extend((file, start, end, "{}/pneumonia.{}.part{}".format(data_dir, file, i), id_index)
+                          for i, (start, end) in enumerate(byte_ranges))
+        results = pool.map(produce_file_subset, shards)
+
+    for file in files:
+        with open_binary(data_dir + "/" + file) as csv_file:
+            header = csv_file.readline()
+        rows_in = rows_out = 0
+        with open(data_dir + "/pneumonia." + file, 'wb') as w_file:
+            w_file.write(header)
+            for (shard_file, start, end, output_path, _), (shard_rows_in, shard_rows_out) in zip(shards, results):
+                if shard_file != file:
+                    continue
+                with open(output_path, 'rb') as part_file:
+                    shutil.copyfileobj(part_file, w_file, 1 << 20)
+                os.remove(output_path)
+                rows_in += shard_rows_in
+                rows_out += shard_rows_out
+        print("{}: {} rows in, {} rows out".format(file, rows_in, rows_out))
 
 
 ########################################################################
 
-files = [
-    # "diagnosis.csv",
-    # "apacheApsVar.csv",
-    # "lab.csv",
-    # "microLab.csv",
-    # "pastHistory.csv",
-    # "medication.csv"
-    "infusionDrug.csv"
-]
-
-patient_ids = set(get_patients_with_pneumonia())
-for file in files:
-    print("Processing file " + file)
-    produce_file_subset(file, patient_ids)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="*", default=["infusionDrug.csv"],
+                        help="tables to subset (eg. diagnosis.csv lab.csv medication.csv)")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--jobs", type=int, default=4, help="number of processes subsetting the tables")
+    args = parser.parse_args()
 
+    patient_ids = set(get_patients_with_pneumonia(args.data_dir))
+    print("Processing files " + ", ".join(args.files))
+    produce_file_subsets(args.data_dir, args.files, patient_ids, args.jobs)
@@ -1,38 +1,145 @@
 """
-Join lab eICU dataset with the patient.csv eICU dataset based on a specific lab measurement
+Join lab eICU dataset with the patient.csv eICU dataset based on specific lab measurements
+
+Any number of labs are joined with a single pass over the lab file, each as a new column of the patient file. A lab
+is given as its labname, optionally followed by how its results of a patient are aggregated (see AGGREGATIONS), eg.
+"sodium:mean". By default, the last result of the patient in the lab file is kept. Both files are read by column
+name (see LAB_COLUMNS), so their columns may come in any order.
+
+Example:
+    python join_datasets_by_guid.py patient.csv lab.csv sodium potassium:max "BUN:mean" -- -basos:count
 """
 
+import argparse
 import csv
-
+import os
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mimiciii"))
 
-def join(file2, file1, labname):
-    with open("../../../data/eicu/" + file1, 'r') as csv_file1:
-        csv_reader1 = csv.reader(csv_file1, delimiter=',')
+from extractor_utils import get_column_indices, iterate_columns, read_csv_columns, read_csv_header
 
-        id_to_lab_result = {}
-        id_col1 = 1
-        for row in csv_reader1:
-            if row[4] == labname:
-                id_to_lab_result[row[id_col1]] = row[5]
+DATA_DIR = "../../../data/eicu"
 
-        with open("../../../data/eicu/" + file2, 'r') as csv_file2:
-            csv_reader2 = csv.reader(csv_file2, delimiter=',')
-            with open("../../../data/eicu/" + file1 + "." + file2, 'w') as csv_file:
-                csv_writer = csv.writer(csv_file, delimiter=',')
-                for row in csv_reader2:
-                    id = row[0]
-                    row.append(id_to_lab_result[id] if id in id_to_lab_result else "")
-                    csv_writer.writerow(row)
+# Columns of the patientunitstayid, labname, and labresult in the lab file (a ValueError is raised if any is missing)
+LAB_COLUMNS = ["patientunitstayid", "labname", "labresult"]
+ID_COLUMN = "patientunitstayid"
 
+# Aggregations of the results of a patient: "first" and "last" are in the order of the lab file, and "min", "max",
+# and "mean" only count the numeric results
+AGGREGATIONS = ["last", "first", "min", "max", "mean", "count"]
+DEFAULT_AGGREGATION = "last"
 
-########################################################################
+
+def parse_lab(value):
+    """
+    Returns (labname, aggregation) of a lab argument, eg. "sodium:mean" or "sodium"
+    """
+    labname, separator, aggregation = value.rpartition(":")
+    if not separator or aggregation not in AGGREGATIONS:
+        return value, DEFAULT_AGGREGATION
+    return labname, aggregation
+
+
+def get_lab_column(labname, aggregation):
+    return labname if aggregation == DEFAULT_AGGREGATION else labname + "-" + aggregation
+
+
+def get_numeric(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
 
 
-data1 = sys.argv[1] # Patient.csv dataset (each row is a unique patient GUID in file)
-data2 = sys.argv[2] # Lab file
-labname = sys.argv[3]
+def aggregate_labs(lab_path, id_to_index, labs):
+    """
+    Aggregates the results of every (labname, aggregation) of labs for the patients of id_to_index (patientunitstayid
+    -> index of the patient) with one pass over the lab file. Returns a list of the values of every patient (in
+    index order) for each lab.
+    """
+    num_patients = len(id_to_index)
+    labname_to_labs = {}
+    for i, (labname, aggregation) in enumerate(labs):
+        labname_to_labs.setdefault(labname, []).append((i, aggregation))
+    # One flat list per lab, indexed by patient, instead of a dict per lab
+    counts = [[0] * num_patients for _ in labs]
+    results = [[None] * num_patients for _ in labs]
+
+    for patient_id, labname, value in iterate_columns(lab_path, LAB_COLUMNS, "Labs"):
+        lab_indices = labname_to_labs.get(labname)
+        if lab_indices is None:
+            continue
+        index = id_to_index.get(patient_id)
+        if index is None:
+            continue
+        for i, aggregation in lab_indices:
+            if aggregation == "last":
+                results[i][index] = value
+            elif aggregation == "first":
+                if counts[i][index] == 0:
+                    results[i][index] = value
+            elif aggregation != "count":
+                number = get_numeric(value)
+                if number is None:
+                    continue
+                result = results[i][index]
+                if aggregation == "mean":
+                    results[i][index] = number if result is None else result + number
+                elif result is None or (number < result[0] if aggregation == "min" else number > result[0]):
+                    results[i][index] = (number, value)
+            counts[i][index] += 1
+
+    columns = []
+    for (labname, aggregation), lab_counts, lab_results in zip(labs, counts, results):
+        if aggregation == "count":
+            columns.append([str(count) for count in lab_counts])
+        elif aggregation == "mean":
+            columns.append(["" if result is None else str(result / count)
+                            for result, count in zip(lab_results, lab_counts)])
+        elif aggregation in ("min", "max"):
+            columns.append(["" if result is None else result[1] for result in lab_results])
+        else:
+            columns.append(["" if result is None else result for result in lab_results])
+    return columns
+
+
+def join(patient_file, lab_file, labs, data_dir=DATA_DIR, output_path=None):
+    """
+    Writes the patient file with one more column per (labname, aggregation) of labs (see aggregate_labs), by default
+    to <lab file>.<patient file>
+    """
+    patient_path = data_dir + "/" + patient_file
+    id_to_index = {}
+    for patient_ids, in read_csv_columns(patient_path, [ID_COLUMN]):
+        for patient_id in patient_ids:
+            id_to_index.setdefault(patient_id, len(id_to_index))
+
+    columns = aggregate_labs(data_dir + "/" + lab_file, id_to_index, labs)
+
+    if output_path is None:
+        output_path = data_dir + "/" + lab_file + "." + patient_file
+    header = read_csv_header(patient_path)
+    id_column, = get_column_indices(header, [ID_COLUMN], patient_path)
+    with open(output_path, 'w') as w_file:
+        csv_writer = csv.writer(w_file, delimiter=',')
+        csv_writer.writerow(header + [get_lab_column(labname, aggregation) for labname, aggregation in labs])
+        for row in iterate_columns(patient_path, header, patient_file):
+            index = id_to_index[row[id_column]]
+            csv_writer.writerow(list(row) + [column[index] for column in columns])
+
+
+########################################################################
 
-join(data1, data2, labname)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("patient_file", help="patient.csv dataset (each row is a unique patient GUID in file)")
+    parser.add_argument("lab_file")
+    parser.add_argument("labs", nargs="+", type=parse_lab,
+                        help="labnames to join, each optionally followed by one of :{} (labnames starting with "
+                             "a dash go after --)".format(", :".join(AGGREGATIONS)))
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--output", default=None, help="output file (<data dir>/<lab file>.<patient file> by default)")
+    args = parser.parse_args()
 
+    join(args.patient_file, args.lab_file, args.labs, args.data_dir, args.output)
@@ -4,27 +4,30 @@ Add labels to the DIAGNOSES_ICD.csv by using info from D_ICD_DIAGNOSES.csv in th
 
 import csv
 
+from extractor_utils import open_text, read_csv_columns
+
 
 def get_icd_code_mapping():
     map = {}
-    with open("../../../data/mimiciii/D_ICD_DIAGNOSES.csv", 'r') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        for row in csv_reader:
-            map[row[1]] = row[2]
+    for codes, titles in read_csv_columns("../../../data/mimiciii/D_ICD_DIAGNOSES.csv", ["ICD9_CODE", "SHORT_TITLE"]):
+        map.update(zip(codes, titles))
     return map
 
 
 def add_labels():
     mapping = get_icd_code_mapping()
-    with open("../../../data/mimiciii/DIAGNOSES_ICD.csv", 'r') as csv_file:
-        with open("../../../data/mimiciii/DIAGNOSES_ICD_LABELED.csv", 'w') as w_file:
-            csv_writer = csv.writer(w_file, delimiter=',')
-            csv_reader = csv.reader(csv_file, delimiter=',')
-            for row in csv_reader:
-                new_row = []
-                new_row.extend(row)
-                if row[4] in mapping:
-                    new_row.append(mapping[row[4]])
+    path = "../../../data/mimiciii/DIAGNOSES_ICD.csv"
+    with open_text(path) as csv_file:
+        header = next(csv.reader(csv_file, delimiter=','))
+    code_index = header.index("ICD9_CODE")
+    with open("../../../data/mimiciii/DIAGNOSES_ICD_LABELED.csv", 'w') as w_file:
+        csv_writer = csv.writer(w_file, delimiter=',')
+        csv_writer.writerow(header + ["SHORT_TITLE"])
+        for chunk in read_csv_columns(path, header):
+            for row in zip(*chunk):
+                new_row = list(row)
+                if row[code_index] in mapping:
+                    new_row.append(mapping[row[code_index]])
                 csv_writer.writerow(new_row)
 
 ########################################################################
@@ -7,36 +7,22 @@ import csv
 from datetime import datetime, timedelta
 import sys
 
+from extractor_utils import read_csv_columns
+
+ADMISSION_COLUMNS = ["HADM_ID", "ADMITTIME", "DISCHTIME", "age", "gender", "INSURANCE", "LANGUAGE", "RELIGION",
+                     "MARITAL_STATUS", "ETHNICITY", "HOSPITAL_EXPIRE_FLAG"]
+
 
 def produce_output(project_dir):
-    with open(project_dir + "/admissions.csv", 'r') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        with open(project_dir + "/admissions.derived.csv", 'w') as w_file:
-            csv_writer = csv.writer(w_file, delimiter=',')
-            csv_writer.writerow(["hadmid", "admittime", "age", "gender", "insurance", "language", "religion", "marital_status", "ethnicity", "status", "los"]);
-            colname_to_col = {}
-            i = 0
-            for row in csv_reader:
-                if i == 0:
-                    j = 0
-                    while j < len(row):
-                        colname_to_col[row[j]] = j
-                        j += 1
-                elif i > 0:
-                    hadmid = row[colname_to_col["HADM_ID"]]
-                    admittime = datetime.strptime(row[colname_to_col["ADMITTIME"]], '%Y-%m-%dT%H:%M:%S')
-                    dischtime = datetime.strptime(row[colname_to_col["DISCHTIME"]], '%Y-%m-%dT%H:%M:%S')
-                    age = row[colname_to_col["age"]]
-                    gender = row[colname_to_col["gender"]]
-                    insurance = row[colname_to_col["INSURANCE"]]
-                    language = row[colname_to_col["LANGUAGE"]]
-                    religion = row[colname_to_col["RELIGION"]]
-                    marital_status = row[colname_to_col["MARITAL_STATUS"]]
-                    ethnicity = row[colname_to_col["ETHNICITY"]]
-                    status = row[colname_to_col["HOSPITAL_EXPIRE_FLAG"]]
-                    los = (dischtime - admittime) / timedelta(days=1)
-                    csv_writer.writerow([hadmid, row[colname_to_col["ADMITTIME"]], age, gender, insurance, language, religion, marital_status, ethnicity, status, los, row[colname_to_col["DISCHTIME"]]])
-                i += 1
+    with open(project_dir + "/admissions.derived.csv", 'w') as w_file:
+        csv_writer = csv.writer(w_file, delimiter=',')
+        csv_writer.writerow(["hadmid", "admittime", "age", "gender", "insurance", "language", "religion", "marital_status", "ethnicity", "status", "los"]);
+        for chunk in read_csv_columns(project_dir + "/admissions.csv", ADMISSION_COLUMNS):
+            for hadmid, admittime, dischtime, age, gender, insurance, language, religion, marital_status, ethnicity, \
+                    status in zip(*chunk):
+                los = (datetime.strptime(dischtime, '%Y-%m-%dT%H:%M:%S') -
+                       datetime.strptime(admittime, '%Y-%m-%dT%H:%M:%S')) / timedelta(days=1)
+                csv_writer.writerow([hadmid, admittime, age, gender, insurance, language, religion, marital_status, ethnicity, status, los, dischtime])
 
 
 ########################################################################
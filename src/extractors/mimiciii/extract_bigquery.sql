@@ -1,3 +1,5 @@
+-- The same queries run locally on the raw MIMIC-III CSV files with extract_sqlite.py
+
 -- Get admissions pneumonia subset
 select c.*,
 case when round(DATETIME_DIFF(c.admittime, p.dob, DAY) / 365.242, 4) > 89 then 91.4 else round(DATETIME_DIFF(c.admittime, p.dob, DAY) / 365.242, 4) end as age,
@@ -40,6 +42,7 @@ ON adm.HADM_ID = c.HADM_ID
 AND adm.HAS_CHARTEVENTS_DATA = 1
 WHERE c.ITEMID = e.ITEMID
 AND c.ERROR != 1
+-- Same ITEMIDs as CHART_ITEMID_TO_CHART in extractor_utils.py (extend both along with --chart-mapping)
 AND c.ITEMID IN (223762, 220179, 220180, 223834, 220277, 220045, 220210, 211, 8441, 455, 618, 646, 470, 677)
 ORDER BY c.HADM_ID, c.CHARTTIME, e.LABEL
 
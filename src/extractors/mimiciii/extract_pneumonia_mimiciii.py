@@ -3,85 +3,157 @@ Scans the MIMIC-III datasets and subsets the datasets for only those patients ad
 
 Note: This script was not used in the end as the filtered was instead done through a SQL query
 
+The cohort (and the lab item labels) are loaded once, then the tables are split into byte ranges that are subset by
+a pool of worker processes. Each worker streams its range and only looks at the HADM_ID of each row, so that the
+rows are copied as they are instead of being parsed and written again. A compressed table (eg. LABEVENTS.csv.gz)
+cannot be split, so it is streamed by a single worker.
 """
 
+import argparse
 import csv
+import io
+from multiprocessing import Pool
+import os
+import shutil
 
+from extractor_utils import get_column_indices, get_record_byte_ranges, iterate_columns, iterate_record_range, \
+    open_binary, read_csv_columns, read_csv_header
 
-def get_lab_item_mapping():
+DATA_DIR = "../../../data/mimiciii"
+
+
+def get_lab_item_mapping(data_dir=DATA_DIR):
     map = {}
-    with open("../../../data/mimiciii/D_LABITEMS.csv", 'r') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        for row in csv_reader:
-            map[row[1]] = row[2]
+    for itemids, labels in read_csv_columns(data_dir + "/D_LABITEMS.csv", ["ITEMID", "LABEL"]):
+        map.update(zip(itemids, labels))
     return map
 
 
-def get_icd_codes():
+def get_icd_codes(data_dir=DATA_DIR):
     pneumonia_codes = []
-    with open("../../../data/mimiciii/D_ICD_DIAGNOSES.csv", 'r') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        for row in csv_reader:
-            if "pneumonia" in row[3].lower():
-                pneumonia_codes.append(row[1])
+    for codes, titles in read_csv_columns(data_dir + "/D_ICD_DIAGNOSES.csv", ["ICD9_CODE", "LONG_TITLE"]):
+        pneumonia_codes.extend(code for code, title in zip(codes, titles) if "pneumonia" in title.lower())
     print("Found " + str(len(pneumonia_codes)) + " codes")
     return pneumonia_codes
 
 
-def get_patients_with_pneumonia():
+def get_patients_with_pneumonia(data_dir=DATA_DIR):
     hamid = set()
-    pneumonia_codes = set(get_icd_codes())
-    with open("../../../data/mimiciii/DIAGNOSES_ICD.csv", 'r') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        for row in csv_reader:
-            if row[4] in pneumonia_codes:
-                hamid.add(row[2])
-
-    with open("../../../data/mimiciii/ADMISSIONS.csv", 'r') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        with open("../data/mimiciii/pneumonia.ADMISSIONS.csv", 'w') as csv_file:
-            csv_writer = csv.writer(csv_file, delimiter=',')
-            i = 0
-            for row in csv_reader:
-                if i == 0:
-                    csv_writer.writerow(row)
-                elif row[2] in hamid:
-                    csv_writer.writerow(row)
-                i += 1
+    pneumonia_codes = set(get_icd_codes(data_dir))
+    for hadmid, code in iterate_columns(data_dir + "/DIAGNOSES_ICD.csv", ["HADM_ID", "ICD9_CODE"], "Diagnoses"):
+        if code in pneumonia_codes:
+            hamid.add(hadmid)
+
+    headers = read_csv_header(data_dir + "/ADMISSIONS.csv")
+    hadmid_index = headers.index("HADM_ID")
+    with open(data_dir + "/pneumonia.ADMISSIONS.csv", 'w') as w_file:
+        csv_writer = csv.writer(w_file, delimiter=',')
+        csv_writer.writerow(headers)
+        for row in iterate_columns(data_dir + "/ADMISSIONS.csv", headers, "Admissions"):
+            if row[hadmid_index] in hamid:
+                csv_writer.writerow(row)
     return hamid
 
 
-def produce_file_subset(file, patient_ids):
-    mapping = get_lab_item_mapping()
-
-    with open("../../../data/mimiciii/" + file, 'r') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        with open("../../../data/mimiciii/pneumonia." + file, 'w') as csv_file:
-            csv_writer = csv.writer(csv_file, delimiter=',')
-            i = 0
-            for row in csv_reader:
-                if i == 0:
-                    csv_writer.writerow(row)
-                elif row[2] in patient_ids:
-                    new_row = []
-                    new_row.extend(row)
-                    if file == "LABEVENTS.csv":
-                        new_row.append(mapping[row[3]])
-                    csv_writer.writerow(new_row)
-                if i % 100000 == 0:
-                    print("     Processed: " + str(i))
-                i += 1
+def get_csv_suffix(values):
+    """
+    Returns the values as the CSV columns (with a leading comma) to append to a row, as bytes
+    """
+    output = io.StringIO()
+    csv.writer(output, delimiter=',', lineterminator='').writerow([""] + values)
+    return output.getvalue().encode('utf-8')
+
+
+def init_subset_worker(data_dir, hadmids, lab_item_mapping):
+    global subset_worker_state
+    subset_worker_state = (
+        data_dir,
+        {hadmid.encode('utf-8') for hadmid in hadmids},
+        {itemid.encode('utf-8'): get_csv_suffix([label]) for itemid, label in lab_item_mapping.items()}
+    )
+
+
+def produce_file_subset(shard):
+    """
+    Writes the rows of the cohort of the (file, start, end) byte range of a table to the output path of the shard
+    (in a worker process, see init_subset_worker). The label of the lab item is appended to the rows of
+    LABEVENTS.csv. The shard also has the indices of the HADM_ID and ITEMID columns of the table (see
+    get_id_column_indices).
+
+    Returns (number of rows read, number of rows written)
+    """
+    data_dir, hadmids, lab_item_to_suffix = subset_worker_state
+    file, start, end, output_path, hadmid_index, itemid_index = shard
+    rows_in = rows_out = 0
+    with open(output_path, 'wb', buffering=1 << 20) as w_file:
+        for _, _, record in iterate_record_range(data_dir + "/" + file, start, end):
+            rows_in += 1
+            # The id columns come before any text column, so splitting on the first commas finds them
+            columns = record.split(b',', max(hadmid_index, itemid_index) + 1)
+            if columns[hadmid_index].strip(b'"') in hadmids:
+                if file == "LABEVENTS.csv":
+                    suffix = lab_item_to_suffix.get(columns[itemid_index].strip(b'"'), b",")
+                    row = record.rstrip(b"\r\n")
+                    record = row + suffix + record[len(row):]
+                w_file.write(record)
+                rows_out += 1
+    return rows_in, rows_out
+
+
+def get_id_column_indices(path):
+    """
+    Returns the indices of the HADM_ID and ITEMID (-1 when it has none) columns of a table
+    """
+    headers = read_csv_header(path)
+    hadmid_index, = get_column_indices(headers, ["HADM_ID"], path)
+    return hadmid_index, headers.index("ITEMID") if "ITEMID" in headers else -1
+
+
+def produce_file_subsets(data_dir, files, hadmids, jobs):
+    """
+    Subsets every table into pneumonia.<file>, with the tables split into byte ranges of whole rows (see
+    get_record_byte_ranges) that are subset by a pool of jobs processes. Prints the number of rows read and written
+    of each table.
+    """
+    lab_item_mapping = get_lab_item_mapping(data_dir) if "LABEVENTS.csv" in files else {}
+    with Pool(jobs, initializer=init_subset_worker, initargs=(data_dir, hadmids, lab_item_mapping)) as pool:
+        shards = []
+        for file in files:
+            byte_ranges = get_record_byte_ranges(data_dir + "/" + file, jobs)
+            id_column_indices = get_id_column_indices(data_dir + "/" + file)
+            shards.extend((file, start, end, "{}/pneumonia.{}.part{}".format(data_dir, file, i)) + id_column_indices
+                          for i, (start, end) in enumerate(byte_ranges))
+        results = pool.map(produce_file_subset, shards)
+
+    for file in files:
+        with open_binary(data_dir + "/" + file) as csv_file:
+            header = csv_file.readline()
+        if file == "LABEVENTS.csv":
+            row = header.rstrip(b"\r\n")
+            header = row + get_csv_suffix(["LABEL"]) + header[len(row):]
+        rows_in = rows_out = 0
+        with open(data_dir + "/pneumonia." + file, 'wb') as w_file:
+            w_file.write(header)
+            for (shard_file, start, end, output_path, _, _), (shard_rows_in, shard_rows_out) in zip(shards, results):
+                if shard_file != file:
+                    continue
+                with open(output_path, 'rb') as part_file:
+                    shutil.copyfileobj(part_file, w_file, 1 << 20)
+                os.remove(output_path)
+                rows_in += shard_rows_in
+                rows_out += shard_rows_out
+        print("{}: {} rows in, {} rows out".format(file, rows_in, rows_out))
 
 
 ########################################################################
 
-files = [
-    # "PRESCRIPTIONS.csv",
-    "LABEVENTS.csv"
-]
-
-patient_ids = set(get_patients_with_pneumonia())
-for file in files:
-    print("Processing file " + file)
-    produce_file_subset(file, patient_ids)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="*", default=["LABEVENTS.csv"], help="tables to subset (eg. PRESCRIPTIONS.csv)")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--jobs", type=int, default=4, help="number of processes subsetting the tables")
+    args = parser.parse_args()
 
+    patient_ids = get_patients_with_pneumonia(args.data_dir)
+    print("Processing files " + ", ".join(args.files))
+    produce_file_subsets(args.data_dir, args.files, patient_ids, args.jobs)
@@ -0,0 +1,232 @@
+"""
+Runs the cohort and event subset queries of extract_bigquery.sql locally on the raw MIMIC-III CSV files (instead of
+on BigQuery) and writes the admissions.csv, labevents.csv, prescriptions.csv, and chartevents.csv files that the
+extractors read.
+
+The raw tables are loaded once into a SQLite database (data_dir/mimiciii.sqlite by default) and indexed by HADM_ID
+and ITEMID. Only the columns used by the queries are loaded, and a table is re-loaded whenever its file changes, so
+changing the cohort (--seq-num, --diagnosis-pattern, --chart-mapping) only re-runs the queries.
+
+Example:
+    python extract_sqlite.py ../../../data/mimiciii ../../../data/exp/pneumonia --seq-num 3
+    python extract_sqlite.py ../../../data/mimiciii ../../../data/exp/pneumonia --outputs admissions.csv labevents.csv
+"""
+
+import argparse
+import csv
+import os
+import sqlite3
+
+from extractor_utils import get_input_location, load_chart_mapping, open_text, read_csv_columns
+
+DATA_DIR = "../../../data/mimiciii"
+
+# Raw MIMIC-III table -> (columns loaded, or None for all of them, indexed columns)
+TABLES = {
+    "ADMISSIONS": (None, [("HADM_ID",)]),
+    "PATIENTS": (["SUBJECT_ID", "GENDER", "DOB"], [("SUBJECT_ID",)]),
+    "DIAGNOSES_ICD": (["HADM_ID", "SEQ_NUM", "ICD9_CODE"], [("HADM_ID",)]),
+    "D_ICD_DIAGNOSES": (["ICD9_CODE", "SHORT_TITLE", "LONG_TITLE"], [("ICD9_CODE",)]),
+    "D_ITEMS": (["ITEMID", "LABEL"], [("ITEMID",)]),
+    "D_LABITEMS": (["ITEMID", "LABEL", "FLUID"], [("ITEMID",)]),
+    "CHARTEVENTS": (["HADM_ID", "ITEMID", "CHARTTIME", "VALUE", "VALUENUM", "VALUEUOM", "WARNING", "ERROR"],
+                    [("HADM_ID", "ITEMID")]),
+    "LABEVENTS": (["HADM_ID", "ITEMID", "CHARTTIME", "VALUE", "VALUENUM", "VALUEUOM"], [("HADM_ID",)]),
+    "PRESCRIPTIONS": (["HADM_ID", "STARTDATE", "ENDDATE", "DRUG", "FORMULARY_DRUG_CD", "PROD_STRENGTH",
+                       "DOSE_VAL_RX", "DOSE_UNIT_RX", "ROUTE"], [("HADM_ID",)])
+}
+
+# Columns compared as numbers by the queries (every other column keeps the text of the CSV file)
+INTEGER_COLUMNS = {"ROW_ID", "SUBJECT_ID", "HADM_ID", "ITEMID", "SEQ_NUM", "ERROR", "HOSPITAL_EXPIRE_FLAG",
+                   "HAS_CHARTEVENTS_DATA"}
+
+# Columns of admissions.csv written as 2100-06-09T01:39:00, like the BigQuery export read by extract_admissions.py
+ADMISSION_TIME_COLUMNS = {"ADMITTIME", "DISCHTIME", "DEATHTIME", "EDREGTIME", "EDOUTTIME"}
+
+# The admissions with a matching diagnosis within the first SEQ_NUM ones, and with chart events
+COHORT_QUERY = """
+INSERT INTO cohort
+SELECT a.HADM_ID, min(b.SHORT_TITLE) FROM DIAGNOSES_ICD a, D_ICD_DIAGNOSES b
+WHERE a.ICD9_CODE = b.ICD9_CODE
+AND (b.SHORT_TITLE LIKE :pattern OR b.LONG_TITLE LIKE :pattern)
+AND a.SEQ_NUM <= :seq_num
+AND a.HADM_ID IN (SELECT HADM_ID FROM ADMISSIONS WHERE HAS_CHARTEVENTS_DATA = 1)
+GROUP BY a.HADM_ID
+"""
+
+# Output file -> (query, tables read by the query). The CROSS JOINs make SQLite look up the rows of each admission of
+# the cohort through the HADM_ID indexes, rather than scanning whole event tables (or indexing them again).
+OUTPUTS = {
+    "admissions.csv": ("""
+SELECT c.*,
+CASE WHEN round((julianday(date(c.ADMITTIME)) - julianday(date(p.DOB))) / 365.242, 4) > 89 THEN 91.4
+ELSE round((julianday(date(c.ADMITTIME)) - julianday(date(p.DOB))) / 365.242, 4) END AS age,
+p.GENDER AS gender,
+d.SHORT_TITLE
+FROM cohort d
+CROSS JOIN ADMISSIONS c ON c.HADM_ID = d.HADM_ID
+CROSS JOIN PATIENTS p ON c.SUBJECT_ID = p.SUBJECT_ID
+ORDER BY c.ADMITTIME, c.HADM_ID
+""", ["PATIENTS"]),
+    "chartevents.csv": ("""
+SELECT c.HADM_ID, c.CHARTTIME, e.ITEMID, e.LABEL, c.VALUE, c.VALUENUM, c.VALUEUOM, c.WARNING
+FROM cohort d
+CROSS JOIN CHARTEVENTS c ON c.HADM_ID = d.HADM_ID
+CROSS JOIN D_ITEMS e ON c.ITEMID = e.ITEMID
+WHERE c.ERROR != 1
+AND c.ITEMID IN (SELECT ITEMID FROM chart_itemids)
+ORDER BY c.HADM_ID, c.CHARTTIME, e.LABEL
+""", ["CHARTEVENTS", "D_ITEMS"]),
+    "labevents.csv": ("""
+SELECT c.HADM_ID, c.CHARTTIME, e.ITEMID, e.LABEL, e.FLUID, c.VALUE, c.VALUENUM, c.VALUEUOM
+FROM cohort d
+CROSS JOIN LABEVENTS c ON c.HADM_ID = d.HADM_ID
+CROSS JOIN D_LABITEMS e ON c.ITEMID = e.ITEMID
+ORDER BY c.HADM_ID, c.CHARTTIME, e.LABEL
+""", ["LABEVENTS", "D_LABITEMS"]),
+    "prescriptions.csv": ("""
+SELECT c.HADM_ID, c.STARTDATE, c.ENDDATE, c.DRUG, c.FORMULARY_DRUG_CD, c.PROD_STRENGTH, c.DOSE_VAL_RX,
+c.DOSE_UNIT_RX, c.ROUTE
+FROM cohort d
+CROSS JOIN PRESCRIPTIONS c ON c.HADM_ID = d.HADM_ID
+ORDER BY c.HADM_ID, c.STARTDATE, c.DRUG
+""", ["PRESCRIPTIONS"])
+}
+
+
+def get_database_location(data_dir):
+    return data_dir + "/mimiciii.sqlite"
+
+
+def get_table_stamp(path, columns):
+    stat = os.stat(path)
+    return ",".join(columns), stat.st_size, stat.st_mtime_ns
+
+
+def load_table(connection, path, table, columns, indexes):
+    """
+    (Re-)loads the given columns of a raw table into the database, then indexes it
+    """
+    print("Loading " + table)
+    connection.execute("DROP TABLE IF EXISTS " + table)
+    connection.execute("DELETE FROM loaded_tables WHERE table_name = ?", (table,))
+    connection.execute("CREATE TABLE {} ({})".format(table, ", ".join(
+        "{} {}".format(column, "INTEGER" if column in INTEGER_COLUMNS else "TEXT") for column in columns)))
+    insert = "INSERT INTO {} VALUES ({})".format(table, ",".join("?" * len(columns)))
+    num_rows = 0
+    for chunk in read_csv_columns(path, columns):
+        # Empty values are NULLs, as in BigQuery
+        connection.executemany(insert, (tuple(value or None for value in row) for row in zip(*chunk)))
+        num_rows += len(chunk[0]) if chunk else 0
+        print("     Loaded {} rows".format(num_rows))
+    for index_columns in indexes:
+        connection.execute("CREATE INDEX {}_by_{} ON {} ({})".format(
+            table, "_".join(index_columns), table, ", ".join(index_columns)))
+    connection.execute("ANALYZE " + table)
+    connection.execute("INSERT INTO loaded_tables VALUES (?, ?, ?, ?)", (table,) + get_table_stamp(path, columns))
+    connection.commit()
+
+
+def open_database(data_dir=DATA_DIR, database_location=None, tables=TABLES):
+    """
+    Opens the database of the raw tables in data_dir (by default data_dir/mimiciii.sqlite), first loading every one
+    of the given tables that is not loaded yet or changed since it was loaded. The tables are read from
+    data_dir/<table>.csv, or from their compressed version (see get_input_location).
+    """
+    connection = sqlite3.connect(get_database_location(data_dir) if database_location is None else database_location)
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.execute("CREATE TABLE IF NOT EXISTS loaded_tables "
+                       "(table_name TEXT PRIMARY KEY, columns TEXT, size INTEGER, mtime INTEGER)")
+    for table in tables:
+        columns, indexes = TABLES[table]
+        path = get_input_location(data_dir + "/" + table + ".csv")
+        if columns is None:
+            with open_text(path) as csv_file:
+                columns = next(csv.reader(csv_file, delimiter=','))
+        stamp = connection.execute("SELECT columns, size, mtime FROM loaded_tables WHERE table_name = ?",
+                                   (table,)).fetchone()
+        if stamp != get_table_stamp(path, columns):
+            load_table(connection, path, table, columns, indexes)
+    return connection
+
+
+def select_cohort(connection, seq_num, diagnosis_pattern, chart_itemids):
+    """
+    Fills the cohort table with the HADM_ID (and the first SHORT_TITLE) of every admission with a diagnosis matching
+    the LIKE pattern (case-sensitive, as in BigQuery) among its first seq_num ones, and the chart_itemids table with
+    the ITEMIDs of the chart events to extract. Returns the number of admissions in the cohort.
+    """
+    connection.execute("PRAGMA case_sensitive_like = ON")
+    connection.execute("PRAGMA automatic_index = OFF")
+    connection.execute("DROP TABLE IF EXISTS temp.cohort")
+    connection.execute("CREATE TEMP TABLE cohort (HADM_ID INTEGER PRIMARY KEY, SHORT_TITLE TEXT)")
+    connection.execute(COHORT_QUERY, {"pattern": diagnosis_pattern, "seq_num": seq_num})
+    connection.execute("DROP TABLE IF EXISTS temp.chart_itemids")
+    connection.execute("CREATE TEMP TABLE chart_itemids (ITEMID INTEGER PRIMARY KEY)")
+    connection.executemany("INSERT INTO chart_itemids VALUES (?)", [(int(itemid),) for itemid in chart_itemids])
+    return connection.execute("SELECT count(*) FROM cohort").fetchone()[0]
+
+
+def write_query_output(connection, query, output_path):
+    """
+    Writes the rows of a query (with their column names as the header) to a CSV file, and returns their number
+    """
+    cursor = connection.execute(query)
+    headers = [description[0] for description in cursor.description]
+    time_indices = [i for i, header in enumerate(headers) if header in ADMISSION_TIME_COLUMNS] \
+        if output_path.endswith("admissions.csv") else []
+    num_rows = 0
+    with open_text(output_path, 'w') as w_file:
+        csv_writer = csv.writer(w_file, delimiter=',')
+        csv_writer.writerow(headers)
+        while True:
+            rows = cursor.fetchmany(100000)
+            if not rows:
+                break
+            for row in rows:
+                if time_indices:
+                    row = list(row)
+                    for i in time_indices:
+                        if row[i] is not None:
+                            row[i] = row[i].replace(" ", "T")
+                csv_writer.writerow(row)
+            num_rows += len(rows)
+    return num_rows
+
+
+def produce_outputs(data_dir, project_dir, outputs, seq_num, diagnosis_pattern, chart_itemids, database_location=None):
+    tables = ["ADMISSIONS", "DIAGNOSES_ICD", "D_ICD_DIAGNOSES"]
+    for output in outputs:
+        tables.extend(table for table in OUTPUTS[output][1] if table not in tables)
+    connection = open_database(data_dir, database_location, tables)
+    num_admissions = select_cohort(connection, seq_num, diagnosis_pattern, chart_itemids)
+    print("Found {} admissions".format(num_admissions))
+    for output in outputs:
+        num_rows = write_query_output(connection, OUTPUTS[output][0], project_dir + "/" + output)
+        print("{}: {} rows".format(output, num_rows))
+    connection.close()
+
+
+########################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_dir", help="directory of the raw MIMIC-III CSV files")
+    parser.add_argument("project_dir", help="directory of the output files")
+    parser.add_argument("--outputs", nargs="+", default=list(OUTPUTS),
+                        help="files to write among {} (all of them by default)".format(", ".join(OUTPUTS)))
+    parser.add_argument("--seq-num", type=int, default=3,
+                        help="only count the diagnoses among the first SEQ_NUM ones of an admission")
+    parser.add_argument("--diagnosis-pattern", default="%neumonia%",
+                        help="SQL LIKE pattern of the SHORT_TITLE or LONG_TITLE of the diagnoses of the cohort")
+    parser.add_argument("--chart-mapping", default=None,
+                        help="JSON or CSV file of additional chart ITEMIDs (see load_chart_mapping)")
+    parser.add_argument("--database", default=None,
+                        help="SQLite file of the loaded tables (data_dir/mimiciii.sqlite by default)")
+    args = parser.parse_args()
+    for output in args.outputs:
+        if output not in OUTPUTS:
+            parser.error("unknown output " + output)
+
+    produce_outputs(args.data_dir, args.project_dir, args.outputs, args.seq_num, args.diagnosis_pattern,
+                    load_chart_mapping(args.chart_mapping), args.database)
@@ -1,13 +1,986 @@
+import argparse
+import csv
+from datetime import datetime
+import gzip
+import io
+from itertools import groupby, islice
+import json
+import os
+import queue
+import tempfile
+import threading
+
 import numpy as np
 
+# chart itemid -> chart name (the ITEMIDs are also listed in extract_bigquery.sql)
+# Extended with a mapping file through load_chart_mapping
+CHART_ITEMID_TO_CHART = {
+    "220045": "Heart Rate",
+    "211": "Heart Rate",
+    "618": "Respiratory Rate",
+    "220210": "Respiratory Rate",
+    "220180": "Diastolic",
+    "8441": "Diastolic",
+    "220179": "Systolic",
+    "455": "Systolic",
+    "220277": "O2",
+    "646": "O2",
+    "223834": "O2 Flow",
+    "470": "O2 Flow",
+    "223762": "Temperature",
+    "677": "Temperature"
+}
+
+# Columns of the event files read by the extractors, with HADM_ID always first (see extract_bigquery.sql)
+LAB_COLUMNS = ["HADM_ID", "CHARTTIME", "LABEL", "VALUENUM"]
+DRUG_COLUMNS = ["HADM_ID", "STARTDATE", "ENDDATE", "FORMULARY_DRUG_CD"]
+CHART_COLUMNS = ["HADM_ID", "CHARTTIME", "ITEMID", "VALUENUM"]
+
+# (name, file name, columns) of the event files
+EVENT_FILES = [
+    ("Labs", "labevents.csv", LAB_COLUMNS),
+    ("Drugs", "prescriptions.csv", DRUG_COLUMNS),
+    ("Charts", "chartevents.csv", CHART_COLUMNS)
+]
+
+# Suffixes of the compressed files that can be read and written in place of .csv files
+COMPRESSED_SUFFIXES = [".gz", ".zst"]
+
+# Parsers of read_csv_columns, in order of preference
+CSV_BACKENDS = ["pyarrow", "pandas", "csv"]
+
+# Proleptic Gregorian ordinal of the epoch (1970-01-01)
+EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+# YYYY-MM-DD -> seconds since the epoch at midnight of that date
+_date_to_epoch_seconds = {}
+
+
+class GroupStatistics(object):
+    """
+    Running statistics of the (offset, val) events of every group of a source (eg. the labs of a window), as arrays
+    indexed like the sorted group keys: the number of events, the sum of the values, the sums of the offsets, values,
+    squares, and products shifted by the first event of the group (so that they do not cancel catastrophically), the
+    min and max, and the first and last events by offset. The AGGREGATES of every group are derived from them, and
+    the statistics of consecutive batches of events are combined with merge, so the raw events never need to be
+    kept. window_ends is the offset at which the window of every group ends.
+    """
+    # field -> value of a group without events, which merge leaves unchanged
+    FIELDS = {
+        "n": 0,
+        "sum": 0.0,
+        "shift_x": 0.0,
+        "shift_y": 0.0,
+        "sum_dx": 0.0,
+        "sum_dy": 0.0,
+        "sum_dxx": 0.0,
+        "sum_dyy": 0.0,
+        "sum_dxy": 0.0,
+        "min": np.inf,
+        "max": -np.inf,
+        "first_offset": np.inf,
+        "first": 0.0,
+        "last_offset": -np.inf,
+        "last": 0.0
+    }
+
+    def __init__(self, keys, window_ends, **fields):
+        self.keys = keys
+        self.window_ends = window_ends
+        for field in self.FIELDS:
+            setattr(self, field, fields[field])
+
+    def expand(self, keys):
+        """
+        Returns field -> array of the statistics for the given sorted keys (a superset of the keys of the groups)
+        """
+        indices = np.searchsorted(keys, self.keys)
+        fields = {}
+        for field, empty in self.FIELDS.items():
+            fields[field] = np.full(len(keys), empty, dtype=np.int64 if field == "n" else np.float64)
+            fields[field][indices] = getattr(self, field)
+        window_ends = np.zeros(len(keys))
+        window_ends[indices] = self.window_ends
+        fields["window_ends"] = window_ends
+        return fields
+
+    def merge(self, other):
+        """
+        Returns the statistics of the events of both (the events of other coming after these ones in the file)
+        """
+        keys = np.union1d(self.keys, other.keys)
+        a = self.expand(keys)
+        b = other.expand(keys)
+        # The sums of other are shifted to the first events of self (groups only present on one side are unchanged)
+        shift_x = np.where(a["n"] > 0, a["shift_x"], b["shift_x"])
+        shift_y = np.where(a["n"] > 0, a["shift_y"], b["shift_y"])
+        delta_x = b["shift_x"] - shift_x
+        delta_y = b["shift_y"] - shift_y
+        take_first = b["first_offset"] < a["first_offset"]
+        take_last = b["last_offset"] >= a["last_offset"]
+        return GroupStatistics(
+            keys, np.where(b["n"] > 0, b["window_ends"], a["window_ends"]),
+            n=a["n"] + b["n"],
+            sum=a["sum"] + b["sum"],
+            shift_x=shift_x,
+            shift_y=shift_y,
+            sum_dx=a["sum_dx"] + (b["sum_dx"] + b["n"] * delta_x),
+            sum_dy=a["sum_dy"] + (b["sum_dy"] + b["n"] * delta_y),
+            sum_dxx=a["sum_dxx"] + (b["sum_dxx"] + 2 * delta_x * b["sum_dx"] + b["n"] * delta_x * delta_x),
+            sum_dyy=a["sum_dyy"] + (b["sum_dyy"] + 2 * delta_y * b["sum_dy"] + b["n"] * delta_y * delta_y),
+            sum_dxy=a["sum_dxy"] + (b["sum_dxy"] + delta_x * b["sum_dy"] + delta_y * b["sum_dx"] +
+                                    b["n"] * delta_x * delta_y),
+            min=np.minimum(a["min"], b["min"]),
+            max=np.maximum(a["max"], b["max"]),
+            first_offset=np.where(take_first, b["first_offset"], a["first_offset"]),
+            first=np.where(take_first, b["first"], a["first"]),
+            last_offset=np.where(take_last, b["last_offset"], a["last_offset"]),
+            last=np.where(take_last, b["last"], a["last"])
+        )
+
+    def mean(self):
+        return self.sum / self.n
+
+    def trend(self):
+        """
+        Least squares trend of the values over the offsets (0 for groups with less than two distinct offsets)
+        """
+        sxx = self.sum_dxx - self.sum_dx * self.sum_dx / self.n
+        sxy = self.sum_dxy - self.sum_dx * self.sum_dy / self.n
+        return np.divide(sxy, sxx, out=np.zeros(len(self.keys)), where=sxx > 0)
+
+    def std(self):
+        return np.sqrt(np.maximum(self.sum_dyy - self.sum_dy * self.sum_dy / self.n, 0) / self.n)
+
+    def count(self):
+        return self.n.astype(np.float64)
+
+    def time_since_last(self):
+        return self.window_ends - self.last_offset
+
+
+def get_event_statistics(keys, offsets, vals, window_ends=0):
+    """
+    Given flat arrays of the group key, offset, and value of a batch of events, returns the GroupStatistics of their
+    groups. window_ends is the offset at which the window of every event (or of all of them) ends.
+
+    Events are ordered by offset within their group, and events at the same offset keep their order. The sums are
+    added in the order of the events, exactly like EventAccumulator does.
+    """
+    offsets = np.asarray(offsets, dtype=np.float64)
+    vals = np.asarray(vals, dtype=np.float64)
+    group_keys, first_indices, group_ids = np.unique(np.asarray(keys, dtype=np.int64), return_index=True,
+                                                     return_inverse=True)
+    group_ids = group_ids.reshape(-1)
+    num_groups = len(group_keys)
+    dx = offsets - offsets[first_indices][group_ids]
+    dy = vals - vals[first_indices][group_ids]
+
+    n = np.bincount(group_ids, minlength=num_groups)
+    order = np.lexsort((offsets, group_ids))
+    first_events = order[np.cumsum(n) - n]
+    last_events = order[np.cumsum(n) - 1]
+    mins = np.full(num_groups, np.inf)
+    np.minimum.at(mins, group_ids, vals)
+    maxs = np.full(num_groups, -np.inf)
+    np.maximum.at(maxs, group_ids, vals)
+    return GroupStatistics(
+        group_keys, np.broadcast_to(np.asarray(window_ends, dtype=np.float64), offsets.shape)[first_events],
+        n=n,
+        sum=np.bincount(group_ids, weights=vals, minlength=num_groups),
+        shift_x=offsets[first_indices],
+        shift_y=vals[first_indices],
+        sum_dx=np.bincount(group_ids, weights=dx, minlength=num_groups),
+        sum_dy=np.bincount(group_ids, weights=dy, minlength=num_groups),
+        sum_dxx=np.bincount(group_ids, weights=dx * dx, minlength=num_groups),
+        sum_dyy=np.bincount(group_ids, weights=dy * dy, minlength=num_groups),
+        sum_dxy=np.bincount(group_ids, weights=dx * dy, minlength=num_groups),
+        min=mins,
+        max=maxs,
+        first_offset=offsets[first_events],
+        first=vals[first_events],
+        last_offset=offsets[last_events],
+        last=vals[last_events]
+    )
+
+
+class EventAccumulator(object):
+    """
+    Running statistics of the (offset, val) events of a single group (see GroupStatistics), updated in O(1) per event
+    so that the raw events are never kept
+    """
+    __slots__ = tuple(GroupStatistics.FIELDS)
+
+    def __init__(self, offset, val):
+        self.n = 1
+        self.sum = val
+        self.shift_x = offset
+        self.shift_y = val
+        self.sum_dx = 0.0
+        self.sum_dy = 0.0
+        self.sum_dxx = 0.0
+        self.sum_dyy = 0.0
+        self.sum_dxy = 0.0
+        self.min = val
+        self.max = val
+        self.first_offset = offset
+        self.first = val
+        self.last_offset = offset
+        self.last = val
+
+    def add(self, offset, val):
+        self.n += 1
+        self.sum += val
+        dx = offset - self.shift_x
+        dy = val - self.shift_y
+        self.sum_dx += dx
+        self.sum_dy += dy
+        self.sum_dxx += dx * dx
+        self.sum_dyy += dy * dy
+        self.sum_dxy += dx * dy
+        if val < self.min:
+            self.min = val
+        elif val > self.max:
+            self.max = val
+        # Events at the same offset keep their order
+        if offset < self.first_offset:
+            self.first_offset = offset
+            self.first = val
+        if offset >= self.last_offset:
+            self.last_offset = offset
+            self.last = val
+
+
+class GroupedEvents(object):
+    """
+    The (key, item, offset, val) events of a source (eg. the labs of a window), kept as an EventAccumulator per
+    (key, item) group, from which their aggregates are derived (see fill_aggregate_features)
+    """
+    __slots__ = ("accumulators",)
+
+    def __init__(self):
+        self.accumulators = {}
+
+    def add(self, key, item, offset, val):
+        accumulator = self.accumulators.get((key, item))
+        if accumulator is None:
+            self.accumulators[(key, item)] = EventAccumulator(offset, val)
+        else:
+            accumulator.add(offset, val)
+
 
 def calculate_trend(tuples):
     """
     Given an array of tuples of (offset, val), perform least squares to find trend
     """
-    if len(tuples) <= 1:
+    tuples = list(tuples)
+    if not tuples:
         return 0
-    x = np.array([t[0] for t in tuples])
-    y = np.array([t[1] for t in tuples])
+    offsets, vals = zip(*tuples)
+    return get_event_statistics(np.zeros(len(tuples)), offsets, vals).trend()[0]
+
+
+# aggregate name -> function returning the aggregate of every group of a GroupStatistics. Each numeric item has a
+# feature column per selected aggregate (see get_feature_columns), all derived from the same running statistics.
+AGGREGATES = {
+    "mean": GroupStatistics.mean,
+    "trend": GroupStatistics.trend,
+    "min": lambda statistics: statistics.min,
+    "max": lambda statistics: statistics.max,
+    "std": GroupStatistics.std,
+    "first": lambda statistics: statistics.first,
+    "last": lambda statistics: statistics.last,
+    "count": GroupStatistics.count,
+    "time_since_last": GroupStatistics.time_since_last
+}
+
+DEFAULT_AGGREGATES = ["mean", "trend"]
+
+
+def parse_aggregates(value):
+    """
+    Parses a comma-separated list of AGGREGATES (eg. mean,trend,min,max), for argparse
+    """
+    aggregates = value.split(",")
+    unknown = [aggregate for aggregate in aggregates if aggregate not in AGGREGATES]
+    if unknown:
+        raise argparse.ArgumentTypeError("unknown aggregate(s) {} (choose from {})".format(
+            ", ".join(unknown), ", ".join(AGGREGATES)))
+    if len(set(aggregates)) != len(aggregates):
+        raise argparse.ArgumentTypeError("aggregates are listed more than once in {}".format(value))
+    return aggregates
+
+
+def get_aggregate_column(name, aggregate):
+    """
+    Returns the name of the feature column of an aggregate of a lab or chart event (the mean keeps the plain name)
+    """
+    return name if aggregate == "mean" else name + "-" + aggregate
+
+
+def round_exact(values, ndigits=3):
+    """
+    Applies Python's round() to every value of a float array (np.round can differ in the last digit).
+    Each distinct value is only rounded once.
+    """
+    uniques, inverse = np.unique(values, return_inverse=True)
+    return np.array([round(v, ndigits) for v in uniques.tolist()], dtype=np.float64)[inverse.reshape(-1)]
+
+
+def parse_epoch_seconds(timestamp):
+    """
+    Given a fixed-format timestamp (eg. 2108-04-06 11:30:00 or 2108-04-06T11:30:00), returns the
+    whole number of seconds since the epoch. Each distinct date is only parsed once.
+    """
+    date = timestamp[:10]
+    date_seconds = _date_to_epoch_seconds.get(date)
+    if date_seconds is None:
+        date_seconds = (datetime.strptime(date, '%Y-%m-%d').toordinal() - EPOCH_ORDINAL) * 86400
+        _date_to_epoch_seconds[date] = date_seconds
+    return date_seconds + int(timestamp[11:13]) * 3600 + int(timestamp[14:16]) * 60 + int(timestamp[17:19])
+
+
+def get_admit_epochs(hadmid_to_admission_info):
+    """
+    Given the map of hadmid -> derived admission row, returns a map of hadmid -> admit time in seconds since the epoch
+    """
+    return {hadmid: parse_epoch_seconds(row[1]) for hadmid, row in hadmid_to_admission_info.items()}
+
+
+def hours_since_admit(admit_epoch, timestamp):
+    """
+    Returns the number of hours between the admit time (in seconds since the epoch) and the event timestamp
+    """
+    return (parse_epoch_seconds(timestamp) - admit_epoch) / 3600
+
+
+def get_cutoff_timestamps(hadmid_to_admit_epoch, hours):
+    """
+    Returns a map of hadmid -> (date, time) strings of the latest timestamp whose hour offset since the admit time,
+    rounded to three decimals, can still be within the given hours. Events after it can be rejected by
+    is_after_cutoff without parsing their timestamp.
+    """
+    hadmid_to_cutoff = {}
+    for hadmid, admit_epoch in hadmid_to_admit_epoch.items():
+        # Offsets up to 1.8 seconds past the window are rounded down into it
+        days, seconds = divmod(admit_epoch + int(hours * 3600) + 2, 86400)
+        hadmid_to_cutoff[hadmid] = (
+            datetime.fromordinal(EPOCH_ORDINAL + days).strftime('%Y-%m-%d'),
+            "{:02d}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+        )
+    return hadmid_to_cutoff
+
+
+def is_after_cutoff(timestamp, cutoff):
+    """
+    Compares a fixed-format timestamp (with either separator, see parse_epoch_seconds) against a (date, time) cutoff
+    of get_cutoff_timestamps as strings
+    """
+    date = timestamp[:10]
+    return date > cutoff[0] or (date == cutoff[0] and timestamp[11:19] > cutoff[1])
+
+
+def calculate_hour_offsets(admit_epochs, timestamps):
+    """
+    Vectorized version of hours_since_admit. Given an array of admit times (in seconds since the epoch) and an
+    array of event timestamps of the same length, returns an array of the hour offsets of every event
+    """
+    event_epochs = np.asarray(timestamps, dtype='datetime64[s]').astype(np.int64)
+    return (event_epochs - np.asarray(admit_epochs, dtype=np.int64)) / 3600
+
+
+class BackgroundDecompressor(io.RawIOBase):
+    """
+    Raw stream of the decompressed bytes of a compressed file, decompressed ahead by a background thread (zlib and
+    zstd release the GIL) so that parsing overlaps decompression
+    """
+
+    def __init__(self, compressed_file, chunk_size=1 << 20, max_chunks=16):
+        super().__init__()
+        self._chunks = queue.Queue(max_chunks)
+        self._chunk = b""
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._decompress, args=(compressed_file, chunk_size), daemon=True)
+        self._thread.start()
+
+    def _decompress(self, compressed_file, chunk_size):
+        try:
+            with compressed_file:
+                while not self._stopped.is_set():
+                    chunk = compressed_file.read(chunk_size)
+                    self._put(chunk)
+                    if not chunk:
+                        break
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self._chunk:
+            chunk = self._chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                # Leave the end of the file for the next reads
+                self._chunks.put(chunk)
+                return 0
+            self._chunk = chunk
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        super().close()
+
+
+def get_compression(path):
+    """
+    Returns the compressed suffix of a path (see COMPRESSED_SUFFIXES), or None
+    """
+    return next((suffix for suffix in COMPRESSED_SUFFIXES if path.endswith(suffix)), None)
+
+
+def get_input_location(path):
+    """
+    Returns the path if it exists, or else the path of its compressed version (eg. labevents.csv.gz for
+    labevents.csv) if there is one
+    """
+    if not os.path.exists(path):
+        for suffix in COMPRESSED_SUFFIXES:
+            if os.path.exists(path + suffix):
+                return path + suffix
+    return path
+
+
+def open_binary(path):
+    """
+    Opens a file (or its compressed version, see get_input_location) for reading bytes. Compressed files are
+    decompressed by a background thread.
+    """
+    path = get_input_location(path)
+    compression = get_compression(path)
+    if compression is None:
+        return open(path, 'rb')
+    if compression == ".gz":
+        compressed_file = gzip.open(path, 'rb')
+    else:
+        import zstandard
+        compressed_file = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+    return io.BufferedReader(BackgroundDecompressor(compressed_file), buffer_size=1 << 20)
+
+
+def open_text(path, mode='r'):
+    """
+    Opens a text file like open(), except that .gz and .zst files are decompressed when read (by a background
+    thread, see open_binary) and compressed when written. Reading a missing .csv file reads its compressed version
+    instead if there is one.
+    """
+    if mode == 'r':
+        path = get_input_location(path)
+        if get_compression(path) is None:
+            return open(path, mode)
+        return io.TextIOWrapper(open_binary(path), encoding='utf-8')
+
+    compression = get_compression(path)
+    if compression is None:
+        return open(path, mode)
+    if compression == ".gz":
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    import zstandard
+    return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(path, mode + 'b')), encoding='utf-8')
+
+
+def get_csv_backend(backend=None):
+    """
+    Returns the given CSV backend, or else the first of CSV_BACKENDS that is installed
+    """
+    if backend is not None:
+        return backend
+    for candidate in CSV_BACKENDS[:-1]:
+        try:
+            __import__(candidate)
+            return candidate
+        except ImportError:
+            pass
+    return CSV_BACKENDS[-1]
+
+
+def get_column_indices(headers, columns, path):
+    missing = [column for column in columns if column not in headers]
+    if missing:
+        raise ValueError("{} has no {} column(s)".format(path, ", ".join(missing)))
+    return [headers.index(column) for column in columns]
+
 
-    return ((np.mean(x) * np.mean(y)) - np.mean(x * y)) / ((np.mean(x) ** 2) - np.mean(x ** 2))
+def read_csv_header(path):
+    """
+    Returns the column names of a CSV file (or of its compressed version, see open_text)
+    """
+    with open_text(path) as csv_file:
+        return next(csv.reader(csv_file, delimiter=','))
+
+
+def read_csv_columns(path, columns, backend=None, chunk_rows=20000, newlines_in_values=False):
+    """
+    Yields the given columns (by header name) of a CSV file one chunk of rows at a time, as a list of columns of
+    str values (empty values stay ""). The chunks are parsed by the C parser of pyarrow or pandas when installed, or
+    else by the csv module (see CSV_BACKENDS). Assumes that no value contains a line break unless newlines_in_values
+    is set (eg. for the TEXT of NOTEEVENTS.csv), which makes pyarrow look for quotes across lines.
+
+    Compressed files are read as they are decompressed (see open_text). pyarrow decompresses them natively and
+    reads ahead on its own threads.
+    """
+    backend = get_csv_backend(backend)
+    path = get_input_location(path)
+    if backend != "csv":
+        # Missing columns raise the same error with every backend
+        get_column_indices(read_csv_header(path), columns, path)
+    if backend == "pyarrow":
+        import pyarrow
+        from pyarrow import csv as pyarrow_csv
+        reader = pyarrow_csv.open_csv(pyarrow.input_stream(path),
+                                      read_options=pyarrow_csv.ReadOptions(block_size=1 << 20),
+                                      parse_options=pyarrow_csv.ParseOptions(newlines_in_values=newlines_in_values),
+                                      convert_options=pyarrow_csv.ConvertOptions(
+                                          include_columns=columns,
+                                          column_types={column: pyarrow.string() for column in columns}))
+        for batch in reader:
+            yield [batch.column(i).to_pylist() for i in range(len(columns))]
+    elif backend == "pandas":
+        import pandas as pd
+        with open_text(path) as csv_file:
+            for chunk in pd.read_csv(csv_file, usecols=columns, dtype=str, na_filter=False, chunksize=chunk_rows):
+                yield [chunk[column].tolist() for column in columns]
+    else:
+        with open_text(path) as csv_file:
+            csv_reader = csv.reader(csv_file, delimiter=',')
+            indices = get_column_indices(next(csv_reader), columns, path)
+            while True:
+                rows = [[row[i] for i in indices] for row in islice(csv_reader, chunk_rows)]
+                if not rows:
+                    break
+                yield [list(column) for column in zip(*rows)]
+
+
+def iterate_columns(path, columns, name, max_rows=None, backend=None, newlines_in_values=False):
+    """
+    Yields every row of an event file as a tuple of the given columns (see read_csv_columns), printing the progress
+    every 100000 events. Stops after max_rows events if given.
+    """
+    num_rows = 0
+    for chunk in read_csv_columns(path, columns, backend, newlines_in_values=newlines_in_values):
+        rows = zip(*chunk)
+        chunk_size = len(chunk[0]) if chunk else 0
+        if max_rows is not None and num_rows + chunk_size > max_rows:
+            yield from islice(rows, max_rows + 1 - num_rows)
+            return
+        yield from rows
+        if (num_rows + chunk_size) // 100000 > num_rows // 100000:
+            print("   {} processed {} events".format(name, num_rows + chunk_size))
+        num_rows += chunk_size
+
+
+def iterate_records(binary_file, position=0, size=None):
+    """
+    Yields (start byte, end byte, bytes) of every record of a CSV file opened in binary mode, from the current
+    position of the file (given as position) to the end of the file, or only within the next size bytes if given.
+    A record spans several lines when a quoted value contains a line break.
+    """
+    end = None if size is None else position + size
+    record = b""
+    for line in binary_file:
+        record += line
+        if record.count(b'"') % 2 == 0:
+            yield position, position + len(record), record
+            position += len(record)
+            record = b""
+            if end is not None and position >= end:
+                return
+    if record:
+        yield position, position + len(record), record
+
+
+def count_quotes(byte_range):
+    """
+    Returns the number of quote characters in the (path, start, end) byte range of a file
+    """
+    path, start, end = byte_range
+    count = 0
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while start < end:
+            block = f.read(min(1 << 22, end - start))
+            if not block:
+                break
+            count += block.count(b'"')
+            start += len(block)
+    return count
+
+
+# Bytes read on each side of a split to tell whether it falls within a quoted value
+QUOTE_WINDOW = 1 << 20
+
+# Bytes that may surround a quote at the edges of a quoted value
+QUOTE_NEIGHBOURS = (b'"', b',', b'\r', b'\n', b'')
+
+
+def get_quote_parity(binary_file, split, window=QUOTE_WINDOW):
+    """
+    Returns whether the byte at split of a CSV file opened in binary mode is within a quoted value, from the quotes
+    within window bytes around it only, or None if those quotes do not tell.
+
+    A quote followed by anything but a quote, a delimiter, or the end of the file can only open a quoted value, and
+    a quote preceded by anything but a quote or a delimiter can only close one (or escape another quote), so the
+    nearest such quote gives the parity of the quotes before the split. A window without any quote is assumed to be
+    outside quoted values, which only fails for a quoted value longer than the window.
+    """
+    start = max(split - window, 0)
+    binary_file.seek(start)
+    block = binary_file.read(split + window - start)
+    base = split - start
+    if b'"' not in block:
+        return False
+
+    def get_parity_before(position):
+        # Returns the parity of the quotes before the quote at position, or None if unknown
+        if block[position + 1:position + 2] not in QUOTE_NEIGHBOURS:
+            return False
+        if position > 0 and block[position - 1:position] not in QUOTE_NEIGHBOURS[:-1]:
+            return True
+        return None
+
+    position = block.find(b'"', base)
+    while position != -1:
+        in_quotes = get_parity_before(position)
+        if in_quotes is not None:
+            return in_quotes ^ (block.count(b'"', base, position) % 2 == 1)
+        position = block.find(b'"', position + 1)
+    position = block.rfind(b'"', 0, base)
+    while position != -1:
+        in_quotes = get_parity_before(position)
+        if in_quotes is not None:
+            return in_quotes ^ (block.count(b'"', position, base) % 2 == 1)
+        position = block.rfind(b'"', 0, position)
+    return None
+
+
+def get_record_byte_ranges(path, num_shards, by_first_column=False):
+    """
+    Splits a CSV file (after its header) into at most num_shards (start, end) byte ranges of similar size that each
+    hold whole records (see iterate_records), even when quoted values contain line breaks.
+
+    With by_first_column, ranges only start where the first column (eg. HADM_ID) changes, so the records of an
+    admission are never split across ranges when the file is grouped by admission.
+
+    Whether a split falls within a quoted value is told from the quotes around it (see get_quote_parity), so that
+    each split is moved to the end of the record that it falls in without reading the whole file. Only when those
+    quotes do not tell are the quotes since the previous range counted (see count_quotes). Compressed files cannot
+    be split, so they are a single (None, None) range.
+    """
+    path = get_input_location(path)
+    if get_compression(path) is not None:
+        return [(None, None)]
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        header_end = len(f.readline())
+        splits = [header_end + (size - header_end) * i // num_shards for i in range(1, num_shards)]
+
+        boundaries = [header_end]
+        for split in splits:
+            if split < boundaries[-1]:
+                # Already within the previous range, which went past this split
+                continue
+            in_quotes = get_quote_parity(f, split)
+            if in_quotes is None:
+                in_quotes = count_quotes((path, boundaries[-1], split)) % 2 == 1
+            f.seek(split)
+            for line in f:
+                in_quotes ^= line.count(b'"') % 2 == 1
+                if not in_quotes:
+                    break
+            boundary = f.tell()
+            if by_first_column:
+                # Moves past the records of the admission that the boundary falls in
+                first_value = None
+                for start, _, record in iterate_records(f, boundary):
+                    value = record.split(b',', 1)[0].strip(b'"')
+                    if first_value is None:
+                        first_value = value
+                    elif value != first_value:
+                        boundary = start
+                        break
+                else:
+                    boundary = size
+            if boundaries[-1] < boundary < size:
+                boundaries.append(boundary)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def iterate_record_range(path, start, end):
+    """
+    Yields (start byte, end byte, bytes) of every record of a CSV file within a byte range (see
+    get_record_byte_ranges). The (None, None) range of a compressed file is the whole file after its header.
+    """
+    if start is None:
+        with open_binary(path) as csv_file:
+            yield from iterate_records(csv_file, len(csv_file.readline()))
+        return
+    with open(path, 'rb', buffering=1 << 20) as csv_file:
+        csv_file.seek(start)
+        yield from iterate_records(csv_file, start, end - start)
+
+
+def iterate_byte_range(path, start, end, columns):
+    """
+    Yields every row of an event file that starts within the byte range (see get_record_byte_ranges) as a tuple of the
+    given columns (by header name). The (None, None) range of a compressed file is the whole file.
+    """
+    if start is None:
+        return (row for chunk in read_csv_columns(path, columns) for row in zip(*chunk))
+    with open(path, 'r') as csv_file:
+        indices = get_column_indices(next(csv.reader(csv_file, delimiter=',')), columns, path)
+
+    def iterate_lines():
+        position = start
+        with open(path, 'rb') as f:
+            f.seek(start)
+            for line in f:
+                if position >= end:
+                    break
+                position += len(line)
+                yield line.decode('utf-8')
+    return (tuple(row[i] for i in indices) for row in csv.reader(iterate_lines(), delimiter=','))
+
+
+def group_rows_by_hadmid(rows):
+    """
+    Given rows sorted by HADM_ID (first column), yields (hadmid, rows of that admission) one admission at a time
+    """
+    previous_hadmid = None
+    for hadmid, hadmid_rows in groupby(rows, key=lambda row: row[0]):
+        if previous_hadmid is not None and int(hadmid) <= int(previous_hadmid):
+            raise ValueError("Events are not sorted by HADM_ID ({} found after {})".format(hadmid, previous_hadmid))
+        previous_hadmid = hadmid
+        yield hadmid, list(hadmid_rows)
+
+
+def merge_by_hadmid(hadmids, *sources):
+    """
+    Merge-joins several streams of (hadmid, rows) sorted by HADM_ID (see group_rows_by_hadmid).
+
+    Yields (hadmid, [rows of each source]) for each of the given hadmids in HADM_ID order, with an empty
+    list for sources without events for that admission. Events of any other admission are skipped.
+    """
+    heads = [next(source, None) for source in sources]
+    for hadmid in sorted(hadmids, key=int):
+        hadmid_key = int(hadmid)
+        hadmid_rows = []
+        for i, source in enumerate(sources):
+            while heads[i] is not None and int(heads[i][0]) < hadmid_key:
+                heads[i] = next(source, None)
+            if heads[i] is not None and int(heads[i][0]) == hadmid_key:
+                hadmid_rows.append(heads[i][1])
+                heads[i] = next(source, None)
+            else:
+                hadmid_rows.append([])
+        yield hadmid, hadmid_rows
+
+
+def load_chart_mapping(mapping_location=None):
+    """
+    Returns CHART_ITEMID_TO_CHART extended (or overridden) by the mapping file at mapping_location if given, either:
+       - a JSON object of ITEMID -> chart name, eg. {"646": "O2"}
+       - a CSV file with ITEMID and CONCEPT columns, eg. derived from MIMIC's d_items table
+    """
+    chart_itemid_to_chart = dict(CHART_ITEMID_TO_CHART)
+    if mapping_location is None:
+        return chart_itemid_to_chart
+
+    with open(mapping_location, 'r') as f:
+        if mapping_location.endswith(".json"):
+            chart_itemid_to_chart.update({str(itemid): chart for itemid, chart in json.load(f).items()})
+        else:
+            csv_reader = csv.reader(f, delimiter=',')
+            headers = [header.upper() for header in next(csv_reader)]
+            itemid_index, chart_index = headers.index("ITEMID"), headers.index("CONCEPT")
+            chart_itemid_to_chart.update({row[itemid_index]: row[chart_index] for row in csv_reader})
+    return chart_itemid_to_chart
+
+
+def get_chart_itemid_columns(chart_itemid_to_chart, chart_to_column):
+    """
+    Returns a map of chart ITEMID -> feature column for every ITEMID mapped to a chart event of the vocabulary
+    """
+    return {
+        itemid: chart_to_column[chart] for itemid, chart in chart_itemid_to_chart.items() if chart in chart_to_column
+    }
+
+
+def discover_vocabulary(project_dir, chart_itemid_to_chart=CHART_ITEMID_TO_CHART):
+    """
+    Cheap first pass over the lab and prescription files that collects the name of every lab (with a numeric value)
+    and drug that can appear in the output. Chart events come from chart_itemid_to_chart.
+
+    Returns {"labs": [...], "drugs": [...], "charts": [...]}, each in sorted order
+    """
+    print("Discovering vocabulary")
+    labs = set()
+    for labels, vals in read_csv_columns(project_dir + "/labevents.csv", ["LABEL", "VALUENUM"]):
+        labs.update(lab for lab, val in zip(labels, vals) if val != "")
+
+    drugs = set()
+    for starts, ends, drug_names in read_csv_columns(project_dir + "/prescriptions.csv", DRUG_COLUMNS[1:]):
+        drugs.update(
+            drug for start, end, drug in zip(starts, ends, drug_names) if drug != "" and start != "" and end != ""
+        )
+
+    return {
+        "labs": sorted(labs),
+        "drugs": sorted(drugs),
+        "charts": sorted(set(chart_itemid_to_chart.values()))
+    }
+
+
+def load_vocabulary(project_dir, vocabulary_location=None, chart_itemid_to_chart=CHART_ITEMID_TO_CHART):
+    """
+    Loads the vocabulary persisted at vocabulary_location. If there is none yet, the vocabulary is discovered
+    from the event files (and persisted at vocabulary_location if given) so that later runs use the same columns.
+
+    Raises a ValueError if chart_itemid_to_chart maps ITEMIDs to chart events that the persisted vocabulary does not
+    have, since they would have no column (eg. after extending the chart mapping)
+    """
+    if vocabulary_location is not None and os.path.exists(vocabulary_location):
+        with open(vocabulary_location, 'r') as f:
+            vocabulary = json.load(f)
+        missing_charts = sorted(set(chart_itemid_to_chart.values()) - set(vocabulary["charts"]))
+        if missing_charts:
+            raise ValueError("The chart events {} of the chart mapping are not in the vocabulary at {} (remove it to "
+                             "discover the vocabulary again)".format(", ".join(missing_charts), vocabulary_location))
+        return vocabulary
+
+    vocabulary = discover_vocabulary(project_dir, chart_itemid_to_chart)
+    if vocabulary_location is not None:
+        with open(vocabulary_location, 'w') as f:
+            json.dump(vocabulary, f, indent=1)
+    return vocabulary
+
+
+def get_feature_columns(vocabulary, aggregates=DEFAULT_AGGREGATES):
+    """
+    Returns the feature column names (aggregates of every lab, every drug, then aggregates of every chart event)
+    along with maps of lab -> column, drug -> column and chart -> column. The aggregates of a lab or chart event are
+    in consecutive columns (in the order of aggregates, by default the average then the trend) starting at its
+    column.
+    """
+    columns = []
+    lab_to_column = {}
+    for l in vocabulary["labs"]:
+        lab_to_column[l] = len(columns)
+        columns.extend(get_aggregate_column(l, aggregate) for aggregate in aggregates)
+
+    drug_to_column = {}
+    for d in vocabulary["drugs"]:
+        drug_to_column[d] = len(columns)
+        columns.append(d)
+
+    chart_to_column = {}
+    for c in vocabulary["charts"]:
+        chart_to_column[c] = len(columns)
+        columns.extend(get_aggregate_column(c, aggregate) for aggregate in aggregates)
+    return columns, lab_to_column, drug_to_column, chart_to_column
+
+
+def get_column_ranges(lab_to_column, drug_to_column, chart_to_column, aggregates=DEFAULT_AGGREGATES):
+    """
+    Returns the (start, end) feature columns of the labs, drugs, and chart events (see get_feature_columns)
+    """
+    lab_end = len(aggregates) * len(lab_to_column)
+    drug_end = lab_end + len(drug_to_column)
+    return (0, lab_end), (lab_end, drug_end), (drug_end, drug_end + len(aggregates) * len(chart_to_column))
+
+
+def allocate_features(num_rows, num_columns, on_disk=False):
+    """
+    Preallocates a zero-filled feature matrix. When on_disk is set, the matrix is backed by a temporary file
+    so that it does not need to fit in memory.
+    """
+    if on_disk:
+        return np.memmap(tempfile.TemporaryFile(), dtype=np.float64, mode='w+', shape=(max(num_rows, 1), num_columns))
+    return np.zeros((num_rows, num_columns))
+
+
+def fill_grouped_aggregate_features(features, statistics, aggregates=DEFAULT_AGGREGATES):
+    """
+    Writes the aggregates (see AGGREGATES) of every group of the GroupStatistics into consecutive columns of the
+    features, starting at the column of the group. Group keys are row * number of feature columns + column (see
+    get_feature_keys).
+    """
+    group_rows, group_columns = np.divmod(statistics.keys, features.shape[1])
+    for i, aggregate in enumerate(aggregates):
+        features[group_rows, group_columns + i] = AGGREGATES[aggregate](statistics)
+
+
+def get_feature_keys(features, rows, columns):
+    """
+    Returns the group keys of events in the given rows and (first) columns of the features
+    """
+    return np.asarray(rows, dtype=np.int64) * features.shape[1] + np.asarray(columns, dtype=np.int64)
+
+
+def get_grouped_statistics(features, key_to_row, item_to_column, events, window_end=0):
+    """
+    Returns the GroupStatistics of every (key, item) group of the GroupedEvents, with the group key of the columns of
+    the item in the row of the key (see get_feature_keys). Keys without a row are skipped. If item_to_column is None,
+    the items are the columns themselves.
+
+    window_end is the offset at which the window of the events ends (see time_since_last), or a function of the key
+    returning it.
+    """
+    keys, accumulators, window_ends = [], [], []
+    for (key, item), accumulator in events.accumulators.items():
+        row = key_to_row.get(key)
+        if row is None:
+            continue
+        keys.append(row * features.shape[1] + (item if item_to_column is None else item_to_column[item]))
+        accumulators.append(accumulator)
+        window_ends.append(window_end(key) if callable(window_end) else window_end)
+    order = np.argsort(np.array(keys, dtype=np.int64))
+    fields = {
+        field: np.array([getattr(accumulator, field) for accumulator in accumulators],
+                        dtype=np.int64 if field == "n" else np.float64)[order]
+        for field in GroupStatistics.FIELDS
+    }
+    return GroupStatistics(np.array(keys, dtype=np.int64)[order], np.array(window_ends, dtype=np.float64)[order],
+                           **fields)
+
+
+def fill_aggregate_features(features, key_to_row, item_to_column, events, aggregates=DEFAULT_AGGREGATES,
+                            window_end=0):
+    """
+    Writes the aggregates of every (key, item) group of the GroupedEvents into the columns of the item in the row of
+    the key (see get_grouped_statistics)
+    """
+    fill_grouped_aggregate_features(features, get_grouped_statistics(features, key_to_row, item_to_column, events,
+                                                                     window_end), aggregates)
+
+
+def format_feature(value):
+    """
+    Rounds a feature to three decimals for the CSV output, writing whole numbers (eg. drug indicators) as integers
+    """
+    value = round(value, 3)
+    return int(value) if value.is_integer() else value
@@ -0,0 +1,225 @@
+"""
+SQLite store of the features of every admission, so that prepare_first_x_hours.py and prepare_lstm_input.py
+(--store) only aggregate the events of the admissions that are new or changed since their last run.
+
+The store keeps the size and modification time of each event file (see EVENT_FILES) and a fingerprint of the events
+of every admission in each of them:
+   - the stage of a file is skipped when neither the file nor the admissions changed since the last run
+   - otherwise, the events of every admission are fingerprinted while the stage scans the file (see
+     AdmissionSelector), and only those of the admissions whose fingerprint changed are aggregated
+The features of the other admissions are taken from the store.
+
+Example:
+    connection = open_feature_store("features.sqlite", {"windows": windows, "columns": columns})
+    hadmid_to_fingerprint = fingerprint_admissions(hadmid_to_admission_info)
+    lab_selector, drug_selector, chart_selector = get_admission_selectors(connection, project_dir,
+                                                                          hadmid_to_fingerprint)
+    process_labs(project_dir, hadmid_to_admit_epoch, hadmid_to_row, lab_to_column, window_to_features,
+                 selector=lab_selector)
+    save_features(connection, lab_selector, lab_selector.get_changed_hadmids(), entries, lab_columns)
+    save_admissions(connection, hadmid_to_fingerprint)
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from extractor_utils import EVENT_FILES, get_input_location, group_rows_by_hadmid
+
+# Bumped whenever the tables of the store change, so that older stores are rebuilt
+STORE_VERSION = 2
+
+STORE_TABLES = {
+    "settings": "(settings TEXT)",
+    "files": "(source TEXT PRIMARY KEY, size INTEGER, mtime INTEGER)",
+    "fingerprints": "(hadmid TEXT, source TEXT, fingerprint TEXT, PRIMARY KEY (hadmid, source))",
+    "features": "(hadmid TEXT, source TEXT, key INTEGER, feature TEXT, value REAL)"
+}
+
+
+class AdmissionSelector(object):
+    """
+    Selects the events of one of the EVENT_FILES (the source) of the admissions that are new or changed since the
+    store was last updated, fingerprinting the events of every admission as the stage scans the file. The events
+    must be sorted by HADM_ID, as with the streaming engine.
+
+    The fingerprint of the events of an admission starts with that of its admission row (see
+    fingerprint_admissions), since the features also depend on the time of admission.
+    """
+
+    def __init__(self, source, stamp, unchanged, hadmid_to_admission_fingerprint, hadmid_to_stored_fingerprint):
+        self.source = source
+        self.stamp = stamp
+        # Whether neither the file nor the admissions changed, so that the stage is skipped
+        self.unchanged = unchanged
+        self.hadmid_to_admission_fingerprint = hadmid_to_admission_fingerprint
+        self.hadmid_to_stored_fingerprint = hadmid_to_stored_fingerprint
+        self.hadmid_to_fingerprint = {}
+
+    def add_admission(self, hadmid, events):
+        """
+        Fingerprints the events (as bytes) of an admission and returns whether they are new or changed
+        """
+        admission_fingerprint = self.hadmid_to_admission_fingerprint.get(hadmid)
+        if admission_fingerprint is None:
+            # Not one of the admissions
+            return False
+        if hadmid in self.hadmid_to_fingerprint:
+            raise ValueError("{} events are not sorted by HADM_ID ({} found twice)".format(self.source, hadmid))
+        fingerprint = hashlib.sha1(admission_fingerprint.encode('utf-8') + events).hexdigest()
+        self.hadmid_to_fingerprint[hadmid] = fingerprint
+        return self.hadmid_to_stored_fingerprint.get(hadmid) != fingerprint
+
+    def select_rows(self, rows):
+        """
+        Yields the rows (tuples of strings that start with the HADM_ID) of the new or changed admissions
+        """
+        for hadmid, hadmid_rows in group_rows_by_hadmid(rows):
+            if self.add_admission(hadmid, "\n".join("\x1f".join(row) for row in hadmid_rows).encode('utf-8')):
+                yield from hadmid_rows
+
+    def select_events(self, events):
+        """
+        Returns the events of a chunk of the columnar engine (with a "hadmid" column) of the new or changed
+        admissions. The chunk must hold all of the events of its admissions (see iterate_event_chunks).
+        """
+        if len(events) == 0:
+            return events
+        hadmids = events["hadmid"].to_numpy()
+        event_hashes = pd.util.hash_pandas_object(events, index=False).to_numpy()
+        starts = np.flatnonzero(np.r_[True, hadmids[1:] != hadmids[:-1]])
+        ends = np.r_[starts[1:], len(hadmids)]
+        selected = np.zeros(len(hadmids), dtype=bool)
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            selected[start:end] = self.add_admission(hadmids[start], event_hashes[start:end].tobytes())
+        return events[selected]
+
+    def get_changed_hadmids(self):
+        """
+        Returns the set of admissions whose events are new or changed, once the stage scanned the whole file (or
+        an empty set when the stage was skipped). The admissions without events are fingerprinted here.
+        """
+        if self.unchanged:
+            return set()
+        for hadmid in self.hadmid_to_admission_fingerprint:
+            if hadmid not in self.hadmid_to_fingerprint:
+                self.add_admission(hadmid, b"")
+        return {
+            hadmid for hadmid, fingerprint in self.hadmid_to_fingerprint.items()
+            if self.hadmid_to_stored_fingerprint.get(hadmid) != fingerprint
+        }
+
+
+def select_admission_rows(rows, selector=None):
+    """
+    Yields only the rows (events) of the new or changed admissions of the selector, or every row if selector is None
+    """
+    if selector is None:
+        return rows
+    return selector.select_rows(rows)
+
+
+def get_file_stamp(path):
+    stat = os.stat(get_input_location(path))
+    return stat.st_size, stat.st_mtime_ns
+
+
+def open_feature_store(store_location, settings):
+    """
+    Opens (or creates) the SQLite store of the fingerprints and features of every admission. The store is emptied
+    when the settings it was built with (eg. the windows and columns) differ from the given settings.
+    """
+    connection = sqlite3.connect(store_location)
+    settings = json.dumps(dict(settings, version=STORE_VERSION), sort_keys=True)
+    stored_settings = None
+    if connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'settings'").fetchone():
+        stored_settings = connection.execute("SELECT settings FROM settings").fetchone()
+    if stored_settings is None or stored_settings[0] != settings:
+        for table, schema in STORE_TABLES.items():
+            connection.execute("DROP TABLE IF EXISTS " + table)
+            connection.execute("CREATE TABLE {} {}".format(table, schema))
+        connection.execute("CREATE INDEX features_hadmid ON features (hadmid, source)")
+        connection.execute("INSERT INTO settings VALUES (?)", (settings,))
+        connection.commit()
+    return connection
+
+
+def fingerprint_admissions(hadmid_to_admission_info):
+    """
+    Returns a map of hadmid -> fingerprint of the admission row
+    """
+    return {
+        hadmid: hashlib.sha1(",".join(row).encode('utf-8')).hexdigest()
+        for hadmid, row in hadmid_to_admission_info.items()
+    }
+
+
+def get_admission_selectors(connection, project_dir, hadmid_to_admission_fingerprint):
+    """
+    Returns the AdmissionSelector of each of the EVENT_FILES, given the fingerprints of the admissions (see
+    fingerprint_admissions). Prints the files whose stage is skipped since neither they nor the admissions changed.
+    """
+    hadmid_to_stored_fingerprint = dict(connection.execute(
+        "SELECT hadmid, fingerprint FROM fingerprints WHERE source = 'Admissions'"))
+    admissions_changed = any(hadmid_to_stored_fingerprint.get(hadmid) != fingerprint
+                             for hadmid, fingerprint in hadmid_to_admission_fingerprint.items())
+
+    selectors = []
+    for name, file_name, _ in EVENT_FILES:
+        stamp = get_file_stamp(project_dir + "/" + file_name)
+        unchanged = not admissions_changed and \
+            connection.execute("SELECT size, mtime FROM files WHERE source = ?", (name,)).fetchone() == stamp
+        if unchanged:
+            print("   {} unchanged since the last run".format(name))
+        selectors.append(AdmissionSelector(name, stamp, unchanged, hadmid_to_admission_fingerprint, dict(
+            connection.execute("SELECT hadmid, fingerprint FROM fingerprints WHERE source = ?", (name,)))))
+    return selectors
+
+
+def save_features(connection, selector, hadmids, entries, columns):
+    """
+    Replaces the stored features of the source of the selector of the given (new or changed) admissions with the
+    non-zero features of entries, an iterable of (hadmid, key, feature row) whose feature rows only hold the given
+    columns (those of the source). The store is only committed by save_admissions.
+    """
+    for hadmid in hadmids:
+        connection.execute("DELETE FROM features WHERE hadmid = ? AND source = ?", (hadmid, selector.source))
+
+    # NaN is stored as NULL by SQLite
+    connection.executemany("INSERT INTO features VALUES (?, ?, ?, ?, ?)", (
+        (hadmid, selector.source, key, columns[column], None if np.isnan(value) else value)
+        for hadmid, key, feature_row in entries
+        for column, value in zip(np.flatnonzero(feature_row).tolist(), feature_row[feature_row != 0].tolist())
+    ))
+    connection.executemany("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)", (
+        (hadmid, selector.source, selector.hadmid_to_fingerprint[hadmid]) for hadmid in hadmids
+    ))
+    connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (selector.source,) + selector.stamp)
+
+
+def save_admissions(connection, hadmid_to_admission_fingerprint):
+    """
+    Stores the fingerprints of the admissions (see fingerprint_admissions) once the features of every source are
+    saved (see save_features), forgets the admissions that are no longer in them, and commits the store
+    """
+    stored_hadmids = [hadmid for hadmid, in connection.execute("SELECT DISTINCT hadmid FROM fingerprints")]
+    for hadmid in stored_hadmids:
+        if hadmid not in hadmid_to_admission_fingerprint:
+            connection.execute("DELETE FROM features WHERE hadmid = ?", (hadmid,))
+            connection.execute("DELETE FROM fingerprints WHERE hadmid = ?", (hadmid,))
+    connection.executemany("INSERT OR REPLACE INTO fingerprints VALUES (?, 'Admissions', ?)",
+                           hadmid_to_admission_fingerprint.items())
+    connection.commit()
+
+
+def load_features(connection, column_to_index):
+    """
+    Yields (hadmid, key, column index, value) for every stored feature
+    """
+    for hadmid, key, feature, value in connection.execute("SELECT hadmid, key, feature, value FROM features"):
+        if feature in column_to_index:
+            yield hadmid, key, column_to_index[feature], np.nan if value is None else value
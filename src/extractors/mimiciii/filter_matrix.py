@@ -3,15 +3,152 @@ Filters matrix to remove columns that occur with a less than X%, replaces empty
 
 Used when filtering the 24/48 hour files
 
+The matrix is read twice a chunk of rows at a time, so that memory does not depend on the number of rows: the first
+pass counts the zeros, empty (NaN), and inf values of every column, and the second pass writes the kept columns.
+A column is kept when less than --threshold of its values are zeros (empty values do not count as zeros), or when it
+is exempted with --keep.
+
+Example:
+    python filter_matrix.py first48hours.csv --threshold 0.7 --keep status los --stats first48hours.stats.csv
 """
 
-import sys
-from pandas import read_csv, np
+import argparse
+import csv
+
+import numpy as np
+import pandas as pd
+
+from extractor_utils import open_text
+
+FILTER_FORMATS = ["csv", "parquet", "feather"]
+
+
+def get_column_type(kinds):
+    """
+    Returns the type of a column from the dtype kinds of its chunks, like pandas would infer from the whole column
+    """
+    if kinds == {"b"}:
+        return "bool"
+    if kinds <= {"i"}:
+        return "int64"
+    if kinds <= {"i", "f"}:
+        return "float64"
+    return "object"
+
+
+def count_column_values(input_file, chunk_rows=10000):
+    """
+    Returns (number of rows, column -> type, column -> number of zeros, column -> number of NaNs, column -> number
+    of infs) with one chunked pass over the matrix. Only the columns that pandas infers as numeric from the whole
+    matrix have zeros, since the "0" values of a text column are strings.
+    """
+    num_rows = 0
+    column_kinds, zeros, nans, infs = {}, {}, {}, {}
+    for chunk in pd.read_csv(input_file, header=0, chunksize=chunk_rows):
+        num_rows += len(chunk)
+        for column in chunk.columns:
+            values = chunk[column]
+            column_kinds.setdefault(column, set()).add(values.dtype.kind)
+            zeros[column] = zeros.get(column, 0) + (int((values == 0).sum()) if values.dtype.kind in "bif" else 0)
+            nans[column] = nans.get(column, 0) + int(values.isna().sum())
+            infs[column] = infs.get(column, 0) + (int(np.isinf(values).sum()) if values.dtype.kind == "f" else 0)
+        print("   Counted {} rows".format(num_rows))
+    column_types = {column: get_column_type(kinds) for column, kinds in column_kinds.items()}
+    for column, column_type in column_types.items():
+        if column_type == "object":
+            # The numeric chunks of a text column are text too when the whole column is read
+            zeros[column] = 0
+    return num_rows, column_types, zeros, nans, infs
+
+
+def write_stats(stats_location, num_rows, kept_columns, zeros, nans, infs):
+    with open(stats_location, 'w') as w_file:
+        csv_writer = csv.writer(w_file, delimiter=',')
+        csv_writer.writerow(["column", "zero_fraction", "nan_count", "inf_count", "kept"])
+        for column in zeros:
+            csv_writer.writerow([column, zeros[column] / num_rows if num_rows else 0, nans[column], infs[column],
+                                 int(column in kept_columns)])
+
+
+def to_arrow_table(chunk, columns, column_types):
+    import pyarrow
+    for column in columns:
+        if column_types[column] == "object":
+            # The empty values of text columns became 0, so keep the whole column as text
+            chunk[column] = chunk[column].astype(str)
+    return pyarrow.Table.from_pandas(chunk, preserve_index=False)
+
+
+def write_filtered_matrix(input_file, output_location, columns, column_types, output_format="csv", chunk_rows=10000):
+    """
+    Writes the given columns of the matrix a chunk of rows at a time, with empty and inf values replaced by 0. The
+    CSV output keeps the row numbers as its first column.
+    """
+    # The output is started from an empty chunk, so that it has the columns even when the matrix has no rows
+    empty = pd.DataFrame({column: pd.Series(dtype=column_types[column]) for column in columns})
+    writer = w_file = None
+    if output_format == "csv":
+        w_file = open_text(output_location, 'w')
+        empty.to_csv(w_file)
+    else:
+        import pyarrow
+        schema = to_arrow_table(empty, columns, column_types).schema
+        if output_format == "parquet":
+            from pyarrow import parquet
+            writer = parquet.ParquetWriter(output_location, schema)
+        else:
+            writer = pyarrow.ipc.new_file(output_location, schema)
+
+    num_rows = 0
+    reader = pd.read_csv(input_file, header=0, usecols=columns, chunksize=chunk_rows,
+                         dtype={column: column_types[column] for column in columns if column_types[column] != "int64"})
+    for chunk in reader:
+        chunk = chunk.fillna(0).replace([np.inf, -np.inf], 0)
+        if num_rows == 0:
+            print(chunk.head(5))
+        if output_format == "csv":
+            chunk.to_csv(w_file, header=False)
+        else:
+            writer.write_table(to_arrow_table(chunk, columns, column_types).cast(schema))
+        num_rows += len(chunk)
+    if w_file is not None:
+        w_file.close()
+    if writer is not None:
+        writer.close()
+    return num_rows
+
+
+def filter_matrix(input_file, output_location, threshold=0.7, keep=(), output_format="csv", stats_location=None,
+                  chunk_rows=10000):
+    num_rows, column_types, zeros, nans, infs = count_column_values(input_file, chunk_rows)
+    columns = [column for column in column_types
+               if column in keep or num_rows == 0 or zeros[column] / num_rows < threshold]
+    print("Keeping {} of {} columns ({} empty and {} inf values replaced by 0)".format(
+        len(columns), len(column_types), sum(nans[column] for column in columns),
+        sum(infs[column] for column in columns)))
+    if stats_location is not None:
+        write_stats(stats_location, num_rows, set(columns), zeros, nans, infs)
+    write_filtered_matrix(input_file, output_location, columns, column_types, output_format, chunk_rows)
+
+
+########################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_file")
+    parser.add_argument("--output", default=None,
+                        help="output file (<input file>.filtered.csv, .parquet, or .feather by default)")
+    parser.add_argument("--threshold", type=float, default=0.7,
+                        help="columns with at least this fraction of zeros are removed")
+    parser.add_argument("--keep", nargs="+", default=[], help="columns that are never removed (eg. status los)")
+    parser.add_argument("--format", choices=FILTER_FORMATS, default="csv")
+    parser.add_argument("--stats", default=None,
+                        help="CSV file of the zero fraction and NaN and inf counts of every column")
+    parser.add_argument("--chunk-rows", type=int, default=10000, help="rows read at a time")
+    args = parser.parse_args()
 
-input_file = sys.argv[1]
-df = read_csv(input_file, header=0)
-df = df.loc[:, (df==0).mean() < .7]
-df.fillna(0, inplace=True)
-df = df.replace([np.inf, -np.inf], 0)
-print(df.head(5))
-df.to_csv(input_file + ".filtered.csv")
+    output_location = args.output
+    if output_location is None:
+        output_location = args.input_file + ".filtered." + args.format
+    filter_matrix(args.input_file, output_location, args.threshold, set(args.keep), args.format, args.stats,
+                  args.chunk_rows)
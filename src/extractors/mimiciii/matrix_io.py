@@ -0,0 +1,295 @@
+"""
+Reads and writes the binary versions of the feature matrices produced by prepare_first_x_hours.py and
+prepare_lstm_input.py (--format sparse, npy, parquet, or feather).
+
+For an output location <name>.csv:
+   - sparse: most of the features are zeros (drug indicators and the 0 used for missing labs), so they are
+     written as a scipy CSR matrix (<name>.npz) along with the names of the feature columns
+     (<name>.columns.json) and the labels and demographics of every row (<name>.rows.csv)
+   - npy: the features are written as a dense float64 matrix (<name>.npy) that can be memory-mapped, along with
+     the same <name>.columns.json and <name>.rows.csv
+   - parquet / feather: the whole table is written as a typed <name>.parquet or <name>.feather (requires pyarrow)
+   - tensor (prepare_lstm_input.py only): the daily features of every admission are written as a zero-padded
+     float32 (admissions x max days x features) tensor (<name>.tensor.npy) along with the number of days of every
+     admission (<name>.lengths.npy), the LOS remaining at every day (<name>.targets.npy), the names of the feature
+     columns (<name>.columns.json), and the labels and demographics of every admission (<name>.admissions.csv)
+
+Example (in a notebook):
+    from matrix_io import load_matrix
+    df = load_matrix('../data/exp/pneumonia-t3/first48hours.csv', columns=['los', 'Heart Rate', 'Sodium'])
+
+    # The first window of 5 days of every admission that stays long enough, with the LOS remaining after it
+    tensor, lengths, targets, columns = load_tensor('../data/exp/pneumonia-t3/timestep.csv')
+    windows, window_targets, valid = sliding_windows(tensor, lengths, targets, 5)
+    lstm_input, lstm_los = windows[valid[:, 0], 0], window_targets[valid[:, 0], 0]
+
+"""
+
+import csv
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from extractor_utils import round_exact
+
+OUTPUT_FORMATS = ["csv", "sparse", "npy", "parquet", "feather"]
+
+
+def get_output_prefix(output_location):
+    for suffix in [".csv", ".csv.gz", ".csv.zst"]:
+        if output_location.endswith(suffix):
+            return output_location[:-len(suffix)]
+    return output_location
+
+
+def get_matrix_locations(output_location):
+    """
+    Returns the locations of the matrix, column names, and rows files of a sparse output
+    """
+    prefix = get_output_prefix(output_location)
+    return prefix + ".npz", prefix + ".columns.json", prefix + ".rows.csv"
+
+
+def to_sparse_features(features, num_rows, chunk_rows=10000):
+    """
+    Converts the first num_rows rows of a dense feature matrix into a CSR matrix, a chunk of rows at a time
+    (so that memory-mapped features are never loaded at once). Values are rounded to three decimals like the
+    CSV output.
+    """
+    chunks = []
+    for start in range(0, num_rows, chunk_rows):
+        chunk = sparse.csr_matrix(np.asarray(features[start:min(start + chunk_rows, num_rows)]))
+        chunk.data = round_exact(chunk.data)
+        chunk.eliminate_zeros()
+        chunks.append(chunk)
+    if not chunks:
+        return sparse.csr_matrix((0, features.shape[1]))
+    return sparse.vstack(chunks, format="csr")
+
+
+def write_rows(rows_location, headers, rows):
+    with open(rows_location, 'w') as w_file:
+        csv_writer = csv.writer(w_file, delimiter=',')
+        csv_writer.writerow(headers)
+        csv_writer.writerows(rows)
+
+
+def write_columns(columns_location, columns):
+    with open(columns_location, 'w') as w_file:
+        json.dump(columns, w_file, indent=1)
+
+
+def write_sparse_output(output_location, headers, rows, columns, features):
+    """
+    Writes the rows (labels and demographics with the given headers) and their features as a sparse output
+    """
+    matrix_location, columns_location, rows_location = get_matrix_locations(output_location)
+    write_rows(rows_location, headers, rows)
+    write_columns(columns_location, columns)
+    sparse.save_npz(matrix_location, to_sparse_features(features, len(rows)))
+
+
+def write_npy_output(output_location, headers, rows, columns, features, chunk_rows=10000):
+    """
+    Writes the rows (labels and demographics with the given headers) and their features as an npy output.
+    The features are copied a chunk of rows at a time, rounded to three decimals like the CSV output.
+    """
+    prefix = get_output_prefix(output_location)
+    write_rows(prefix + ".rows.csv", headers, rows)
+    write_columns(prefix + ".columns.json", columns)
+    matrix = np.lib.format.open_memmap(prefix + ".npy", mode='w+', dtype=np.float64,
+                                       shape=(len(rows), len(columns)))
+    for start in range(0, len(rows), chunk_rows):
+        end = min(start + chunk_rows, len(rows))
+        chunk = np.asarray(features[start:end])
+        matrix[start:end] = round_exact(chunk).reshape(chunk.shape)
+    matrix.flush()
+
+
+def write_table_output(output_location, headers, rows, columns, features, output_format):
+    """
+    Writes the rows (labels and demographics with the given headers) and their features as a single typed
+    parquet or feather table
+    """
+    table = pd.DataFrame(rows, columns=headers)
+    for header in headers:
+        # Same types as pd.read_csv would infer from the CSV output
+        try:
+            table[header] = pd.to_numeric(table[header])
+        except (TypeError, ValueError):
+            table[header] = table[header].replace("", np.nan)
+    matrix = np.asarray(features[:len(rows)])
+    features_table = pd.DataFrame(round_exact(matrix).reshape(matrix.shape), columns=columns)
+    table = pd.concat([table, features_table], axis=1)
+
+    prefix = get_output_prefix(output_location)
+    if output_format == "parquet":
+        table.to_parquet(prefix + ".parquet", index=False)
+    else:
+        table.to_feather(prefix + ".feather")
+
+
+def write_binary_output(output_location, headers, rows, columns, features, output_format):
+    """
+    Writes the rows and their features in one of the binary output formats (see OUTPUT_FORMATS)
+    """
+    if output_format == "sparse":
+        write_sparse_output(output_location, headers, rows, columns, features)
+    elif output_format == "npy":
+        write_npy_output(output_location, headers, rows, columns, features)
+    else:
+        write_table_output(output_location, headers, rows, columns, features, output_format)
+
+
+def write_tensor_output(output_location, headers, admission_rows, los, columns, features, max_days=None,
+                        chunk_admissions=1000):
+    """
+    Writes the daily features of every admission as a tensor output. The features of an admission are the
+    consecutive rows of features given by its number of days (int(los)), truncated to max_days if given.
+    """
+    prefix = get_output_prefix(output_location)
+    write_rows(prefix + ".admissions.csv", headers, admission_rows)
+    write_columns(prefix + ".columns.json", columns)
+
+    los = np.asarray(los, dtype=np.float64)
+    num_days = los.astype(np.int64)
+    lengths = num_days if max_days is None else np.minimum(num_days, max_days)
+    first_rows = np.concatenate([[0], np.cumsum(num_days)[:-1]]).astype(np.int64)
+    tensor_days = int(lengths.max()) if len(lengths) else 0
+    np.save(prefix + ".lengths.npy", lengths)
+    days = np.arange(tensor_days)
+    np.save(prefix + ".targets.npy", np.where(days < lengths[:, None], los[:, None] - days, 0).astype(np.float32))
+
+    tensor = np.lib.format.open_memmap(prefix + ".tensor.npy", mode='w+', dtype=np.float32,
+                                       shape=(len(lengths), tensor_days, len(columns)))
+    for start in range(0, len(lengths), chunk_admissions):
+        end = min(start + chunk_admissions, len(lengths))
+        chunk = np.zeros((end - start, tensor_days, len(columns)), dtype=np.float32)
+        for i in range(start, end):
+            admission_features = np.asarray(features[first_rows[i]:first_rows[i] + lengths[i]])
+            chunk[i - start, :lengths[i]] = round_exact(admission_features).reshape(admission_features.shape)
+        tensor[start:end] = chunk
+    tensor.flush()
+
+
+def load_tensor(output_location):
+    """
+    Loads a tensor output as (memory-mapped admissions x max days x features tensor, number of days of every
+    admission, LOS remaining at every day of every admission, feature column names)
+    """
+    prefix = get_output_prefix(output_location)
+    with open(prefix + ".columns.json", 'r') as f:
+        columns = json.load(f)
+    return np.load(prefix + ".tensor.npy", mmap_mode='r'), np.load(prefix + ".lengths.npy"), \
+        np.load(prefix + ".targets.npy"), columns
+
+
+def sliding_windows(tensor, lengths, targets, window_size):
+    """
+    Returns every window of window_size consecutive days of every admission of a tensor output (see load_tensor) as
+    (windows, window targets, valid), where:
+       - windows[a, d] is the (window_size x features) window of admission a starting at day d. This is a strided
+         view of the tensor, so no data is copied until windows are selected.
+       - window_targets[a, d] is the LOS remaining after that window
+       - valid[a, d] is whether that window lies within the days of the admission
+    """
+    num_windows = max(tensor.shape[1] - window_size + 1, 0)
+    admission_stride, day_stride, feature_stride = tensor.strides
+    windows = np.lib.stride_tricks.as_strided(
+        tensor, shape=(tensor.shape[0], num_windows, window_size, tensor.shape[2]),
+        strides=(admission_stride, day_stride, day_stride, feature_stride), writeable=False)
+    window_targets = targets[:, :num_windows] - window_size
+    valid = np.arange(num_windows)[None, :] < (np.asarray(lengths) - window_size + 1)[:, None]
+    return windows, window_targets, valid
+
+
+def load_sparse_matrix(output_location):
+    """
+    Loads a sparse output as (rows DataFrame, CSR feature matrix, feature column names)
+    """
+    matrix_location, columns_location, rows_location = get_matrix_locations(output_location)
+    with open(columns_location, 'r') as f:
+        columns = json.load(f)
+    return pd.read_csv(rows_location, header=0), sparse.load_npz(matrix_location), columns
+
+
+def check_columns(output_location, available_columns, columns):
+    """
+    Raises a KeyError if any of the given columns (if not None) is not one of the available columns of the output
+    """
+    if columns is None:
+        return
+    available_columns = set(available_columns)
+    missing = [column for column in columns if column not in available_columns]
+    if missing:
+        raise KeyError("{} has no {} column(s)".format(output_location, ", ".join(missing)))
+
+
+def select_columns(frame, columns):
+    """
+    Returns the given columns of the frame in the given order (all of them if columns is None)
+    """
+    return frame if columns is None else frame[list(columns)]
+
+
+def select_feature_columns(matrix, feature_columns, columns):
+    """
+    Returns (the columns of the feature matrix that are among the given columns, their names)
+    """
+    if columns is None:
+        return matrix, feature_columns
+    column_to_index = {column: i for i, column in enumerate(feature_columns)}
+    selected = [column for column in columns if column in column_to_index]
+    return matrix[:, [column_to_index[column] for column in selected]], selected
+
+
+def load_matrix(output_location, columns=None, dense=False):
+    """
+    Loads an output (in whichever format it was written) as a single DataFrame with the same columns as the
+    CSV output, or only the given columns in the given order. Raises a KeyError if any of the given columns is not
+    a column of the output.
+
+    npy features are memory-mapped so that only the selected columns are read, parquet and feather tables only
+    read the selected columns, and sparse features stay sparse (pandas SparseDtype) unless dense is set.
+    """
+    prefix = get_output_prefix(output_location)
+    if os.path.exists(prefix + ".parquet"):
+        from pyarrow import parquet
+        check_columns(output_location, parquet.read_schema(prefix + ".parquet").names, columns)
+        return select_columns(pd.read_parquet(prefix + ".parquet", columns=columns), columns)
+    if os.path.exists(prefix + ".feather"):
+        import pyarrow
+        from pyarrow import feather
+        with pyarrow.memory_map(prefix + ".feather") as source:
+            check_columns(output_location, pyarrow.ipc.open_file(source).schema.names, columns)
+        table = feather.read_table(prefix + ".feather", columns=columns, memory_map=True).to_pandas()
+        return select_columns(table, columns)
+
+    if os.path.exists(prefix + ".npy"):
+        with open(prefix + ".columns.json", 'r') as f:
+            feature_columns = json.load(f)
+        row_columns = list(pd.read_csv(prefix + ".rows.csv", header=0, nrows=0).columns)
+        check_columns(output_location, row_columns + feature_columns, columns)
+        matrix, feature_columns = select_feature_columns(np.load(prefix + ".npy", mmap_mode='r'), feature_columns,
+                                                         columns)
+        rows = pd.read_csv(prefix + ".rows.csv", header=0,
+                           usecols=None if columns is None else [c for c in row_columns if c in columns])
+        features = pd.DataFrame(matrix, columns=feature_columns)
+    elif os.path.exists(prefix + ".npz"):
+        rows, matrix, feature_columns = load_sparse_matrix(output_location)
+        check_columns(output_location, list(rows.columns) + feature_columns, columns)
+        matrix, feature_columns = select_feature_columns(matrix.tocsc(), feature_columns, columns)
+        if dense:
+            features = pd.DataFrame(matrix.toarray(), columns=feature_columns)
+        else:
+            # Built column by column so that the implicit entries read back as zeros (DataFrame.sparse.from_spmatrix
+            # fills them with NaN in newer versions of pandas)
+            features = pd.DataFrame({column: pd.arrays.SparseArray.from_spmatrix(matrix[:, [i]])
+                                     for i, column in enumerate(feature_columns)}, columns=feature_columns)
+    else:
+        check_columns(output_location, pd.read_csv(output_location, header=0, nrows=0).columns, columns)
+        return select_columns(pd.read_csv(output_location, header=0, usecols=columns), columns)
+    return select_columns(pd.concat([rows, features], axis=1), columns)
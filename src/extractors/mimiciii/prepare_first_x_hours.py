@@ -7,23 +7,48 @@ Note that any numeric column are split into two columns containing:
    1) the average numeric values across all timepoints within the first X hours
    2) the trend of numeric values across all timepoints within the first X hours
       (trendline linear regression of that feature using least squares)
+More aggregates (eg. min, max, std, last, count) can be selected with --aggregates (see AGGREGATES in
+extractor_utils.py), which are all computed from the same pass over the event files.
 
-"""
+Several windows can be produced at once (eg. 6,12,24,48,72 hours), in which case each event file is
+only read once and every event is added to each window that it falls in.
 
-import csv
-from collections import defaultdict
-from datetime import datetime, timedelta
-import sys
+Three engines produce the same output:
+   - rows: streams the event files row by row, keeping running statistics of every (hadmid, item) group
+   - columnar: loads the event files as typed columns and aggregates each (hadmid, item) group with
+     NumPy group-by reductions a chunk of rows at a time (much faster, and only keeps running statistics of each
+     group between chunks)
+   - streaming: assumes the event files are sorted by HADM_ID and only holds one admission at a time
 
-from extractor_utils import calculate_trend
+"""
 
-def produce_output(project_dir, output_location, first_hours=24, max_rows=None):
-    #
-    # Load admissions information
-    #
+import argparse
+import csv
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from extractor_utils import CHART_COLUMNS, DEFAULT_AGGREGATES, DRUG_COLUMNS, EVENT_FILES, LAB_COLUMNS, GroupedEvents, \
+    allocate_features, calculate_hour_offsets, fill_aggregate_features, fill_grouped_aggregate_features, \
+    format_feature, get_admit_epochs, get_chart_itemid_columns, get_column_ranges, get_cutoff_timestamps, \
+    get_event_statistics, get_feature_columns, get_feature_keys, get_grouped_statistics, get_record_byte_ranges, \
+    group_rows_by_hadmid, hours_since_admit, is_after_cutoff, iterate_byte_range, iterate_columns, \
+    load_chart_mapping, load_vocabulary, merge_by_hadmid, open_text, parse_aggregates, round_exact
+from feature_store import fingerprint_admissions, get_admission_selectors, load_features, open_feature_store, \
+    save_admissions, save_features, select_admission_rows
+from matrix_io import OUTPUT_FORMATS, write_binary_output
+
+
+def load_admissions(project_dir):
+    """
+    Loads the derived admissions file into a map of hadmid -> admission row
+    """
     print("Processing derived admissions file")
     hadmid_to_admission_info = {}
-    with open(project_dir + "/admissions.derived.csv", 'r') as csv_file:
+    with open_text(project_dir + "/admissions.derived.csv") as csv_file:
         csv_reader = csv.reader(csv_file, delimiter=',')
         i = 0
         for row in csv_reader:
@@ -32,236 +57,539 @@ def produce_output(project_dir, output_location, first_hours=24, max_rows=None):
                 continue
             hadmid = row[0]
             hadmid_to_admission_info[hadmid] = row
-
-
-    #
-    # Load lab information
-    #
+    return hadmid_to_admission_info
+
+
+def add_lab_events(rows, hadmid_to_admit_epoch, hadmid_to_cutoff, windows, lab_to_column, window_to_lab_events):
+    """
+    Adds every lab event to the GroupedEvents of each window (in hours) it falls in
+
+    Events are rejected with cheap checks first (value, vocabulary, then the timestamp as a string against the
+    cutoff of the last window, see get_cutoff_timestamps) so that only the remaining ones are parsed
+    """
+    for hadmid, charttime, lab, val in rows:
+        if val == "" or lab not in lab_to_column:
+            # Skip because this is not a numeric value (or not part of the vocabulary)
+            continue
+        if is_after_cutoff(charttime, hadmid_to_cutoff[hadmid]):
+            continue
+        offset = round(hours_since_admit(hadmid_to_admit_epoch[hadmid], charttime), 3)
+        val = round(float(val), 3)
+        for window in windows:
+            if offset <= window:
+                window_to_lab_events[window].add(hadmid, lab, offset, val)
+
+
+def iterate_drug_windows(rows, hadmid_to_admit_epoch, hadmid_to_cutoff, drug_to_column, windows):
+    """
+    Yields (hadmid, drug column, window) for every window (in hours) that a prescription overlaps
+
+    Prescriptions starting after the cutoff of the last window (see get_cutoff_timestamps) are rejected without
+    parsing their dates
+    """
+    for hadmid, start, end, drug in rows:
+        if drug == "" or start == "" or end == "" or drug not in drug_to_column:
+            continue
+        if is_after_cutoff(start, hadmid_to_cutoff[hadmid]):
+            continue
+
+        admit_epoch = hadmid_to_admit_epoch[hadmid]
+        drug_start_offset = hours_since_admit(admit_epoch, start)
+        drug_end_offset = hours_since_admit(admit_epoch, end)
+        for window in windows:
+            if drug_start_offset <= window and drug_end_offset >= 0:
+                # Drug was given within the window
+                yield hadmid, drug_to_column[drug], window
+
+
+def add_drug_events(rows, hadmid_to_admit_epoch, hadmid_to_cutoff, hadmid_to_row, drug_to_column,
+                    window_to_features):
+    """
+    Marks every drug as given within each window (in hours) that its prescription overlaps (see
+    iterate_drug_windows)
+    """
+    for hadmid, column, window in iterate_drug_windows(rows, hadmid_to_admit_epoch, hadmid_to_cutoff, drug_to_column,
+                                                       window_to_features.keys()):
+        window_to_features[window][hadmid_to_row[hadmid], column] = 1
+
+
+def add_chart_events(rows, hadmid_to_admit_epoch, hadmid_to_cutoff, windows, chart_itemid_to_column,
+                     window_to_chart_events):
+    """
+    Adds every chart event (with its feature column as item) to the GroupedEvents of each window (in hours) it
+    falls in
+
+    Like add_lab_events, events are rejected with cheap checks before their timestamp is parsed
+    """
+    for hadmid, charttime, itemid, val in rows:
+        column = chart_itemid_to_column.get(itemid)
+        if column is None or val == "":
+            # Skip because this is not a chart event of the vocabulary (or not a numeric value)
+            continue
+        if is_after_cutoff(charttime, hadmid_to_cutoff[hadmid]):
+            continue
+        offset = round(hours_since_admit(hadmid_to_admit_epoch[hadmid], charttime), 3)
+        val = float(val)
+        for window in windows:
+            if offset <= window:
+                window_to_chart_events[window].add(hadmid, column, offset, val)
+
+
+def process_labs(project_dir, hadmid_to_admit_epoch, hadmid_to_row, lab_to_column, window_to_features,
+                 max_rows=None, selector=None, aggregates=DEFAULT_AGGREGATES):
+    """
+    Reads the lab file once and writes the aggregates (by default the average and trend) of every lab into the
+    features of each window (in hours) it falls in
+
+    If selector is given, only the events of the new or changed admissions of the feature store are aggregated
+    (see AdmissionSelector)
+    """
     print("Processing lab file")
+    windows = sorted(window_to_features.keys())
+    hadmid_to_cutoff = get_cutoff_timestamps(hadmid_to_admit_epoch, windows[-1])
 
-    # lab -> hadmid
-    lab_to_hadmid = defaultdict(set)
-
-    # hadmid -> lab -> labvalues
-    hadmid_to_raw_lab_info = {}
-    with open(project_dir + "/labevents.csv", 'r') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        i = 0
-        for row in csv_reader:
-            if i == 0:
-                i += 1
-                continue
-            hadmid = row[0]
-            if hadmid not in hadmid_to_raw_lab_info:
-                hadmid_to_raw_lab_info[hadmid] = defaultdict(list)
-            admittime = datetime.strptime(hadmid_to_admission_info[hadmid][1], '%Y-%m-%dT%H:%M:%S')
-            offset = (datetime.strptime(row[1], '%Y-%m-%d %H:%M:%S') - admittime) / timedelta(hours=1)
-            offset = round(offset, 3)
-            if offset <= first_hours:
-                lab = row[3]
-                val = row[6]
-                if val == "":
-                    # Skip because this is not a numeric value
-                    continue
-                val = round(float(val), 3)
-                lab_to_hadmid[lab].add(hadmid)
-                hadmid_to_raw_lab_info[hadmid][lab].append((offset, val))
-
-            if i % 100000 == 0:
-                print("   Labs processed {} events".format(i))
-
-            if max_rows is not None and i > max_rows:
-                break
-            i += 1
-
-
-    hadmid_to_processed_lab_info = {}
-    for hadmid, raw_lab_info in hadmid_to_raw_lab_info.items():
-        hadmid_row = []
-        for lab, _ in lab_to_hadmid.items():
-            if lab in raw_lab_info:
-                # Calculate average among all lab values
-                hadmid_row.append(sum([t[1] for t in raw_lab_info[lab]]) / float(len(raw_lab_info[lab])))
-                # Calculate trend over the time period
-                hadmid_row.append(calculate_trend(raw_lab_info[lab]))
-            else:
-                hadmid_row.append(0)
-                hadmid_row.append(0)
-        hadmid_to_processed_lab_info[hadmid] = hadmid_row
-
-
-    #
-    # Load prescription information
-    #
-    print("Processing prescriptions file")
-
-    all_drugs = set()
+    # window -> (hadmid, lab, offset, labvalue) events
+    window_to_lab_events = {window: GroupedEvents() for window in windows}
+    rows = iterate_columns(project_dir + "/labevents.csv", LAB_COLUMNS, "Labs", max_rows)
+    add_lab_events(select_admission_rows(rows, selector), hadmid_to_admit_epoch, hadmid_to_cutoff, windows,
+                   lab_to_column, window_to_lab_events)
 
-    # hadmid -> drug
-    hadmid_to_drug = defaultdict(set)
-    with open(project_dir + "/prescriptions.csv", 'r') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        i = 0
-        for row in csv_reader:
-            if i == 0:
-                i += 1
-                continue
-            if row[4] == "" or row[1] == "" or row[2] == "":
-                i += 1
-                continue
+    for window in windows:
+        fill_aggregate_features(window_to_features[window], hadmid_to_row, lab_to_column, window_to_lab_events[window],
+                                aggregates, window)
 
 
-            hadmid = row[0]
-            drug = row[4]
-
-            admittime = datetime.strptime(hadmid_to_admission_info[hadmid][1], '%Y-%m-%dT%H:%M:%S')
-            drug_start_offset = (datetime.strptime(row[1], '%Y-%m-%d %H:%M:%S') - admittime) / timedelta(hours=1)
-            drug_end_offset = (datetime.strptime(row[2], '%Y-%m-%d %H:%M:%S') - admittime) / timedelta(hours=1)
-            if drug_start_offset <= first_hours and drug_end_offset >= 0:
-                # Drug was given within the 24 hour window
-                all_drugs.add(drug)
-                hadmid_to_drug[hadmid].add(drug)
-
-            if i % 100000 == 0:
-                print("   Drugs processed {} events".format(i))
-            if max_rows is not None and i > max_rows:
-                break
-            i += 1
-
-    hadmid_to_processed_drug_info = {}
-    for hadmid, drugs in hadmid_to_drug.items():
-        hadmid_row = []
-        for d in all_drugs:
-            if d in drugs:
-                hadmid_row.append(1)
-            else:
-                hadmid_row.append(0)
-        hadmid_to_processed_drug_info[hadmid] = hadmid_row
+def process_prescriptions(project_dir, hadmid_to_admit_epoch, hadmid_to_row, drug_to_column, window_to_features,
+                          max_rows=None, selector=None):
+    """
+    Reads the prescriptions file once and marks every drug given within each window (in hours)
 
-    #
-    # Load chart information
-    #
+    If selector is given, only the events of the new or changed admissions of the feature store are aggregated
+    (see AdmissionSelector)
+    """
+    print("Processing prescriptions file")
+    hadmid_to_cutoff = get_cutoff_timestamps(hadmid_to_admit_epoch, max(window_to_features.keys()))
+    rows = iterate_columns(project_dir + "/prescriptions.csv", DRUG_COLUMNS, "Drugs", max_rows)
+    add_drug_events(select_admission_rows(rows, selector), hadmid_to_admit_epoch, hadmid_to_cutoff, hadmid_to_row,
+                    drug_to_column, window_to_features)
+
+
+def process_charts(project_dir, hadmid_to_admit_epoch, hadmid_to_row, chart_itemid_to_column, window_to_features,
+                   max_rows=None, selector=None, aggregates=DEFAULT_AGGREGATES):
+    """
+    Reads the chart file once and writes the aggregates (by default the average and trend) of every chart event into
+    the features of each window (in hours) it falls in. chart_itemid_to_column maps the ITEMIDs to the columns of
+    their chart event (see get_chart_itemid_columns).
+
+    If selector is given, only the events of the new or changed admissions of the feature store are aggregated
+    (see AdmissionSelector)
+    """
     print("Processing chart information file")
-
-    # chartevent -> hadmid
-    chartevent_to_hadmid = defaultdict(set)
-
-    # hadmid -> chartevent -> chartevent value
-    hadmid_to_raw_chart_info = {}
-    with open(project_dir + "/chartevents.csv", 'r') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        i = 0
-        for row in csv_reader:
-            if i == 0:
-                i += 1
-                continue
-            hadmid = row[0]
-            if hadmid not in hadmid_to_raw_chart_info:
-                hadmid_to_raw_chart_info[hadmid] = defaultdict(list)
-            admittime = datetime.strptime(hadmid_to_admission_info[hadmid][1], '%Y-%m-%dT%H:%M:%S')
-            offset = (datetime.strptime(row[1], '%Y-%m-%d %H:%M:%S') - admittime) / timedelta(hours=1)
-            offset = round(offset, 3)
-            if offset <= first_hours:
-                chartitemid = row[2]
-                if chartitemid == "220045" or chartitemid == "211":
-                    chart = "Heart Rate"
-                elif chartitemid == "618" or chartitemid == "220210":
-                    chart = "Respiratory Rate"
-                elif chartitemid == "220180" or chartitemid == "8441":
-                    chart = "Diastolic"
-                elif chartitemid == "220179" or chartitemid == "455":
-                    chart = "Systolic"
-                elif chartitemid == "220277" or chartitemid == "211":
-                    chart = "O2"
-                elif chartitemid == "223834" or chartitemid == "470":
-                    chart = "O2 Flow"
-                elif chartitemid == "223762" or chartitemid == "677":
-                    chart = "Temperature"
-
-                val = row[5]
-                if val == "":
-                    # Skip because this is not a numeric value
-                    continue
-                val = float(val)
-                chartevent_to_hadmid[chart].add(hadmid)
-                hadmid_to_raw_chart_info[hadmid][chart].append((offset, val))
-
-            if max_rows is not None and i > max_rows:
-                break
-
-            if i % 100000 == 0:
-                print("   Charts processed {} events".format(i))
-            i += 1
-
-    hadmid_to_processed_chart_info = {}
-    for hadmid, raw_chart_info in hadmid_to_raw_chart_info.items():
-        hadmid_row = []
-        for chart, _ in chartevent_to_hadmid.items():
-            if chart in raw_chart_info:
-                # Calculate average among all chart values
-                hadmid_row.append(sum([t[1] for t in raw_chart_info[chart]]) / float(len(raw_chart_info[chart])))
-                # Calculate trend over the time period
-                hadmid_row.append(calculate_trend(raw_chart_info[chart]))
+    windows = sorted(window_to_features.keys())
+    hadmid_to_cutoff = get_cutoff_timestamps(hadmid_to_admit_epoch, windows[-1])
+
+    # window -> (hadmid, chartevent column, offset, chartevent value) events
+    window_to_chart_events = {window: GroupedEvents() for window in windows}
+    rows = iterate_columns(project_dir + "/chartevents.csv", CHART_COLUMNS, "Charts", max_rows)
+    add_chart_events(select_admission_rows(rows, selector), hadmid_to_admit_epoch, hadmid_to_cutoff, windows,
+                     chart_itemid_to_column, window_to_chart_events)
+
+    for window in windows:
+        fill_aggregate_features(window_to_features[window], hadmid_to_row, None, window_to_chart_events[window],
+                                aggregates, window)
+
+
+def process_stage_block(stage, project_dir, hadmid_to_admit_epoch, hadmid_to_row, item_to_column, column_range,
+                        windows, max_rows=None, selector=None):
+    """
+    Runs one of the process_* stages (in a separate process) on features that only hold the columns of its
+    source, given by column_range. Returns (window -> those features, the selector with the fingerprints of the
+    scan).
+    """
+    start, end = column_range
+    window_to_block = {window: allocate_features(len(hadmid_to_row), end - start) for window in windows}
+    stage(project_dir, hadmid_to_admit_epoch, hadmid_to_row,
+          {item: column - start for item, column in item_to_column.items()}, window_to_block, max_rows,
+          selector)
+    return window_to_block, selector
+
+
+def init_shard_worker(hadmid_to_admit_epoch, windows, lab_to_column, drug_to_column, chart_itemid_to_column):
+    global shard_worker_state
+    shard_worker_state = (hadmid_to_admit_epoch, get_cutoff_timestamps(hadmid_to_admit_epoch, windows[-1]), windows,
+                          lab_to_column, drug_to_column, chart_itemid_to_column)
+
+
+def process_shard(shard):
+    """
+    Aggregates the events of a byte range of one of the event files (in a worker process, see init_shard_worker)
+
+    Returns the partial statistics of the shard:
+       - labs: window -> GroupedEvents of the labs
+       - drugs: window -> set of (hadmid, drug column) of the drugs given within the window
+       - charts: window -> GroupedEvents of the chart events
+    """
+    hadmid_to_admit_epoch, hadmid_to_cutoff, windows, lab_to_column, drug_to_column, chart_itemid_to_column = \
+        shard_worker_state
+    name, path, columns, start, end = shard
+    rows = iterate_byte_range(path, start, end, columns)
+    if name == "Labs":
+        window_to_lab_events = {window: GroupedEvents() for window in windows}
+        add_lab_events(rows, hadmid_to_admit_epoch, hadmid_to_cutoff, windows, lab_to_column, window_to_lab_events)
+        return window_to_lab_events
+    if name == "Drugs":
+        window_to_drugs = {window: set() for window in windows}
+        for hadmid, column, window in iterate_drug_windows(rows, hadmid_to_admit_epoch, hadmid_to_cutoff,
+                                                           drug_to_column, windows):
+            window_to_drugs[window].add((hadmid, column))
+        return window_to_drugs
+    window_to_chart_events = {window: GroupedEvents() for window in windows}
+    add_chart_events(rows, hadmid_to_admit_epoch, hadmid_to_cutoff, windows, chart_itemid_to_column,
+                     window_to_chart_events)
+    return window_to_chart_events
+
+
+def process_events_parallel(project_dir, hadmid_to_admit_epoch, hadmid_to_row, lab_to_column, drug_to_column,
+                            chart_itemid_to_column, window_to_features, jobs, aggregates=DEFAULT_AGGREGATES):
+    """
+    Parallel version of the process_* stages
+
+    Every event file is split into byte ranges of whole records and admissions (see get_record_byte_ranges) that are
+    read by a pool of jobs processes. The running statistics of the shards are then merged in file order (see
+    GroupStatistics.merge), so the output is the same as process_labs, process_prescriptions and process_charts.
+    """
+    windows = sorted(window_to_features.keys())
+    shards = []
+    for name, file_name, columns in EVENT_FILES:
+        path = project_dir + "/" + file_name
+        shards.extend((name, path, columns, start, end) for start, end in get_record_byte_ranges(path, jobs, True))
+
+    print("Processing lab, prescriptions, and chart information files in {} shards with {} jobs".format(
+        len(shards), jobs))
+    window_to_lab_statistics = {window: get_event_statistics([], [], [], window) for window in windows}
+    window_to_chart_statistics = {window: get_event_statistics([], [], [], window) for window in windows}
+    with Pool(jobs, initializer=init_shard_worker,
+              initargs=(hadmid_to_admit_epoch, windows, lab_to_column, drug_to_column, chart_itemid_to_column)) as pool:
+        for (name, path, columns, start, end), result in zip(shards, pool.imap(process_shard, shards)):
+            if start is None:
+                print("   {} processed (compressed, so in a single shard)".format(name))
+            else:
+                print("   {} processed bytes {} to {}".format(name, start, end))
+            if name == "Labs":
+                for window in windows:
+                    window_to_lab_statistics[window] = window_to_lab_statistics[window].merge(get_grouped_statistics(
+                        window_to_features[window], hadmid_to_row, lab_to_column, result[window], window))
+            elif name == "Drugs":
+                for window in windows:
+                    for hadmid, column in result[window]:
+                        window_to_features[window][hadmid_to_row[hadmid], column] = 1
             else:
-                hadmid_row.append(0)
-                hadmid_row.append(0)
-        hadmid_to_processed_chart_info[hadmid] = hadmid_row
+                for window in windows:
+                    window_to_chart_statistics[window] = window_to_chart_statistics[window].merge(
+                        get_grouped_statistics(window_to_features[window], hadmid_to_row, None, result[window], window))
+
+    for window in windows:
+        fill_grouped_aggregate_features(window_to_features[window], window_to_lab_statistics[window], aggregates)
+        fill_grouped_aggregate_features(window_to_features[window], window_to_chart_statistics[window], aggregates)
+
+
+def iterate_event_chunks(path, columns, names, max_rows=None, chunk_rows=1000000):
+    """
+    Yields the given columns (by header name) of an event file as typed columns renamed to names, about chunk_rows
+    rows at a time. Value columns ("val") are parsed exactly as float() would parse them.
+
+    The event files are sorted by HADM_ID (the first column), so the events of the last admission of a chunk are
+    carried over to the next one. Every chunk then holds all of the events of its admissions, and the statistics of
+    an admission are summed in file order as with the rows engine instead of being merged across chunks.
+    """
+    column_to_name = dict(zip(columns, names))
+    carried = None
+    with open_text(path) as csv_file:
+        reader = pd.read_csv(csv_file, usecols=columns, header=0, nrows=None if max_rows is None else max_rows + 1,
+                             dtype={column: str for column, name in column_to_name.items() if name != "val"},
+                             keep_default_na=False,
+                             na_values={column: [""] for column, name in column_to_name.items() if name == "val"},
+                             float_precision="round_trip", chunksize=chunk_rows)
+        for events in reader:
+            events = events[columns].rename(columns=column_to_name)
+            if carried is not None:
+                events = pd.concat([carried, events], ignore_index=True)
+            hadmids = events[names[0]].to_numpy()
+            last_start = len(hadmids) - int(np.argmax(hadmids[::-1] != hadmids[-1])) if len(hadmids) else 0
+            if last_start == len(hadmids):
+                # Every event of the chunk belongs to the same admission
+                last_start = 0
+            carried = events.iloc[last_start:]
+            if last_start > 0:
+                yield events.iloc[:last_start]
+    if carried is not None and len(carried) > 0:
+        yield carried
+
+
+def fill_window_statistics(window_to_features, window_to_statistics, rows, columns, offsets, vals):
+    """
+    Merges the events of a chunk into the GroupStatistics of each window (in hours) they fall in
+    """
+    for window, features in window_to_features.items():
+        mask = offsets <= window
+        chunk_statistics = get_event_statistics(get_feature_keys(features, rows[mask], columns[mask]), offsets[mask],
+                                                vals[mask], window)
+        window_to_statistics[window] = window_to_statistics[window].merge(chunk_statistics)
+
+
+def process_labs_columnar(project_dir, hadmid_to_admit_epoch, hadmid_to_row, lab_to_column, window_to_features,
+                          max_rows=None, selector=None, aggregates=DEFAULT_AGGREGATES):
+    """
+    Columnar version of process_labs
+
+    The lab file is read a chunk at a time, and only the running statistics of every group are kept between chunks
+    """
+    print("Processing lab file (columnar)")
+    window_to_statistics = {window: get_event_statistics([], [], [], window) for window in window_to_features}
+    for labs in iterate_event_chunks(project_dir + "/labevents.csv", LAB_COLUMNS, ["hadmid", "charttime", "lab", "val"],
+                                     max_rows):
+        if selector is not None:
+            labs = selector.select_events(labs)
+        labs = labs[labs["val"].notna() & labs["lab"].isin(lab_to_column.keys())]
+        rows = labs["hadmid"].map(hadmid_to_row).to_numpy()
+        columns = labs["lab"].map(lab_to_column).to_numpy()
+        offsets = round_exact(calculate_hour_offsets(labs["hadmid"].map(hadmid_to_admit_epoch).to_numpy(),
+                                                     labs["charttime"].to_numpy()))
+        vals = round_exact(labs["val"].to_numpy())
+        fill_window_statistics(window_to_features, window_to_statistics, rows, columns, offsets, vals)
+
+    for window, features in window_to_features.items():
+        fill_grouped_aggregate_features(features, window_to_statistics[window], aggregates)
+
+
+def process_prescriptions_columnar(project_dir, hadmid_to_admit_epoch, hadmid_to_row, drug_to_column,
+                                   window_to_features, max_rows=None, selector=None):
+    """
+    Columnar version of process_prescriptions
+    """
+    print("Processing prescriptions file (columnar)")
+    for prescriptions in iterate_event_chunks(project_dir + "/prescriptions.csv", DRUG_COLUMNS,
+                                              ["hadmid", "start", "end", "drug"], max_rows):
+        if selector is not None:
+            prescriptions = selector.select_events(prescriptions)
+        prescriptions = prescriptions[(prescriptions["drug"] != "") & (prescriptions["start"] != "") &
+                                      (prescriptions["end"] != "") & prescriptions["drug"].isin(drug_to_column.keys())]
+        admit_epochs = prescriptions["hadmid"].map(hadmid_to_admit_epoch).to_numpy()
+        drug_start_offsets = calculate_hour_offsets(admit_epochs, prescriptions["start"].to_numpy())
+        drug_end_offsets = calculate_hour_offsets(admit_epochs, prescriptions["end"].to_numpy())
+        rows = prescriptions["hadmid"].map(hadmid_to_row).to_numpy()
+        columns = prescriptions["drug"].map(drug_to_column).to_numpy()
+
+        for window, features in window_to_features.items():
+            # Drug was given within the window
+            mask = (drug_start_offsets <= window) & (drug_end_offsets >= 0)
+            features[rows[mask], columns[mask]] = 1
+
+
+def process_charts_columnar(project_dir, hadmid_to_admit_epoch, hadmid_to_row, chart_itemid_to_column,
+                            window_to_features, max_rows=None, selector=None, aggregates=DEFAULT_AGGREGATES):
+    """
+    Columnar version of process_charts
+
+    Like process_labs_columnar, the chart file is read a chunk at a time
+    """
+    print("Processing chart information file (columnar)")
+    window_to_statistics = {window: get_event_statistics([], [], [], window) for window in window_to_features}
+    for charts in iterate_event_chunks(project_dir + "/chartevents.csv", CHART_COLUMNS,
+                                       ["hadmid", "charttime", "itemid", "val"], max_rows):
+        if selector is not None:
+            charts = selector.select_events(charts)
+        charts = charts[charts["val"].notna() & charts["itemid"].isin(chart_itemid_to_column.keys())]
+        rows = charts["hadmid"].map(hadmid_to_row).to_numpy()
+        columns = charts["itemid"].map(chart_itemid_to_column).to_numpy()
+        offsets = round_exact(calculate_hour_offsets(charts["hadmid"].map(hadmid_to_admit_epoch).to_numpy(),
+                                                     charts["charttime"].to_numpy()))
+        vals = charts["val"].to_numpy()
+        fill_window_statistics(window_to_features, window_to_statistics, rows, columns, offsets, vals)
+
+    for window, features in window_to_features.items():
+        fill_grouped_aggregate_features(features, window_to_statistics[window], aggregates)
+
+
+def write_output(output_location, hadmid_to_admission_info, columns, features, output_format="csv"):
+    """
+    Joins the admissions with their lab, drug, and chart features of a single window back into one file
+    (or into one of the binary formats of matrix_io)
+    """
+    #### Build Headers ####
+    headers = [
+        "status",
+        "los",
+        "age",
+        "gender",
+        "insurance",
+        "language",
+        "religion",
+        "marital_status",
+        "ethnicity"
+    ]
+
+    #### Derive Content ####
+    def get_admission_row(row):
+        output_row = [row[9], round(float(row[10]), 3)]
+        output_row.extend(row[2:9])
+        return output_row
+
+    if output_format != "csv":
+        admission_rows = [get_admission_row(row) for row in hadmid_to_admission_info.values()]
+        write_binary_output(output_location, headers, admission_rows, columns, features, output_format)
+        return
+
+    with open_text(output_location, 'w') as w_file:
+        csv_writer = csv.writer(w_file, delimiter=',')
+        csv_writer.writerow(headers + columns)
+        for row, feature_row in zip(hadmid_to_admission_info.values(), features):
+            output_row = get_admission_row(row)
+            output_row.extend([format_feature(f) for f in feature_row.tolist()])
+            csv_writer.writerow(output_row)
+
 
+def produce_outputs(project_dir, window_to_output_location, max_rows=None, engine="rows", vocabulary_location=None,
+                    output_format="csv", jobs=1, parallel_stages=False, store_location=None,
+                    chart_mapping_location=None, aggregates=DEFAULT_AGGREGATES):
+    """
+    Produces one output file per window (in hours) while reading each of the event files only once
+
+    eg. {24: "first24hours.csv", 48: "first48hours.csv"}
+
+    The columns come from the vocabulary persisted at vocabulary_location (see load_vocabulary), so that they are
+    fixed before any event is aggregated and stay in the same order across runs
+
+    With jobs > 1, the rows engine splits the event files into shards that are aggregated by that many processes.
+    Otherwise, with parallel_stages, the rows and columnar engines process the lab, prescriptions, and chart files at
+    the same time in separate processes.
+
+    With a store_location, the rows and columnar engines only aggregate the events of the admissions that are new or
+    changed since the last run and take the features of the others from the store (see feature_store.py)
+
+    Chart events are identified by the ITEMIDs of CHART_ITEMID_TO_CHART, extended by the mapping file at
+    chart_mapping_location if given (see load_chart_mapping)
+
+    Every lab and chart event has a feature column per aggregate (see AGGREGATES)
+    """
+    windows = sorted(window_to_output_location.keys())
+    hadmid_to_admission_info = load_admissions(project_dir)
+    hadmid_to_admit_epoch = get_admit_epochs(hadmid_to_admission_info)
+    hadmid_to_row = {hadmid: row for row, hadmid in enumerate(hadmid_to_admission_info)}
+    chart_itemid_to_chart = load_chart_mapping(chart_mapping_location)
+    columns, lab_to_column, drug_to_column, chart_to_column = \
+        get_feature_columns(load_vocabulary(project_dir, vocabulary_location, chart_itemid_to_chart), aggregates)
+    chart_itemid_to_column = get_chart_itemid_columns(chart_itemid_to_chart, chart_to_column)
+    window_to_features = {
+        window: allocate_features(len(hadmid_to_row), len(columns), on_disk=engine == "streaming")
+        for window in windows
+    }
+
+    selectors = [None] * len(EVENT_FILES)
+    if store_location is not None:
+        connection = open_feature_store(store_location, {"windows": windows, "columns": columns,
+                                                         "charts": chart_itemid_to_chart, "engine": engine})
+        hadmid_to_fingerprint = fingerprint_admissions(hadmid_to_admission_info)
+        selectors = get_admission_selectors(connection, project_dir, hadmid_to_fingerprint)
+
+    column_ranges = get_column_ranges(lab_to_column, drug_to_column, chart_to_column, aggregates)
+    if engine == "streaming":
+        process_events_streaming(project_dir, hadmid_to_admit_epoch, hadmid_to_row, lab_to_column, drug_to_column,
+                                 chart_itemid_to_column, window_to_features, max_rows, aggregates)
+    elif engine == "rows" and jobs > 1 and max_rows is None:
+        process_events_parallel(project_dir, hadmid_to_admit_epoch, hadmid_to_row, lab_to_column, drug_to_column,
+                                chart_itemid_to_column, window_to_features, jobs, aggregates)
+    else:
+        if engine == "columnar":
+            stages = [partial(process_labs_columnar, aggregates=aggregates), process_prescriptions_columnar,
+                      partial(process_charts_columnar, aggregates=aggregates)]
+        else:
+            stages = [partial(process_labs, aggregates=aggregates), process_prescriptions,
+                      partial(process_charts, aggregates=aggregates)]
+        item_to_columns = [lab_to_column, drug_to_column, chart_itemid_to_column]
+        # The stages of the files that did not change since the last run of the store are skipped
+        indices = [i for i, selector in enumerate(selectors) if selector is None or not selector.unchanged]
+        if parallel_stages:
+            # The stages are independent until the join, so each one fills its own block of columns
+            with ProcessPoolExecutor(len(stages)) as executor:
+                futures = [
+                    executor.submit(process_stage_block, stages[i], project_dir, hadmid_to_admit_epoch, hadmid_to_row,
+                                    item_to_columns[i], column_ranges[i], windows, max_rows, selectors[i])
+                    for i in indices
+                ]
+                for future, i in zip(futures, indices):
+                    window_to_block, selectors[i] = future.result()
+                    start, end = column_ranges[i]
+                    for window, block in window_to_block.items():
+                        window_to_features[window][:, start:end] = block
+        else:
+            for i in indices:
+                stages[i](project_dir, hadmid_to_admit_epoch, hadmid_to_row, item_to_columns[i], window_to_features,
+                          max_rows, selectors[i])
+
+    if store_location is not None:
+        print("Updating the feature store")
+        changed_hadmids = set()
+        for selector, (start, end) in zip(selectors, column_ranges):
+            hadmids = selector.get_changed_hadmids()
+            save_features(connection, selector, hadmids, (
+                (hadmid, window, window_to_features[window][hadmid_to_row[hadmid], start:end])
+                for window in windows for hadmid in hadmids
+            ), columns[start:end])
+            changed_hadmids |= hadmids
+        save_admissions(connection, hadmid_to_fingerprint)
+        print("Processed {} new or changed admissions out of {}".format(len(changed_hadmids), len(hadmid_to_row)))
+        column_to_index = {column: index for index, column in enumerate(columns)}
+        for hadmid, window, index, value in load_features(connection, column_to_index):
+            window_to_features[window][hadmid_to_row[hadmid], index] = value
+        connection.close()
 
     #
-    # Join the events back into one file
+    # Join the events back into one file per window
     #
-    print("Joining all events")
-
-    with open(output_location, 'w') as w_file:
-        csv_writer = csv.writer(w_file, delimiter=',')
-
-        #### Build Headers ####
-        headers = [
-            "status",
-            "los",
-            "age",
-            "gender",
-            "insurance",
-            "language",
-            "religion",
-            "marital_status",
-            "ethnicity"
-        ]
-
-        for l in lab_to_hadmid.keys():
-            headers.append(l)
-            headers.append(l + "-trend")
-
-        for d in all_drugs:
-            headers.append(d)
-
-        for c in chartevent_to_hadmid.keys():
-            headers.append(c)
-            headers.append(c + "-trend")
-
-        csv_writer.writerow(headers)
-
-
-        #### Derive Content ####
-        for hadmid, row in hadmid_to_admission_info.items():
-            output_row = [row[9], round(float(row[10]), 3)]
-            output_row.extend(row[2:9])
-            labevent_row = hadmid_to_processed_lab_info[hadmid] if hadmid in hadmid_to_processed_lab_info else \
-                [0 for _ in range(2*len(lab_to_hadmid.keys()))]
-            output_row.extend(labevent_row)
-            drug_row = hadmid_to_processed_drug_info[hadmid] if hadmid in hadmid_to_processed_drug_info else \
-                [0 for _ in range(len(all_drugs))]
-            output_row.extend(drug_row)
-            chartevent_row = hadmid_to_processed_chart_info[hadmid] if hadmid in hadmid_to_processed_chart_info else \
-                [0 for _ in range(2*len(chartevent_to_hadmid.keys()))]
-            output_row.extend(chartevent_row)
-
-            for i in range(len(output_row)):
-                if isinstance(output_row[i], float):
-                    output_row[i] = round(output_row[i], 3)
-
-            csv_writer.writerow(output_row)
+    for window in windows:
+        print("Joining all events for the first {} hours".format(window))
+        write_output(window_to_output_location[window], hadmid_to_admission_info, columns,
+                     window_to_features[window], output_format)
+
+
+def process_events_streaming(project_dir, hadmid_to_admit_epoch, hadmid_to_row, lab_to_column, drug_to_column,
+                             chart_itemid_to_column, window_to_features, max_rows=None, aggregates=DEFAULT_AGGREGATES):
+    """
+    Streaming version of the process_* stages for event files sorted by HADM_ID (as exported by extract_bigquery.sql)
+
+    The lab, prescription, and chart files are merge-joined one admission at a time. The features of each admission
+    are written as soon as its events end (into features backed by temporary files), so memory stays bounded by a
+    single admission no matter how large the event files are.
+    """
+    windows = sorted(window_to_features.keys())
+    hadmid_to_cutoff = get_cutoff_timestamps(hadmid_to_admit_epoch, windows[-1])
+
+    print("Processing lab, prescriptions, and chart information files (sorted by HADM_ID)")
+    sources = [
+        group_rows_by_hadmid(iterate_columns(project_dir + "/" + file_name, columns, name, max_rows))
+        for name, file_name, columns in EVENT_FILES
+    ]
+    for hadmid, (lab_rows, drug_rows, chart_rows) in merge_by_hadmid(hadmid_to_row.keys(), *sources):
+        window_to_lab_events = {window: GroupedEvents() for window in windows}
+        window_to_chart_events = {window: GroupedEvents() for window in windows}
+        add_lab_events(lab_rows, hadmid_to_admit_epoch, hadmid_to_cutoff, windows, lab_to_column,
+                       window_to_lab_events)
+        add_drug_events(drug_rows, hadmid_to_admit_epoch, hadmid_to_cutoff, hadmid_to_row, drug_to_column,
+                        window_to_features)
+        add_chart_events(chart_rows, hadmid_to_admit_epoch, hadmid_to_cutoff, windows, chart_itemid_to_column,
+                         window_to_chart_events)
+        for window, features in window_to_features.items():
+            fill_aggregate_features(features, hadmid_to_row, lab_to_column, window_to_lab_events[window], aggregates,
+                                    window)
+            fill_aggregate_features(features, hadmid_to_row, None, window_to_chart_events[window], aggregates, window)
+
+
+def produce_output(project_dir, output_location, first_hours=24, max_rows=None, engine="rows",
+                   vocabulary_location=None, output_format="csv", jobs=1, parallel_stages=False, store_location=None,
+                   chart_mapping_location=None, aggregates=DEFAULT_AGGREGATES):
+    produce_outputs(project_dir, {first_hours: output_location}, max_rows, engine, vocabulary_location, output_format,
+                    jobs, parallel_stages, store_location, chart_mapping_location, aggregates)
 
 
 ########################################################################
@@ -286,8 +614,46 @@ def produce_output(project_dir, output_location, first_hours=24, max_rows=None):
 # 100087,2126-11-01 17:49:00,220045,Heart Rate,78,78,bpm,0
 # 100087,2126-11-01 17:51:00,220180,Non Invasive Blood Pressure diastolic,87,87,mmHg,0
 
-project_dir = sys.argv[1]
-output_location = sys.argv[2]
-first_hours = int(sys.argv[3]) if len(sys.argv) > 3 else 24
-max_lines = int(sys.argv[4]) if len(sys.argv) > 4 else None
-produce_output(project_dir, output_location, first_hours, max_lines)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("project_dir")
+    parser.add_argument("output_location",
+                        help='must contain "{}" (eg. first{}hours.csv) when more than one window is given')
+    parser.add_argument("first_hours", nargs="?", default="24", help="eg. 24 or 6,12,24,48,72")
+    parser.add_argument("max_lines", nargs="?", type=int, default=None)
+    parser.add_argument("--engine", choices=["rows", "columnar", "streaming"], default="rows",
+                        help="streaming requires the event files to be sorted by HADM_ID")
+    parser.add_argument("--vocabulary", default=None,
+                        help="JSON file of the lab, drug, and chart columns (created on the first run if missing)")
+    parser.add_argument("--chart-mapping", default=None,
+                        help="JSON (ITEMID -> chart name) or CSV (ITEMID,CONCEPT) file of chart ITEMIDs to add to the "
+                             "built-in mapping")
+    parser.add_argument("--aggregates", type=parse_aggregates, default=",".join(DEFAULT_AGGREGATES),
+                        help="comma-separated aggregates of every lab and chart event (eg. mean,trend,min,max,std,"
+                             "first,last,count,time_since_last)")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="csv",
+                        help="binary formats are described in matrix_io.py")
+    parser.add_argument("--parallel-stages", action="store_true",
+                        help="process the lab, prescriptions, and chart files at the same time")
+    parser.add_argument("--store", default=None,
+                        help="SQLite file of the features of every admission, so that later runs only process the "
+                             "admissions whose events changed (rows and columnar engines, events sorted by HADM_ID)")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of processes aggregating shards of the event files (rows engine only)")
+    args = parser.parse_args()
+    if args.jobs > 1 and (args.engine != "rows" or args.max_lines is not None):
+        parser.error("--jobs is only supported by the rows engine without max_lines")
+    if args.parallel_stages and (args.engine == "streaming" or args.jobs > 1):
+        parser.error("--parallel-stages is only supported by the rows and columnar engines without --jobs")
+    if args.store is not None and (args.engine == "streaming" or args.jobs > 1 or args.max_lines is not None):
+        parser.error("--store is only supported by the rows and columnar engines without --jobs or max_lines")
+
+    first_hours = [int(h) for h in args.first_hours.split(",")]
+    if len(first_hours) == 1:
+        produce_output(args.project_dir, args.output_location, first_hours[0], args.max_lines, args.engine,
+                       args.vocabulary, args.format, args.jobs, args.parallel_stages,
+                       args.store, args.chart_mapping, args.aggregates)
+    else:
+        produce_outputs(args.project_dir, {h: args.output_location.format(h) for h in first_hours}, args.max_lines,
+                        args.engine, args.vocabulary, args.format, args.jobs, args.parallel_stages,
+                        args.store, args.chart_mapping, args.aggregates)
@@ -6,6 +6,8 @@ Note that any numeric column are split into two columns containing:
    1) the average numeric values across all timepoints within the first X hours
    2) the trend of numeric values across all timepoints within the first X hours
       (trendline linear regression of that feature using least squares)
+More aggregates (eg. min, max, std, last, count) can be selected with --aggregates (see AGGREGATES in
+extractor_utils.py), which are all computed from the same pass over the event files.
 
 This means that a single patient who stays five days in the ICU will have five separate
 rows in this joined dataset. The LOS will likewise decrement by one for each day that
@@ -16,21 +18,28 @@ Example Columns:
 
 """
 
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import csv
-from collections import defaultdict
-from datetime import datetime, timedelta
-import sys
+from functools import partial
 import math
 
-from extractor_utils import calculate_trend
+from extractor_utils import CHART_COLUMNS, DEFAULT_AGGREGATES, DRUG_COLUMNS, EVENT_FILES, LAB_COLUMNS, GroupedEvents, \
+    allocate_features, fill_aggregate_features, format_feature, get_admit_epochs, get_chart_itemid_columns, \
+    get_column_ranges, get_feature_columns, group_rows_by_hadmid, hours_since_admit, iterate_columns, \
+    load_chart_mapping, load_vocabulary, merge_by_hadmid, open_text, parse_aggregates, parse_epoch_seconds
+from feature_store import fingerprint_admissions, get_admission_selectors, load_features, open_feature_store, \
+    save_admissions, save_features, select_admission_rows
+from matrix_io import OUTPUT_FORMATS, write_binary_output, write_tensor_output
 
-def produce_output(project_dir, output_location, sample_first_only):
-    #
-    # Load admissions information
-    #
+
+def load_admissions(project_dir, sample_first_only=False):
+    """
+    Loads the derived admissions file into a map of hadmid -> admission row
+    """
     print("Processing derived admissions file")
     hadmid_to_admission_info = {}
-    with open(project_dir + "/admissions.derived.csv", 'r') as csv_file:
+    with open_text(project_dir + "/admissions.derived.csv") as csv_file:
         csv_reader = csv.reader(csv_file, delimiter=',')
         i = 0
         for row in csv_reader:
@@ -42,292 +51,359 @@ def produce_output(project_dir, output_location, sample_first_only):
                 hadmid_to_admission_info[hadmid] = row
             if sample_first_only:
                 break
+    return hadmid_to_admission_info
 
-    #
-    # Load lab information
-    #
-    print("Processing lab file")
-
-    first_sample_hamid = None
-
-    # lab -> hadmid
-    lab_to_hadmid = defaultdict(set)
-
-    # hadmid -> time -> lab -> labvalues
-    hadmid_to_raw_lab_info = {}
-    with open(project_dir + "/labevents.csv", 'r') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        i = 0
-        for row in csv_reader:
-            if i == 0:
-                i += 1
-                continue
-
-            if sample_first_only and first_sample_hamid is not None and first_sample_hamid != row[0]:
-                break
-            elif sample_first_only and first_sample_hamid is None:
-                first_sample_hamid = row[0]
 
-            hadmid = row[0]
+def get_timestep_rows(hadmid_to_admission_info):
+    """
+    Returns a map of (hadmid, day) -> output row, with a row for every day of the length of stay of each admission
+    """
+    timestep_to_row = {}
+    for hadmid, row in hadmid_to_admission_info.items():
+        for day in range(int(float(row[10]))):
+            timestep_to_row[(hadmid, day)] = len(timestep_to_row)
+    return timestep_to_row
 
-            admittime = datetime.strptime(hadmid_to_admission_info[hadmid][1], '%Y-%m-%dT%H:%M:%S')
-            offset = (datetime.strptime(row[1], '%Y-%m-%d %H:%M:%S') - admittime) / timedelta(hours=1)
-            offset = round(offset, 3)
-            days_since_admittance = math.floor(offset / 24) + 1
 
-            if hadmid not in hadmid_to_raw_lab_info:
-                hadmid_to_raw_lab_info[hadmid] = {}
-            if days_since_admittance not in hadmid_to_raw_lab_info[hadmid]:
-                hadmid_to_raw_lab_info[hadmid][days_since_admittance] = defaultdict(list)
+def get_day_end(timestep):
+    """
+    Returns the offset (in hours since admittance) at which the day of a (hadmid, day) timestep ends
+    """
+    return timestep[1] * 24
 
-            lab = row[3]
-            val = row[6]
-            if val == "":
-                # Skip because this is not a numeric value
-                continue
-            val = round(float(val), 3)
-            lab_to_hadmid[lab].add(hadmid)
-            hadmid_to_raw_lab_info[hadmid][days_since_admittance][lab].append((offset, val))
-
-            if i % 100000 == 0:
-                print("   Labs processed {} events".format(i))
-            i += 1
-
-    hadmid_to_time_to_processed_lab_info = {}
-    for hadmid, day_offset_map in hadmid_to_raw_lab_info.items():
-        hadmid_to_time_to_processed_lab_info[hadmid] = {}
-        for day_offset, raw_lab_info in day_offset_map.items():
-            hadmid_row = []
-            for lab, _ in lab_to_hadmid.items():
-                if lab in raw_lab_info:
-                    # Calculate average among all lab values
-                    hadmid_row.append(sum([t[1] for t in raw_lab_info[lab]]) / float(len(raw_lab_info[lab])))
-                    # Calculate trend over the time period
-                    hadmid_row.append(calculate_trend(raw_lab_info[lab]))
-                else:
-                    hadmid_row.append(0)
-                    hadmid_row.append(0)
-            hadmid_to_time_to_processed_lab_info[hadmid][day_offset] = hadmid_row
 
+def open_rows(path, columns, name, sample_first_only=False):
+    rows = iterate_columns(path, columns, name)
+    return first_admission_only(rows) if sample_first_only else rows
 
-    #
-    # Load prescription information
-    #
-    print("Processing prescriptions file")
 
-    all_drugs = set()
+def first_admission_only(rows):
+    """
+    Yields only the rows of the first admission (assumes the rows are sorted by HADM_ID)
+    """
     first_sample_hamid = None
+    for row in rows:
+        if first_sample_hamid is not None and first_sample_hamid != row[0]:
+            break
+        first_sample_hamid = row[0]
+        yield row
+
+
+def add_lab_events(rows, hadmid_to_admit_epoch, lab_to_column, lab_events):
+    """
+    Adds every lab event to the GroupedEvents, keyed by the (hadmid, day since admittance) it falls in
+    """
+    for hadmid, charttime, lab, val in rows:
+        if val == "" or lab not in lab_to_column:
+            # Skip because this is not a numeric value (or not part of the vocabulary)
+            continue
+        offset = round(hours_since_admit(hadmid_to_admit_epoch[hadmid], charttime), 3)
+        days_since_admittance = math.floor(offset / 24) + 1
+        val = round(float(val), 3)
+
+        lab_events.add((hadmid, days_since_admittance), lab, offset, val)
+
+
+def add_drug_events(rows, hadmid_to_admit_epoch, drug_to_column, hadmid_to_drug_intervals):
+    """
+    Adds the days (since admittance) that every prescription covers as a (first day, end day, drug column) interval
+    of its admission (see fill_drug_intervals)
+    """
+    for hadmid, start, end, drug in rows:
+        if drug == "" or start == "" or end == "" or drug not in drug_to_column:
+            continue
+
+        admit_epoch = hadmid_to_admit_epoch[hadmid]
+        # Seconds since admittance
+        drug_start = max(parse_epoch_seconds(start) - admit_epoch, 0)
+        drug_end = parse_epoch_seconds(end) - admit_epoch
+        if drug_start >= drug_end:
+            continue
+
+        # Drug was administered on the day it started and on the day of every following 24 hours before it ended
+        first_day = drug_start // 86400
+        num_days = -((drug_start - drug_end) // 86400)
+        if hadmid not in hadmid_to_drug_intervals:
+            hadmid_to_drug_intervals[hadmid] = []
+        hadmid_to_drug_intervals[hadmid].append((first_day, first_day + num_days, drug_to_column[drug]))
+
+
+def get_admission_rows(timestep_to_row):
+    """
+    Returns a map of hadmid -> (first output row, number of days) of every admission (see get_timestep_rows)
+    """
+    hadmid_to_rows = {}
+    for (hadmid, day), row in timestep_to_row.items():
+        if day == 0:
+            hadmid_to_rows[hadmid] = (row, 1)
+        else:
+            hadmid_to_rows[hadmid] = (hadmid_to_rows[hadmid][0], day + 1)
+    return hadmid_to_rows
+
+
+def fill_drug_intervals(features, hadmid_to_rows, hadmid_to_drug_intervals):
+    """
+    Marks every drug as given on each day of its intervals within the length of stay of the admission
+    """
+    for hadmid, drug_intervals in hadmid_to_drug_intervals.items():
+        if hadmid not in hadmid_to_rows:
+            continue
+        first_row, num_days = hadmid_to_rows[hadmid]
+        for first_day, end_day, column in drug_intervals:
+            if first_day < num_days:
+                features[first_row + first_day:first_row + min(end_day, num_days), column] = 1
+
+
+def add_chart_events(rows, hadmid_to_admit_epoch, chart_itemid_to_column, chart_events):
+    """
+    Adds every chart event (with its feature column as item) to the GroupedEvents, keyed by the (hadmid, day since
+    admittance) it falls in
+    """
+    for hadmid, charttime, itemid, val in rows:
+        column = chart_itemid_to_column.get(itemid)
+        if column is None or val == "":
+            # Skip because this is not a chart event of the vocabulary (or not a numeric value)
+            continue
+        offset = round(hours_since_admit(hadmid_to_admit_epoch[hadmid], charttime), 3)
+        days_since_admittance = math.floor(offset / 24) + 1
+        val = float(val)
+
+        chart_events.add((hadmid, days_since_admittance), column, offset, val)
+
+
+def process_labs(project_dir, hadmid_to_admit_epoch, timestep_to_row, lab_to_column, features,
+                 sample_first_only=False, selector=None, aggregates=DEFAULT_AGGREGATES):
+    """
+    Reads the lab file and writes the daily aggregates (by default the average and trend) of every lab into the
+    features
+
+    If selector is given, only the events of the new or changed admissions of the feature store are aggregated
+    (see AdmissionSelector)
+    """
+    print("Processing lab file")
 
-    # hadmid -> days_since_admittance -> drug
-    hadmid_to_time_to_drug = defaultdict(set)
-    with open(project_dir + "/prescriptions.csv", 'r') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        i = 0
-        for row in csv_reader:
-            if i == 0:
-                i += 1
-                continue
-            if row[4] == "" or row[1] == "" or row[2] == "":
-                i += 1
-                continue
-
-
-            if sample_first_only and first_sample_hamid is not None and first_sample_hamid != row[0]:
-                break
-            elif sample_first_only and first_sample_hamid is None:
-                first_sample_hamid = row[0]
-
-            hadmid = row[0]
-            drug = row[4]
-
-            admittime = datetime.strptime(hadmid_to_admission_info[hadmid][1], '%Y-%m-%dT%H:%M:%S')
-            drug_start_offset = (datetime.strptime(row[1], '%Y-%m-%d %H:%M:%S') - admittime) / timedelta(hours=1)
-            drug_end_offset = (datetime.strptime(row[2], '%Y-%m-%d %H:%M:%S') - admittime) / timedelta(hours=1)
-
-            all_drugs.add(drug)
-            hour_offset = max(drug_start_offset, 0)
-            while hour_offset < drug_end_offset:
-                # Drug was administered on this relative date
-                day_offset = int(hour_offset / 24)
-                if hadmid not in hadmid_to_time_to_drug:
-                    hadmid_to_time_to_drug[hadmid] = {}
-                if day_offset not in hadmid_to_time_to_drug[hadmid]:
-                    hadmid_to_time_to_drug[hadmid][day_offset] = set()
-                hadmid_to_time_to_drug[hadmid][day_offset].add(drug)
-                hour_offset += 24
-
-            if i % 100000 == 0:
-                print("   Drugs processed {} events".format(i))
-            i += 1
-
-    hadmid_to_time_to_processed_drug_info = {}
-    for hadmid, time_info in hadmid_to_time_to_drug.items():
-        for day_offset, drugs in time_info.items():
-            hadmid_row = []
-            for d in all_drugs:
-                if d in drugs:
-                    hadmid_row.append(1)
-                else:
-                    hadmid_row.append(0)
-            if hadmid not in hadmid_to_time_to_processed_drug_info:
-                hadmid_to_time_to_processed_drug_info[hadmid] = {}
-            hadmid_to_time_to_processed_drug_info[hadmid][day_offset] = hadmid_row
-
-    #
-    # Load chart information
-    #
-    print("Processing chart information file")
-
-    first_sample_hamid = None
-
-    # chartevent -> hadmid
-    chartevent_to_hadmid = defaultdict(set)
-
-    # hadmid -> time -> chartevent -> chartevent value
-    hadmid_to_time_to_raw_chart_info = {}
-    with open(project_dir + "/chartevents.csv", 'r') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        i = 0
-        for row in csv_reader:
-            if i == 0:
-                i += 1
-                continue
-
-            if sample_first_only and first_sample_hamid is not None and first_sample_hamid != row[0]:
-                break
-            elif sample_first_only and first_sample_hamid is None:
-                first_sample_hamid = row[0]
-
-            hadmid = row[0]
-            admittime = datetime.strptime(hadmid_to_admission_info[hadmid][1], '%Y-%m-%dT%H:%M:%S')
-            offset = (datetime.strptime(row[1], '%Y-%m-%d %H:%M:%S') - admittime) / timedelta(hours=1)
-            offset = round(offset, 3)
-            days_since_admittance = math.floor(offset / 24) + 1
-
-            if hadmid not in hadmid_to_time_to_raw_chart_info:
-                hadmid_to_time_to_raw_chart_info[hadmid] = {}
-            if days_since_admittance not in hadmid_to_time_to_raw_chart_info[hadmid]:
-                hadmid_to_time_to_raw_chart_info[hadmid][days_since_admittance] = defaultdict(list)
-
-            chartitemid = row[2]
-            if chartitemid == "220045" or chartitemid == "211":
-                chart = "Heart Rate"
-            elif chartitemid == "618" or chartitemid == "220210":
-                chart = "Respiratory Rate"
-            elif chartitemid == "220180" or chartitemid == "8441":
-                chart = "Diastolic"
-            elif chartitemid == "220179" or chartitemid == "455":
-                chart = "Systolic"
-            elif chartitemid == "220277" or chartitemid == "211":
-                chart = "O2"
-            elif chartitemid == "223834" or chartitemid == "470":
-                chart = "O2 Flow"
-            elif chartitemid == "223762" or chartitemid == "677":
-                chart = "Temperature"
-
-            val = row[5]
-            if val == "":
-                # Skip because this is not a numeric value
-                continue
-            val = float(val)
-            chartevent_to_hadmid[chart].add(hadmid)
-            hadmid_to_time_to_raw_chart_info[hadmid][days_since_admittance][chart].append((offset, val))
-
-            if i % 100000 == 0:
-                print("   Charts processed {} events".format(i))
-            i += 1
-
-    hadmid_to_time_to_processed_chart_info = {}
-    for hadmid, time_info in hadmid_to_time_to_raw_chart_info.items():
-        for day_offset, raw_chart_info in time_info.items():
-            hadmid_row = []
-            for chart, _ in chartevent_to_hadmid.items():
-                if chart in raw_chart_info:
-                    # Calculate average among all chart values
-                    hadmid_row.append(sum([t[1] for t in raw_chart_info[chart]]) / float(len(raw_chart_info[chart])))
-                    # Calculate trend over the time period
-                    hadmid_row.append(calculate_trend(raw_chart_info[chart]))
-                else:
-                    hadmid_row.append(0)
-                    hadmid_row.append(0)
-            if hadmid not in hadmid_to_time_to_processed_chart_info:
-                hadmid_to_time_to_processed_chart_info[hadmid] = {}
-            hadmid_to_time_to_processed_chart_info[hadmid][day_offset] = hadmid_row
-
+    # ((hadmid, day), lab, offset, labvalue) events
+    lab_events = GroupedEvents()
+    rows = open_rows(project_dir + "/labevents.csv", LAB_COLUMNS, "Labs", sample_first_only)
+    add_lab_events(select_admission_rows(rows, selector), hadmid_to_admit_epoch, lab_to_column, lab_events)
+    fill_aggregate_features(features, timestep_to_row, lab_to_column, lab_events, aggregates, get_day_end)
 
-    #
-    # Join the events back into one file
-    #
-    print("Joining all events")
-
-    with open(output_location, 'w') as w_file:
-        csv_writer = csv.writer(w_file, delimiter=',')
 
-        #### Build Headers ####
-        headers = [
-            "timestep",
-            "status",
-            "los",
-            "age",
-            "gender",
-            "insurance",
-            "language",
-            "religion",
-            "marital_status",
-            "ethnicity"
-        ]
+def process_prescriptions(project_dir, hadmid_to_admit_epoch, timestep_to_row, drug_to_column, features,
+                          sample_first_only=False, selector=None):
+    """
+    Reads the prescriptions file and marks every drug given on each day in the features
 
-        for l in lab_to_hadmid.keys():
-            headers.append(l)
-            headers.append(l + "-trend")
+    If selector is given, only the events of the new or changed admissions of the feature store are aggregated
+    (see AdmissionSelector)
+    """
+    print("Processing prescriptions file")
 
-        for d in all_drugs:
-            headers.append(d)
+    # hadmid -> intervals of days that each drug was administered on
+    hadmid_to_drug_intervals = {}
+    rows = open_rows(project_dir + "/prescriptions.csv", DRUG_COLUMNS, "Drugs", sample_first_only)
+    add_drug_events(select_admission_rows(rows, selector), hadmid_to_admit_epoch, drug_to_column,
+                    hadmid_to_drug_intervals)
+    fill_drug_intervals(features, get_admission_rows(timestep_to_row), hadmid_to_drug_intervals)
 
-        for c in chartevent_to_hadmid.keys():
-            headers.append(c)
-            headers.append(c + "-trend")
 
-        csv_writer.writerow(headers)
+def process_charts(project_dir, hadmid_to_admit_epoch, timestep_to_row, chart_itemid_to_column, features,
+                   sample_first_only=False, selector=None, aggregates=DEFAULT_AGGREGATES):
+    """
+    Reads the chart file and writes the daily aggregates (by default the average and trend) of every chart event
+    into the features.
+    chart_itemid_to_column maps the ITEMIDs to the columns of their chart event (see get_chart_itemid_columns).
 
+    If selector is given, only the events of the new or changed admissions of the feature store are aggregated
+    (see AdmissionSelector)
+    """
+    print("Processing chart information file")
 
-        #### Derive Content ####
-        for hadmid, row in hadmid_to_admission_info.items():
+    # ((hadmid, day), chartevent column, offset, chartevent value) events
+    chart_events = GroupedEvents()
+    rows = open_rows(project_dir + "/chartevents.csv", CHART_COLUMNS, "Charts", sample_first_only)
+    add_chart_events(select_admission_rows(rows, selector), hadmid_to_admit_epoch, chart_itemid_to_column,
+                     chart_events)
+    fill_aggregate_features(features, timestep_to_row, None, chart_events, aggregates, get_day_end)
+
+
+def process_stage_block(stage, project_dir, hadmid_to_admit_epoch, timestep_to_row, item_to_column, column_range,
+                        sample_first_only=False, selector=None):
+    """
+    Runs one of the process_* stages (in a separate process) on features that only hold the columns of its
+    source, given by column_range. Returns (those features, the selector with the fingerprints of the scan).
+    """
+    start, end = column_range
+    features = allocate_features(len(timestep_to_row), end - start)
+    stage(project_dir, hadmid_to_admit_epoch, timestep_to_row,
+          {item: column - start for item, column in item_to_column.items()}, features, sample_first_only,
+          selector)
+    return features, selector
+
+
+def write_output(output_location, hadmid_to_admission_info, columns, features, output_format="csv", max_days=None):
+    """
+    Joins the admissions with their daily lab, drug, and chart features back into one file with a row per day
+    of each admission (or into one of the binary formats of matrix_io)
+
+    The tensor format (see write_tensor_output) holds at most max_days days of each admission if given
+    """
+    #### Build Headers ####
+    headers = [
+        "timestep",
+        "status",
+        "los",
+        "age",
+        "gender",
+        "insurance",
+        "language",
+        "religion",
+        "marital_status",
+        "ethnicity"
+    ]
+
+    #### Derive Content ####
+    def get_timestep_rows():
+        for row in hadmid_to_admission_info.values():
             los = int(float(row[10]))
             # TODO: Try keeping the same data from the last time step if current time step is unknown
             for day in range(los):
                 output_row = [day, row[9], round(float(row[10]) - day, 3)]
                 output_row.extend(row[2:9])
-                if hadmid in hadmid_to_time_to_processed_lab_info:
-                    if day in hadmid_to_time_to_processed_lab_info[hadmid]:
-                        output_row.extend(hadmid_to_time_to_processed_lab_info[hadmid][day])
-                    else:
-                        # Use zeros for unknown
-                        output_row.extend([0 for _ in range(2 * len(lab_to_hadmid.keys()))])
-                else:
-                    output_row.extend([0 for _ in range(2 * len(lab_to_hadmid.keys()))])
-
-                if hadmid in hadmid_to_time_to_processed_drug_info:
-                    if day in hadmid_to_time_to_processed_drug_info[hadmid]:
-                        output_row.extend(hadmid_to_time_to_processed_drug_info[hadmid][day])
-                    else:
-                        output_row.extend([0 for _ in range(len(all_drugs))])
-                else:
-                    output_row.extend([0 for _ in range(len(all_drugs))])
-
-                if hadmid in hadmid_to_time_to_processed_chart_info:
-                    if day in hadmid_to_time_to_processed_chart_info[hadmid]:
-                        output_row.extend(hadmid_to_time_to_processed_chart_info[hadmid][day])
-                    else:
-                        output_row.extend([0 for _ in range(2*len(chartevent_to_hadmid.keys()))])
-                else:
-                    output_row.extend([0 for _ in range(2*len(chartevent_to_hadmid.keys()))])
-
-                for i in range(len(output_row)):
-                    if isinstance(output_row[i], float):
-                        output_row[i] = round(output_row[i], 3)
-
-                csv_writer.writerow(output_row)
+                yield output_row
+
+    if output_format == "tensor":
+        admission_rows = [[row[9], row[10]] + row[2:9] for row in hadmid_to_admission_info.values()]
+        write_tensor_output(output_location, headers[1:], admission_rows,
+                            [float(row[10]) for row in hadmid_to_admission_info.values()], columns, features, max_days)
+        return
+    if output_format != "csv":
+        write_binary_output(output_location, headers, list(get_timestep_rows()), columns, features, output_format)
+        return
+
+    with open_text(output_location, 'w') as w_file:
+        csv_writer = csv.writer(w_file, delimiter=',')
+        csv_writer.writerow(headers + columns)
+        # Zeros are used for unknown
+        for output_row, feature_row in zip(get_timestep_rows(), features):
+            output_row.extend([format_feature(f) for f in feature_row.tolist()])
+            csv_writer.writerow(output_row)
+
+
+def produce_output(project_dir, output_location, sample_first_only, engine="rows", vocabulary_location=None,
+                   output_format="csv", parallel_stages=False, store_location=None, max_days=None,
+                   chart_mapping_location=None, aggregates=DEFAULT_AGGREGATES):
+    """
+    Produces the file with a row per day of each admission
+
+    The columns come from the vocabulary persisted at vocabulary_location (see load_vocabulary), which can be shared
+    with prepare_first_x_hours so that both outputs have the same feature columns
+
+    With parallel_stages, the lab, prescriptions, and chart files are processed at the same time in separate processes
+
+    With a store_location, the rows engine only aggregates the events of the admissions that are new or changed since
+    the last run and takes the features of the others from the store (see feature_store.py)
+
+    Chart events are identified by the ITEMIDs of CHART_ITEMID_TO_CHART, extended by the mapping file at
+    chart_mapping_location if given (see load_chart_mapping)
+
+    Every lab and chart event has a feature column per aggregate (see AGGREGATES)
+    """
+    hadmid_to_admission_info = load_admissions(project_dir, sample_first_only)
+    hadmid_to_admit_epoch = get_admit_epochs(hadmid_to_admission_info)
+    timestep_to_row = get_timestep_rows(hadmid_to_admission_info)
+    chart_itemid_to_chart = load_chart_mapping(chart_mapping_location)
+    columns, lab_to_column, drug_to_column, chart_to_column = \
+        get_feature_columns(load_vocabulary(project_dir, vocabulary_location, chart_itemid_to_chart), aggregates)
+    chart_itemid_to_column = get_chart_itemid_columns(chart_itemid_to_chart, chart_to_column)
+    features = allocate_features(len(timestep_to_row), len(columns), on_disk=engine == "streaming")
+
+    selectors = [None] * len(EVENT_FILES)
+    if store_location is not None:
+        connection = open_feature_store(store_location, {"timesteps": "days", "columns": columns,
+                                                         "charts": chart_itemid_to_chart})
+        hadmid_to_fingerprint = fingerprint_admissions(hadmid_to_admission_info)
+        selectors = get_admission_selectors(connection, project_dir, hadmid_to_fingerprint)
+
+    column_ranges = get_column_ranges(lab_to_column, drug_to_column, chart_to_column, aggregates)
+    if engine == "streaming":
+        process_events_streaming(project_dir, hadmid_to_admission_info, hadmid_to_admit_epoch, timestep_to_row,
+                                 lab_to_column, drug_to_column, chart_itemid_to_column, features, aggregates)
+    else:
+        stages = [partial(process_labs, aggregates=aggregates), process_prescriptions,
+                  partial(process_charts, aggregates=aggregates)]
+        item_to_columns = [lab_to_column, drug_to_column, chart_itemid_to_column]
+        # The stages of the files that did not change since the last run of the store are skipped
+        indices = [i for i, selector in enumerate(selectors) if selector is None or not selector.unchanged]
+        if parallel_stages:
+            # The stages are independent until the join, so each one fills its own block of columns
+            with ProcessPoolExecutor(len(stages)) as executor:
+                futures = [
+                    executor.submit(process_stage_block, stages[i], project_dir, hadmid_to_admit_epoch,
+                                    timestep_to_row, item_to_columns[i], column_ranges[i], sample_first_only,
+                                    selectors[i])
+                    for i in indices
+                ]
+                for future, i in zip(futures, indices):
+                    start, end = column_ranges[i]
+                    features[:, start:end], selectors[i] = future.result()
+        else:
+            for i in indices:
+                stages[i](project_dir, hadmid_to_admit_epoch, timestep_to_row, item_to_columns[i], features,
+                          sample_first_only, selectors[i])
+
+    if store_location is not None:
+        print("Updating the feature store")
+        changed_hadmids = set()
+        for selector, (start, end) in zip(selectors, column_ranges):
+            hadmids = selector.get_changed_hadmids()
+            save_features(connection, selector, hadmids, (
+                (hadmid, day, features[row, start:end]) for (hadmid, day), row in timestep_to_row.items()
+                if hadmid in hadmids
+            ), columns[start:end])
+            changed_hadmids |= hadmids
+        save_admissions(connection, hadmid_to_fingerprint)
+        print("Processed {} new or changed admissions out of {}".format(len(changed_hadmids),
+                                                                       len(hadmid_to_admission_info)))
+        column_to_index = {column: index for index, column in enumerate(columns)}
+        for hadmid, day, index, value in load_features(connection, column_to_index):
+            features[timestep_to_row[(hadmid, day)], index] = value
+        connection.close()
+
+    #
+    # Join the events back into one file
+    #
+    print("Joining all events")
+    write_output(output_location, hadmid_to_admission_info, columns, features, output_format, max_days)
+
+
+def process_events_streaming(project_dir, hadmid_to_admission_info, hadmid_to_admit_epoch, timestep_to_row,
+                             lab_to_column, drug_to_column, chart_itemid_to_column, features,
+                             aggregates=DEFAULT_AGGREGATES):
+    """
+    Streaming version of produce_output for event files sorted by HADM_ID (as exported by extract_bigquery.sql)
+
+    The lab, prescription, and chart files are merge-joined one admission at a time. The daily features of each
+    admission are written as soon as its events end (into features backed by a temporary file), so memory stays
+    bounded by a single admission no matter how large the event files are.
+    """
+    hadmid_to_rows = get_admission_rows(timestep_to_row)
+
+    print("Processing lab, prescriptions, and chart information files (sorted by HADM_ID)")
+    sources = [
+        group_rows_by_hadmid(iterate_columns(project_dir + "/" + file_name, columns, name))
+        for name, file_name, columns in EVENT_FILES
+    ]
+    for hadmid, (lab_rows, drug_rows, chart_rows) in merge_by_hadmid(hadmid_to_admission_info.keys(), *sources):
+        lab_events = GroupedEvents()
+        chart_events = GroupedEvents()
+        add_lab_events(lab_rows, hadmid_to_admit_epoch, lab_to_column, lab_events)
+        hadmid_to_drug_intervals = {}
+        add_drug_events(drug_rows, hadmid_to_admit_epoch, drug_to_column, hadmid_to_drug_intervals)
+        add_chart_events(chart_rows, hadmid_to_admit_epoch, chart_itemid_to_column, chart_events)
+        fill_aggregate_features(features, timestep_to_row, lab_to_column, lab_events, aggregates, get_day_end)
+        fill_drug_intervals(features, hadmid_to_rows, hadmid_to_drug_intervals)
+        fill_aggregate_features(features, timestep_to_row, None, chart_events, aggregates, get_day_end)
 
 
 ########################################################################
@@ -352,7 +428,37 @@ def produce_output(project_dir, output_location, sample_first_only):
 # 100087,2126-11-01 17:49:00,220045,Heart Rate,78,78,bpm,0
 # 100087,2126-11-01 17:51:00,220180,Non Invasive Blood Pressure diastolic,87,87,mmHg,0
 
-project_dir = sys.argv[1]
-output_location = sys.argv[2]
-sample_first_only = bool(sys.argv[3]) if len(sys.argv) > 3 else False # If true, produce a file containing only the first sample (assumes files are sorted order)
-produce_output(project_dir, output_location, sample_first_only)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("project_dir")
+    parser.add_argument("output_location")
+    # If given, produce a file containing only the first sample (assumes files are sorted order)
+    parser.add_argument("sample_first_only", nargs="?", default="")
+    parser.add_argument("--engine", choices=["rows", "streaming"], default="rows",
+                        help="streaming requires the event files to be sorted by HADM_ID")
+    parser.add_argument("--vocabulary", default=None,
+                        help="JSON file of the lab, drug, and chart columns (created on the first run if missing)")
+    parser.add_argument("--chart-mapping", default=None,
+                        help="JSON (ITEMID -> chart name) or CSV (ITEMID,CONCEPT) file of chart ITEMIDs to add to the "
+                             "built-in mapping")
+    parser.add_argument("--aggregates", type=parse_aggregates, default=",".join(DEFAULT_AGGREGATES),
+                        help="comma-separated daily aggregates of every lab and chart event (eg. mean,trend,min,max,"
+                             "std,first,last,count,time_since_last)")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS + ["tensor"], default="csv",
+                        help="binary formats are described in matrix_io.py")
+    parser.add_argument("--max-days", type=int, default=None,
+                        help="number of days of each admission kept in the tensor format (all of them by default)")
+    parser.add_argument("--parallel-stages", action="store_true",
+                        help="process the lab, prescriptions, and chart files at the same time (rows engine only)")
+    parser.add_argument("--store", default=None,
+                        help="SQLite file of the features of every admission, so that later runs only process the "
+                             "admissions whose events changed (rows engine only, events sorted by HADM_ID)")
+    args = parser.parse_args()
+    if args.parallel_stages and args.engine != "rows":
+        parser.error("--parallel-stages is only supported by the rows engine")
+    if args.store is not None and args.engine != "rows":
+        parser.error("--store is only supported by the rows engine")
+
+    produce_output(args.project_dir, args.output_location, bool(args.sample_first_only), args.engine,
+                   args.vocabulary, args.format, args.parallel_stages,
+                   args.store, args.max_days, args.chart_mapping, args.aggregates)
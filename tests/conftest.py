@@ -0,0 +1,70 @@
+"""
+Shared fixtures of the tests: a small synthetic MIMIC-III project directory with the files that
+extract_bigquery.sql exports (admissions.derived.csv, and labevents.csv, prescriptions.csv, and chartevents.csv
+sorted by HADM_ID, so that every engine can read them)
+"""
+
+import csv
+from datetime import datetime, timedelta
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "extractors", "mimiciii"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "extractors", "eicu"))
+
+LABS = ["Anion Gap", "Creatinine", "Hemoglobin", "Sodium"]
+DRUGS = ["ALBU3H", "FURO40", "VANC1F", "ZITHR250"]
+CHART_ITEMIDS = ["220045", "211", "618", "220180", "220179", "646", "223762"]
+
+
+def write_csv(path, headers, rows):
+    with open(path, 'w', newline='') as w_file:
+        csv_writer = csv.writer(w_file, delimiter=',')
+        csv_writer.writerow(headers)
+        csv_writer.writerows(rows)
+
+
+def write_mimic_dir(project_dir, num_admissions=40, seed=1):
+    """
+    Writes a synthetic project directory of num_admissions admissions, with events before, within, and after the
+    first days of each admission (including non-numeric values and prescriptions without an end date)
+    """
+    rng = random.Random(seed)
+    admissions, labs, prescriptions, charts = [], [], [], []
+    for hadmid in range(100000, 100000 + num_admissions):
+        admit = datetime(2100, 1, 1) + timedelta(days=rng.randint(0, 1000), minutes=rng.randint(0, 1439))
+        los = round(rng.uniform(0.5, 6), 4)
+        admissions.append([hadmid, admit.strftime('%Y-%m-%dT%H:%M:%S'), round(rng.uniform(20, 90), 4),
+                           rng.choice("MF"), "Private", "ENGL", "CATHOLIC", "MARRIED", "WHITE", rng.randint(0, 1), los])
+        for _ in range(rng.randint(0, 30)):
+            time = admit + timedelta(minutes=rng.randint(-600, int(los * 1440)))
+            value = "" if rng.random() < 0.1 else str(round(rng.uniform(0, 200), rng.choice([0, 1, 3])))
+            labs.append([hadmid, time.strftime('%Y-%m-%d %H:%M:%S'), rng.choice(LABS), value])
+        for _ in range(rng.randint(0, 4)):
+            start = admit + timedelta(days=rng.randint(-2, int(los)))
+            end = start + timedelta(days=rng.randint(0, 4))
+            prescriptions.append([hadmid, start.strftime('%Y-%m-%d 00:00:00'),
+                                  "" if rng.random() < 0.1 else end.strftime('%Y-%m-%d 00:00:00'), rng.choice(DRUGS)])
+        for _ in range(rng.randint(0, 60)):
+            time = admit + timedelta(minutes=rng.randint(-60, int(los * 1440)), seconds=rng.choice([0, 9, 30]))
+            value = "" if rng.random() < 0.05 else str(round(rng.uniform(30, 150), 1))
+            charts.append([hadmid, time.strftime('%Y-%m-%d %H:%M:%S'), rng.choice(CHART_ITEMIDS), value])
+
+    write_csv(os.path.join(project_dir, "admissions.derived.csv"),
+              ["hadmid", "admittime", "age", "gender", "insurance", "language", "religion", "marital_status",
+               "ethnicity", "status", "los"], admissions)
+    write_csv(os.path.join(project_dir, "labevents.csv"), ["HADM_ID", "CHARTTIME", "LABEL", "VALUENUM"],
+              sorted(labs, key=lambda row: (row[0], row[1])))
+    write_csv(os.path.join(project_dir, "prescriptions.csv"), ["HADM_ID", "STARTDATE", "ENDDATE", "FORMULARY_DRUG_CD"],
+              sorted(prescriptions, key=lambda row: (row[0], row[1])))
+    write_csv(os.path.join(project_dir, "chartevents.csv"), ["HADM_ID", "CHARTTIME", "ITEMID", "VALUENUM"],
+              sorted(charts, key=lambda row: (row[0], row[1])))
+    return project_dir
+
+
+@pytest.fixture(scope="session")
+def mimic_dir(tmp_path_factory):
+    return write_mimic_dir(str(tmp_path_factory.mktemp("mimic")))
@@ -0,0 +1,39 @@
+import csv
+
+import pytest
+
+from extractor_utils import CSV_BACKENDS, iterate_columns, read_csv_columns, read_csv_header
+
+
+@pytest.fixture
+def notes_csv(tmp_path):
+    path = str(tmp_path / "NOTEEVENTS.csv")
+    with open(path, 'w', newline='') as w_file:
+        csv_writer = csv.writer(w_file, delimiter=',')
+        csv_writer.writerow(["ROW_ID", "HADM_ID", "CATEGORY", "TEXT"])
+        for row_id in range(50):
+            csv_writer.writerow([row_id, 100000 + row_id, "" if row_id % 4 else "Discharge",
+                                 "Patient, \"{}\"\nexpired".format(row_id) if row_id % 3 == 0 else "plain"])
+    return path
+
+
+@pytest.mark.parametrize("backend", CSV_BACKENDS)
+def test_read_csv_columns(notes_csv, backend):
+    columns = [value for chunk in read_csv_columns(notes_csv, ["TEXT", "HADM_ID"], backend, chunk_rows=7,
+                                                    newlines_in_values=True)
+               for value in zip(*chunk)]
+    assert columns == [("Patient, \"{}\"\nexpired".format(row_id) if row_id % 3 == 0 else "plain", str(100000 + row_id))
+                       for row_id in range(50)]
+    categories = [category for category, in iterate_columns(notes_csv, ["CATEGORY"], "Notes", backend=backend,
+                                                             newlines_in_values=True)]
+    assert categories == ["" if row_id % 4 else "Discharge" for row_id in range(50)]
+
+
+@pytest.mark.parametrize("backend", CSV_BACKENDS)
+def test_read_csv_columns_missing_column(notes_csv, backend):
+    with pytest.raises(ValueError):
+        list(read_csv_columns(notes_csv, ["HADM_ID", "LONG_TITLE"], backend, newlines_in_values=True))
+
+
+def test_read_csv_header(notes_csv):
+    assert read_csv_header(notes_csv) == ["ROW_ID", "HADM_ID", "CATEGORY", "TEXT"]
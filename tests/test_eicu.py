@@ -0,0 +1,115 @@
+import csv
+import gzip
+import os
+import shutil
+
+import pytest
+
+from eicu_index import open_index, read_patient_rows
+from extract_patient_info_eicu import extract_patients, scan_file_for_patients, scan_file_for_relevant_lines
+from extract_pneumonia_eicu import produce_file_subsets
+from join_datasets_by_guid import join
+
+
+def write_csv(path, headers, rows):
+    with open(path, 'w', newline='') as w_file:
+        csv_writer = csv.writer(w_file, delimiter=',')
+        csv_writer.writerow(headers)
+        csv_writer.writerows(rows)
+
+
+@pytest.fixture
+def eicu_dir(tmp_path):
+    data_dir = str(tmp_path)
+    write_csv(os.path.join(data_dir, "patient.csv"), ["patientunitstayid", "gender", "apacheadmissiondx"],
+              [[141000 + i, "Male", "Pneumonia, bacterial"] for i in range(20)])
+    # The patientunitstayid is not the second column, and the lab names contain commas and line breaks
+    write_csv(os.path.join(data_dir, "lab.csv"),
+              ["labid", "labresultoffset", "patientunitstayid", "labname", "labresult"],
+              [[i, i * 10, 141000 + i // 3, "Na, \"serum\"\nlevel" if i % 4 == 0 else "BUN", i] for i in range(60)])
+    return data_dir
+
+
+def test_scan_file_for_patients(eicu_dir):
+    header, id_to_rows = scan_file_for_patients(eicu_dir, "lab.csv", {"141002", "141019"})
+    assert header == ["labid", "labresultoffset", "patientunitstayid", "labname", "labresult"]
+    assert sorted(id_to_rows) == ["141002", "141019"]
+    assert [row[0] for row in id_to_rows["141002"]] == ["6", "7", "8"]
+    assert list(id_to_rows["141002"][2]) == ["8", "80", "141002", "Na, \"serum\"\nlevel", "8"]
+
+
+def test_scan_file_without_patient_column(eicu_dir):
+    write_csv(os.path.join(eicu_dir, "medication.csv"), ["medicationid", "stayid"], [[1, 141000]])
+    with pytest.raises(ValueError):
+        scan_file_for_patients(eicu_dir, "medication.csv", {"141000"})
+
+
+def test_extract_patients_matches_index(eicu_dir):
+    output_path = os.path.join(eicu_dir, "patient{}.out")
+    extract_patients(eicu_dir, ["141005", "141001"], output_path)
+    connection = open_index(eicu_dir)
+    for patient_id in ["141005", "141001"]:
+        with open(output_path.format(patient_id), 'r', newline='') as csv_file:
+            output = list(csv.reader(csv_file, delimiter=','))
+        header, rows = read_patient_rows(connection, eicu_dir, "lab.csv", [patient_id])
+        lab_start = output.index(["lab.csv"])
+        assert output[lab_start + 1:lab_start + 2 + len(rows)] == [header] + rows
+        assert all(row[2] == patient_id for row in rows) and len(rows) == 3
+    connection.close()
+
+
+def read_csv(path):
+    with open(path, 'r', newline='') as csv_file:
+        return list(csv.reader(csv_file, delimiter=','))
+
+
+def compress_lab_table(data_dir):
+    with open(os.path.join(data_dir, "lab.csv"), 'rb') as csv_file, \
+            gzip.open(os.path.join(data_dir, "lab.csv.gz"), 'wb') as w_file:
+        shutil.copyfileobj(csv_file, w_file)
+    os.remove(os.path.join(data_dir, "lab.csv"))
+
+
+def test_subset_compressed_table(eicu_dir):
+    produce_file_subsets(eicu_dir, ["lab.csv"], ["141002", "141019"], 2)
+    subset = read_csv(os.path.join(eicu_dir, "pneumonia.lab.csv"))
+    assert [row[0] for row in subset] == ["labid", "6", "7", "8", "57", "58", "59"]
+
+    compress_lab_table(eicu_dir)
+    produce_file_subsets(eicu_dir, ["lab.csv"], ["141002", "141019"], 2)
+    assert read_csv(os.path.join(eicu_dir, "pneumonia.lab.csv")) == subset
+
+
+def test_relevant_lines_of_compressed_table(eicu_dir):
+    connection = open_index(eicu_dir)
+    lines = scan_file_for_relevant_lines(connection, eicu_dir, "lab.csv", "141002")
+    connection.close()
+    assert [row[0] for row in lines] == ["lab.csv", "labid", "6", "7", "8"]
+
+    compress_lab_table(eicu_dir)
+    connection = open_index(eicu_dir)
+    assert scan_file_for_relevant_lines(connection, eicu_dir, "lab.csv", "141002") == lines
+    connection.close()
+
+
+def test_join_reads_labs_by_column_name(eicu_dir):
+    # An extended lab export, with the columns in another order than lab.csv
+    write_csv(os.path.join(eicu_dir, "lab.extended.csv"),
+              ["labresult", "labname", "labmeasurenamesystem", "patientunitstayid", "labid"],
+              [["140", "sodium", "mmol/L", "141001", 1], ["150", "sodium", "mmol/L", "141001", 2],
+               ["7", "BUN", "mg/dL", "141003", 3], ["x", "sodium", "mmol/L", "141003", 4]])
+    output_path = os.path.join(eicu_dir, "joined.csv")
+    join("patient.csv", "lab.extended.csv", [("sodium", "last"), ("sodium", "mean"), ("BUN", "count")], eicu_dir,
+         output_path)
+    with open(output_path, 'r', newline='') as csv_file:
+        rows = list(csv.reader(csv_file, delimiter=','))
+    assert rows[0] == ["patientunitstayid", "gender", "apacheadmissiondx", "sodium", "sodium-mean", "BUN-count"]
+    assert rows[2] == ["141001", "Male", "Pneumonia, bacterial", "150", "145.0", "0"]
+    assert rows[4] == ["141003", "Male", "Pneumonia, bacterial", "x", "", "1"]
+
+
+def test_join_without_lab_column(eicu_dir):
+    write_csv(os.path.join(eicu_dir, "lab.renamed.csv"), ["patientunitstayid", "labname", "result"],
+              [["141001", "sodium", "140"]])
+    with pytest.raises(ValueError):
+        join("patient.csv", "lab.renamed.csv", [("sodium", "last")], eicu_dir, os.path.join(eicu_dir, "joined.csv"))
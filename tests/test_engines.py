@@ -0,0 +1,153 @@
+import csv
+from functools import partial
+import os
+import shutil
+
+import pytest
+
+from extractor_utils import AGGREGATES
+import prepare_first_x_hours
+import prepare_lstm_input
+
+ALL_AGGREGATES = sorted(AGGREGATES)
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def produce_windows(project_dir, directory, **kwargs):
+    os.makedirs(str(directory), exist_ok=True)
+    window_to_output_location = {window: os.path.join(str(directory), "first{}hours.csv".format(window))
+                                 for window in [6, 48]}
+    prepare_first_x_hours.produce_outputs(project_dir, window_to_output_location, aggregates=ALL_AGGREGATES, **kwargs)
+    return {window: read_file(location) for window, location in window_to_output_location.items()}
+
+
+def produce_timesteps(project_dir, directory, **kwargs):
+    os.makedirs(str(directory), exist_ok=True)
+    output_location = os.path.join(str(directory), "timestep.csv")
+    prepare_lstm_input.produce_output(project_dir, output_location, False, aggregates=ALL_AGGREGATES, **kwargs)
+    return read_file(output_location)
+
+
+@pytest.fixture(scope="module")
+def rows_windows(mimic_dir, tmp_path_factory):
+    return produce_windows(mimic_dir, tmp_path_factory.mktemp("rows"))
+
+
+@pytest.fixture(scope="module")
+def rows_timesteps(mimic_dir, tmp_path_factory):
+    return produce_timesteps(mimic_dir, tmp_path_factory.mktemp("rows"))
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"engine": "columnar"},
+    {"engine": "streaming"},
+    {"engine": "rows", "jobs": 2},
+    {"engine": "rows", "parallel_stages": True},
+    {"engine": "columnar", "parallel_stages": True},
+], ids=["columnar", "streaming", "jobs", "rows-parallel-stages", "columnar-parallel-stages"])
+def test_engines_match_rows_engine(mimic_dir, rows_windows, tmp_path, kwargs):
+    assert produce_windows(mimic_dir, tmp_path, **kwargs) == rows_windows
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"engine": "streaming"},
+    {"engine": "rows", "parallel_stages": True},
+], ids=["streaming", "parallel-stages"])
+def test_lstm_engines_match_rows_engine(mimic_dir, rows_timesteps, tmp_path, kwargs):
+    assert produce_timesteps(mimic_dir, tmp_path, **kwargs) == rows_timesteps
+
+
+def test_columnar_chunks_split_admissions(mimic_dir, rows_windows, tmp_path, monkeypatch):
+    # Chunks of a few events end within the events of most admissions
+    monkeypatch.setattr(prepare_first_x_hours, "iterate_event_chunks",
+                        partial(prepare_first_x_hours.iterate_event_chunks, chunk_rows=7))
+    assert produce_windows(mimic_dir, tmp_path, engine="columnar") == rows_windows
+
+
+def test_event_chunks_hold_whole_admissions(mimic_dir):
+    chunks = list(prepare_first_x_hours.iterate_event_chunks(os.path.join(mimic_dir, "labevents.csv"),
+                                                             ["HADM_ID", "VALUENUM"], ["hadmid", "val"], chunk_rows=7))
+    hadmids = [set(chunk["hadmid"]) for chunk in chunks]
+    assert all(not (first & second) for first in hadmids for second in hadmids if first is not second)
+    with open(os.path.join(mimic_dir, "labevents.csv"), 'r') as csv_file:
+        assert sum(len(chunk) for chunk in chunks) == len(csv_file.readlines()) - 1
+
+
+def quote_chart_file(project_dir):
+    """
+    Rewrites the chart file with every value quoted (eg. "100001"), which changes none of its events
+    """
+    path = os.path.join(project_dir, "chartevents.csv")
+    with open(path, 'r', newline='') as csv_file:
+        rows = list(csv.reader(csv_file, delimiter=','))
+    with open(path, 'w', newline='') as w_file:
+        csv.writer(w_file, delimiter=',', quoting=csv.QUOTE_ALL).writerows(rows)
+
+
+def change_first_chart_value(project_dir):
+    """
+    Changes the value of the first chart event, so that only its admission has different events
+    """
+    path = os.path.join(project_dir, "chartevents.csv")
+    with open(path, 'r', newline='') as csv_file:
+        rows = list(csv.reader(csv_file, delimiter=','))
+    rows[1][3] = "999.0"
+    with open(path, 'w', newline='') as w_file:
+        csv.writer(w_file, delimiter=',').writerows(rows)
+
+
+@pytest.mark.parametrize("engine", ["rows", "columnar"])
+def test_store_only_processes_changed_admissions(mimic_dir, rows_windows, tmp_path, capsys, engine):
+    project_dir = str(tmp_path / "mimic")
+    shutil.copytree(mimic_dir, project_dir)
+    store_location = str(tmp_path / "features.sqlite")
+
+    assert produce_windows(project_dir, tmp_path / "first", engine=engine, store_location=store_location) == \
+        rows_windows
+    assert "Processed 40 new or changed admissions out of 40" in capsys.readouterr().out
+
+    assert produce_windows(project_dir, tmp_path / "same", engine=engine, store_location=store_location) == \
+        rows_windows
+    output = capsys.readouterr().out
+    assert "Processed 0 new or changed admissions out of 40" in output
+    assert "Charts unchanged since the last run" in output and "Processing chart" not in output
+
+    change_first_chart_value(project_dir)
+    changed = produce_windows(project_dir, tmp_path / "changed", engine=engine, store_location=store_location)
+    assert "Processed 1 new or changed admissions out of 40" in capsys.readouterr().out
+    assert changed == produce_windows(project_dir, tmp_path / "fresh", engine=engine)
+    assert changed != rows_windows
+
+
+@pytest.mark.parametrize("engine", ["rows", "columnar"])
+def test_store_ignores_quoted_values(mimic_dir, rows_windows, tmp_path, capsys, engine):
+    project_dir = str(tmp_path / "mimic")
+    shutil.copytree(mimic_dir, project_dir)
+    store_location = str(tmp_path / "features.sqlite")
+    produce_windows(project_dir, tmp_path / "first", engine=engine, store_location=store_location)
+    capsys.readouterr()
+
+    quote_chart_file(project_dir)
+    assert produce_windows(project_dir, tmp_path / "quoted", engine=engine, store_location=store_location) == \
+        rows_windows
+    output = capsys.readouterr().out
+    assert "Processing chart" in output and "Processed 0 new or changed admissions out of 40" in output
+
+
+def test_lstm_store_only_processes_changed_admissions(mimic_dir, rows_timesteps, tmp_path, capsys):
+    project_dir = str(tmp_path / "mimic")
+    shutil.copytree(mimic_dir, project_dir)
+    store_location = str(tmp_path / "features.sqlite")
+
+    assert produce_timesteps(project_dir, tmp_path / "first", store_location=store_location) == rows_timesteps
+    assert produce_timesteps(project_dir, tmp_path / "same", store_location=store_location) == rows_timesteps
+    capsys.readouterr()
+
+    change_first_chart_value(project_dir)
+    changed = produce_timesteps(project_dir, tmp_path / "changed", store_location=store_location)
+    assert "Processed 1 new or changed admissions out of 40" in capsys.readouterr().out
+    assert changed == produce_timesteps(project_dir, tmp_path / "fresh")
@@ -0,0 +1,38 @@
+import pandas as pd
+import pytest
+
+from feature_store import AdmissionSelector
+
+ROWS = [("100", "2100-01-01 00:00:00", "7.0"), ("100", "2100-01-01 01:00:00", "8.0"),
+        ("101", "2100-01-02 00:00:00", "9.0"), ("103", "2100-01-03 00:00:00", "1.0")]
+HADMID_TO_ADMISSION_FINGERPRINT = {"100": "a", "101": "b", "102": "c"}
+
+
+def test_select_rows_of_changed_admissions():
+    first = AdmissionSelector("Labs", (0, 0), False, HADMID_TO_ADMISSION_FINGERPRINT, {})
+    # 103 is not one of the admissions
+    assert list(first.select_rows(iter(ROWS))) == ROWS[:3]
+    assert first.get_changed_hadmids() == {"100", "101", "102"}
+
+    changed_rows = ROWS[:2] + [("101", "2100-01-02 00:00:00", "9.5")] + ROWS[3:]
+    second = AdmissionSelector("Labs", (0, 0), False, HADMID_TO_ADMISSION_FINGERPRINT, first.hadmid_to_fingerprint)
+    assert list(second.select_rows(iter(changed_rows))) == changed_rows[2:3]
+    assert second.get_changed_hadmids() == {"101"}
+
+
+def test_select_events_of_changed_admissions():
+    events = pd.DataFrame(ROWS, columns=["hadmid", "charttime", "val"])
+    first = AdmissionSelector("Labs", (0, 0), False, HADMID_TO_ADMISSION_FINGERPRINT, {})
+    assert first.select_events(events)["hadmid"].tolist() == ["100", "100", "101"]
+    assert first.get_changed_hadmids() == {"100", "101", "102"}
+
+    events.loc[2, "val"] = "9.5"
+    second = AdmissionSelector("Labs", (0, 0), False, HADMID_TO_ADMISSION_FINGERPRINT, first.hadmid_to_fingerprint)
+    assert second.select_events(events)["hadmid"].tolist() == ["101"]
+    assert second.get_changed_hadmids() == {"101"}
+
+
+def test_select_events_not_sorted_by_hadmid():
+    events = pd.DataFrame(ROWS[:1] + ROWS[2:3] + ROWS[1:2], columns=["hadmid", "charttime", "val"])
+    with pytest.raises(ValueError):
+        AdmissionSelector("Labs", (0, 0), False, HADMID_TO_ADMISSION_FINGERPRINT, {}).select_events(events)
@@ -0,0 +1,48 @@
+import os
+
+import pandas as pd
+import pytest
+
+from filter_matrix import FILTER_FORMATS, count_column_values, filter_matrix
+from matrix_io import load_matrix
+
+
+@pytest.mark.parametrize("output_format", FILTER_FORMATS)
+def test_filter_matrix(tmp_path, output_format):
+    input_file = str(tmp_path / "first48hours.csv")
+    pd.DataFrame({"hadmid": [1, 2, 3, 4], "gender": ["M", None, "F", "M"], "Sodium": [0, 0, 0, 140.5],
+                  "Heart Rate": [80.0, None, float("inf"), 0], "status": [0, 0, 0, 1]}).to_csv(input_file, index=False)
+    output_location = str(tmp_path / ("first48hours.filtered." + output_format))
+    filter_matrix(input_file, output_location, threshold=0.7, keep={"status"}, output_format=output_format,
+                  chunk_rows=3)
+    loaded = load_matrix(str(tmp_path / "first48hours.filtered.csv"), dense=True)
+    if output_format == "csv":
+        loaded = loaded.drop(columns=loaded.columns[0])
+    expected = pd.DataFrame({"hadmid": [1, 2, 3, 4], "gender": ["M", "0", "F", "M"],
+                             "Heart Rate": [80.0, 0, 0, 0], "status": [0, 0, 0, 1]})
+    pd.testing.assert_frame_equal(loaded, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize("output_format", FILTER_FORMATS)
+def test_filter_header_only_matrix(tmp_path, output_format):
+    input_file = str(tmp_path / "first48hours.csv")
+    with open(input_file, 'w') as w_file:
+        w_file.write("hadmid,Sodium,status\n")
+    output_location = str(tmp_path / ("first48hours.filtered." + output_format))
+    filter_matrix(input_file, output_location, output_format=output_format)
+    assert os.path.exists(output_location)
+    loaded = load_matrix(str(tmp_path / "first48hours.filtered.csv"), dense=True)
+    assert len(loaded) == 0
+    assert list(loaded.columns)[-3:] == ["hadmid", "Sodium", "status"]
+
+
+def test_count_zeros_like_whole_matrix(tmp_path):
+    input_file = str(tmp_path / "first48hours.csv")
+    # The first chunk of insurance is numeric, but the whole column is text, so its "0" values are not zeros
+    pd.DataFrame({"insurance": ["0", "0", "0", "Private"], "religion": ["0", "0", "0", "0"],
+                  "Sodium": [0, 0, 0, 140.5], "Heart Rate": [0.0, None, 80.0, 0]}).to_csv(input_file, index=False)
+    num_rows, column_types, zeros, nans, infs = count_column_values(input_file, chunk_rows=3)
+    whole_matrix = pd.read_csv(input_file, header=0)
+    assert zeros == {column: int((whole_matrix[column] == 0).sum()) for column in whole_matrix.columns}
+    assert zeros == {"insurance": 0, "religion": 4, "Sodium": 3, "Heart Rate": 2}
+    assert column_types["insurance"] == "object"
@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from matrix_io import OUTPUT_FORMATS, load_matrix, sliding_windows
+from prepare_first_x_hours import produce_output
+
+
+@pytest.fixture(scope="module")
+def csv_output(mimic_dir, tmp_path_factory):
+    output_location = os.path.join(str(tmp_path_factory.mktemp("csv")), "first48hours.csv")
+    produce_output(mimic_dir, output_location, 48)
+    return output_location
+
+
+def write_output(mimic_dir, directory, output_format):
+    output_location = os.path.join(str(directory), "first48hours.csv")
+    produce_output(mimic_dir, output_location, 48, output_format=output_format)
+    return output_location
+
+
+def test_sparse_round_trip(mimic_dir, csv_output, tmp_path):
+    expected = pd.read_csv(csv_output)
+    loaded = load_matrix(write_output(mimic_dir, tmp_path, "sparse"), dense=False)
+    feature_columns = [column for column in loaded.columns if isinstance(loaded[column].dtype, pd.SparseDtype)]
+    assert feature_columns == list(expected.columns[9:])
+    assert loaded[feature_columns].sparse.to_dense().equals(expected[feature_columns].astype(np.float64))
+    pd.testing.assert_frame_equal(loaded[list(expected.columns[:9])], expected[list(expected.columns[:9])])
+
+
+def test_sliding_windows():
+    tensor = np.arange(3 * 6 * 2, dtype=np.float32).reshape(3, 6, 2)
+    lengths = np.array([6, 2, 4])
+    targets = np.arange(3 * 6, dtype=np.float32).reshape(3, 6)
+    windows, window_targets, valid = sliding_windows(tensor, lengths, targets, 3)
+    assert windows.shape == (3, 4, 3, 2)
+    for a in range(3):
+        for d in range(4):
+            np.testing.assert_array_equal(windows[a, d], tensor[a, d:d + 3])
+    np.testing.assert_array_equal(window_targets, targets[:, :4] - 3)
+    np.testing.assert_array_equal(valid, [[True] * 4, [False] * 4, [True, True, False, False]])
+    assert sliding_windows(tensor, lengths, targets, 7)[0].shape == (3, 0, 7, 2)
+
+
+@pytest.mark.parametrize("output_format", OUTPUT_FORMATS)
+def test_load_matrix_round_trip(mimic_dir, csv_output, tmp_path, output_format):
+    expected = pd.read_csv(csv_output)
+    loaded = load_matrix(write_output(mimic_dir, tmp_path, output_format), dense=True)
+    pd.testing.assert_frame_equal(loaded, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize("output_format", OUTPUT_FORMATS)
+def test_load_matrix_columns(mimic_dir, csv_output, tmp_path, output_format):
+    output_location = write_output(mimic_dir, tmp_path, output_format)
+    columns = ["Heart Rate-trend", "los", "Sodium", "status"]
+    loaded = load_matrix(output_location, columns=columns, dense=True)
+    assert list(loaded.columns) == columns
+    pd.testing.assert_frame_equal(loaded, pd.read_csv(csv_output)[columns], check_dtype=False)
+    with pytest.raises(KeyError):
+        load_matrix(output_location, columns=["los", "Not a column"])
@@ -0,0 +1,79 @@
+import csv
+import io
+
+import pytest
+
+from eicu_index import iterate_runs
+from extractor_utils import get_quote_parity, get_record_byte_ranges, iterate_records
+
+
+@pytest.fixture
+def quoted_csv(tmp_path):
+    path = str(tmp_path / "NOTES.csv")
+    with open(path, 'w', newline='') as w_file:
+        csv_writer = csv.writer(w_file, delimiter=',')
+        csv_writer.writerow(["ROW_ID", "HADM_ID", "TEXT"])
+        for row_id in range(200):
+            text = "line\nbreak, \"quoted\"" if row_id % 3 == 0 else "plain"
+            csv_writer.writerow([row_id, 100000 + row_id // 7, text])
+    return path
+
+
+@pytest.mark.parametrize("num_shards", [1, 2, 7, 50])
+def test_record_byte_ranges(quoted_csv, num_shards):
+    byte_ranges = get_record_byte_ranges(quoted_csv, num_shards)
+    records = []
+    with open(quoted_csv, 'rb') as csv_file:
+        for start, end in byte_ranges:
+            csv_file.seek(start)
+            for record_start, record_end, record in iterate_records(csv_file, start, end - start):
+                assert start <= record_start < record_end <= end
+                records.append(record)
+    with open(quoted_csv, 'rb') as csv_file:
+        next(csv_file)
+        assert b"".join(records) == csv_file.read()
+    rows = [row for record in records for row in csv.reader(io.StringIO(record.decode('utf-8'), newline=''))]
+    assert [row[0] for row in rows] == [str(row_id) for row_id in range(200)]
+
+
+@pytest.mark.parametrize("num_shards", [2, 7, 50])
+def test_record_byte_ranges_by_first_column(tmp_path, num_shards):
+    path = str(tmp_path / "EVENTS.csv")
+    with open(path, 'w', newline='') as w_file:
+        csv_writer = csv.writer(w_file, delimiter=',')
+        csv_writer.writerow(["HADM_ID", "TEXT"])
+        for row_id in range(200):
+            csv_writer.writerow([100000 + row_id // 7, "line\nbreak" if row_id % 3 == 0 else "plain"])
+
+    range_hadmids = []
+    with open(path, 'rb') as csv_file:
+        for start, end in get_record_byte_ranges(path, num_shards, True):
+            csv_file.seek(start)
+            rows = csv.reader(io.StringIO(csv_file.read(end - start).decode('utf-8'), newline=''))
+            range_hadmids.append([row[0] for row in rows])
+    assert len(range_hadmids) > 1
+    assert [hadmid for hadmids in range_hadmids for hadmid in hadmids] == [str(100000 + i // 7) for i in range(200)]
+    assert all(previous[-1] != hadmids[0] for previous, hadmids in zip(range_hadmids[:-1], range_hadmids[1:]))
+
+
+@pytest.mark.parametrize("window", [4, 16, 1 << 20])
+def test_quote_parity(quoted_csv, window):
+    with open(quoted_csv, 'rb') as csv_file:
+        content = csv_file.read()
+        for split in range(len(content)):
+            in_quotes = get_quote_parity(csv_file, split, window)
+            if b'"' not in content[max(split - window, 0):split + window]:
+                # Assumed outside of quoted values, which only holds for windows longer than the values
+                continue
+            if in_quotes is not None or window > len(content):
+                assert in_quotes == (content.count(b'"', 0, split) % 2 == 1)
+
+
+def test_iterate_runs(quoted_csv):
+    runs = list(iterate_runs(quoted_csv, 1))
+    assert [run_id for run_id, _, _ in runs] == [str(100000 + i) for i in range(29)]
+    with open(quoted_csv, 'rb') as csv_file:
+        _, start, end = runs[1]
+        csv_file.seek(start)
+        rows = list(csv.reader(io.StringIO(csv_file.read(end - start).decode('utf-8'), newline='')))
+    assert [row[0] for row in rows] == [str(row_id) for row_id in range(7, 14)]
@@ -0,0 +1,24 @@
+import json
+import os
+
+import pytest
+
+from extractor_utils import CHART_ITEMID_TO_CHART, load_chart_mapping, load_vocabulary
+
+
+def test_load_persisted_vocabulary(mimic_dir, tmp_path):
+    vocabulary_location = str(tmp_path / "vocabulary.json")
+    vocabulary = load_vocabulary(mimic_dir, vocabulary_location, CHART_ITEMID_TO_CHART)
+    assert os.path.exists(vocabulary_location)
+    assert load_vocabulary(mimic_dir, vocabulary_location, CHART_ITEMID_TO_CHART) == vocabulary
+
+
+def test_chart_mapping_missing_from_vocabulary(mimic_dir, tmp_path):
+    vocabulary_location = str(tmp_path / "vocabulary.json")
+    load_vocabulary(mimic_dir, vocabulary_location, CHART_ITEMID_TO_CHART)
+
+    mapping_location = str(tmp_path / "charts.json")
+    with open(mapping_location, 'w') as w_file:
+        json.dump({"220050": "Arterial Systolic", "220051": "Heart Rate"}, w_file)
+    with pytest.raises(ValueError, match="Arterial Systolic"):
+        load_vocabulary(mimic_dir, vocabulary_location, load_chart_mapping(mapping_location))